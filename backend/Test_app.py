@@ -59,6 +59,7 @@ def setup_database():
     # Limpar banco após o teste
     with engine.begin() as conn:
         conn.execute(text("DELETE FROM uploads"))
+        conn.execute(text("DELETE FROM upload_periods"))
 
 
 @pytest.fixture
@@ -127,6 +128,56 @@ def test_health_check(client):
     data = response.json()
     assert data["ok"] is True
     assert "cache_size" in data
+    for name in ("blob", "result", "chart", "ai"):
+        assert {"hits", "misses", "evictions", "resident_bytes", "budget_bytes"} <= set(data["caches"][name])
+
+
+def test_byte_budget_cache_evicts_by_size():
+    """Teste: Cache limitado por bytes descarta os menos usados até caber e conta hits/misses"""
+    from backend.app import ByteBudgetCache
+
+    c = ByteBudgetCache(max_bytes=1000, ttl=60)
+    c["a"] = b"x" * 400
+    c["b"] = b"x" * 400
+    assert c.get("a") is not None          # "a" passa a ser o mais recente
+    c["c"] = b"x" * 400                     # estoura: sai "b", o menos usado
+    assert "b" not in c and "a" in c and "c" in c
+    assert c.get("b") is None
+    c["grande"] = b"x" * 5000               # maior que o orçamento: não entra
+    assert "grande" not in c
+    stats = c.stats()
+    assert stats["resident_bytes"] == 800
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["rejected"]) == (1, 1, 1, 1)
+
+
+def test_byte_budget_cache_is_thread_safe():
+    """Teste: Várias threads gravando, lendo e invalidando o mesmo cache sem erros nem orçamento estourado"""
+    import threading
+    from backend.app import ByteBudgetCache
+
+    c = ByteBudgetCache(max_bytes=20_000, ttl=60)
+    errors = []
+
+    def worker(n):
+        try:
+            for i in range(3000):
+                c[(n, i)] = b"x" * 1000
+                c.get((n, i - 1))
+                if i % 50 == 0:
+                    c.pop((n, i - 2), None)
+                    c.drop_where(lambda key: key[1] % 7 == 0)
+                    c.stats()
+        except Exception as e:  # qualquer erro de corrida falha o teste
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    stats = c.stats()
+    assert stats["resident_bytes"] <= 20_000 and stats["items"] == len(list(c.keys()))
 
 
 # =============================================================================
@@ -205,6 +256,126 @@ def test_upload_deduplication(client, sample_booking_excel, sample_multimodal_ex
     assert len(data2.get("skipped", [])) > 0
 
 
+def test_upload_unchanged_costs_one_round_trip(client, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: Reenvio idêntico custa uma consulta (só hashes); arquivo alterado troca só os próprios períodos"""
+    from sqlalchemy import event
+    from backend.app import sha256_bytes
+
+    mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    raw = {"booking": sample_booking_excel.getvalue(), "multimodal": sample_multimodal_excel.getvalue(),
+           "transportes": sample_transportes_excel.getvalue()}
+    files = lambda data: {k: (f"{k}.xlsx", v, mime) for k, v in data.items()}
+    assert client.post("/api/upload", files=files(raw), data={"client": "TEST_CLIENT"}).status_code == 200
+
+    statements = []
+    def count(conn, cursor, statement, params, context, executemany):
+        if "upload" in statement:
+            statements.append(statement)
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        data = client.post("/api/upload", files=files(raw), data={"client": "TEST_CLIENT"}).json()
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    assert data["inserted"] == [] and len(data["skipped"]) == 6
+    assert len(statements) == 1
+
+    # Transportes alterado: só os 2 períodos de transp são regravados, o arquivo antigo sai do store
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["Embarcador", "Data Coleta", "Data Entrega", "Porto", "Tipo Operação"])
+    ws.append(["Cliente A", "2024-10-11", "2024-10-16", "SANTOS", "FCL"])
+    buf = io.BytesIO()
+    wb.save(buf)
+    changed = dict(raw, transportes=buf.getvalue())
+    data = client.post("/api/upload", files=files(changed), data={"client": "TEST_CLIENT"}).json()
+    assert sorted((r["ym"], r["kind"]) for r in data["inserted"]) == [("2024-10", "transp"), ("2024-11", "transp")]
+    with engine.begin() as conn:
+        hashes = conn.execute(text("SELECT DISTINCT hash FROM uploads WHERE client='TEST_CLIENT' AND kind='transp'")).fetchall()
+        old = conn.execute(text("SELECT COUNT(*) FROM upload_blobs WHERE hash=:h AND kind='transp'"),
+                           {"h": sha256_bytes(raw["transportes"])}).scalar()
+    assert hashes == [(sha256_bytes(buf.getvalue()),)]
+    assert old == 0
+
+def test_upload_stores_normalized_parquet(client, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: Upload grava o frame normalizado (Parquet) junto do arquivo"""
+    from backend.app import frame_from_parquet, BOOKING_NORM_COLUMNS
+
+    files = {
+        "booking": ("booking.xlsx", sample_booking_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "multimodal": ("multi.xlsx", sample_multimodal_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "transportes": ("transp.xlsx", sample_transportes_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }
+    response = client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"})
+    assert response.status_code == 200
+
+    with engine.begin() as conn:
+        norm = conn.execute(text(
+            "SELECT b.norm FROM uploads u JOIN upload_blobs b ON b.hash = u.hash AND b.kind = u.kind "
+            "WHERE u.client='TEST_CLIENT' AND u.ym='2024-10' AND u.kind='booking'"
+        )).scalar()
+    assert norm is not None
+    df = frame_from_parquet(norm)
+    assert list(df.columns) == BOOKING_NORM_COLUMNS
+    assert int(df[df["__ym"] == "2024-10"]["qtde"].sum()) == 15
+
+
+def test_upload_stores_each_file_once(client, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: Um arquivo que cobre vários períodos é gravado uma única vez"""
+    from backend.app import sha256_bytes
+
+    booking_bytes = sample_booking_excel.getvalue()
+    files = {
+        "booking": ("booking.xlsx", booking_bytes, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "multimodal": ("multi.xlsx", sample_multimodal_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "transportes": ("transp.xlsx", sample_transportes_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }
+    response = client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"})
+    assert response.status_code == 200
+    assert response.json()["periods"] == ["2024-10", "2024-11"]
+
+    h = sha256_bytes(booking_bytes)
+    with engine.begin() as conn:
+        blobs = conn.execute(text("SELECT COUNT(*) FROM upload_blobs WHERE hash=:h AND kind='booking'"), {"h": h}).scalar()
+        mappings = conn.execute(text(
+            "SELECT COUNT(*) FROM uploads WHERE client='TEST_CLIENT' AND kind='booking' AND hash=:h AND data IS NULL"
+        ), {"h": h}).scalar()
+    assert blobs == 1
+    assert mappings == 2
+
+
+def test_upload_persists_column_mapping(client, monkeypatch, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: Mapeamento de colunas é gravado no upload e reaproveitado sem resolver cabeçalhos de novo"""
+    import json
+    import backend.app as backend_app
+
+    files = {
+        "booking": ("booking.xlsx", sample_booking_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "multimodal": ("multi.xlsx", sample_multimodal_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "transportes": ("transp.xlsx", sample_transportes_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }
+    client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"})
+
+    with engine.begin() as conn:
+        col_map = conn.execute(text("SELECT col_map FROM upload_blobs WHERE kind='booking'")).scalar()
+        # simula upload antigo sem Parquet nem agregados: a próxima leitura normaliza a partir do arquivo
+        conn.execute(text("UPDATE upload_blobs SET norm=NULL"))
+        conn.execute(text("DELETE FROM agg_files"))
+    assert json.loads(col_map)["cols"]["qtd"] == "QTDE_CONTAINER"
+
+    def fail(*args, **kwargs):
+        raise AssertionError("cabeçalhos resolvidos de novo")
+    monkeypatch.setattr(backend_app, "resolve_schema", fail)
+    client.get("/api/clear-cache")
+
+    response = client.get("/api/summary?client=TEST_CLIENT&ym=2024-10&embarcador=Cliente A")
+    assert response.status_code == 200
+    with engine.begin() as conn:
+        missing = conn.execute(text("SELECT COUNT(*) FROM upload_blobs WHERE norm IS NULL")).scalar()
+        aggregated = conn.execute(text("SELECT COUNT(*) FROM agg_files")).scalar()
+    assert missing == 0
+    assert aggregated == 3  # agregados gerados no mesmo fallback
+
+
 # =============================================================================
 # TESTES - AVAILABLE DATA
 # =============================================================================
@@ -240,6 +411,124 @@ def test_available_data_with_uploads(client, sample_booking_excel, sample_multim
     assert len(data["embarcadores"]) > 0
 
 
+
+def test_available_data_reads_embarcador_catalog(client, monkeypatch, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: Embarcadores vêm do catálogo gravado no upload, sem ler o Parquet; ?ym= filtra por mês"""
+    import backend.app as backend_app
+
+    files = {
+        "booking": ("booking.xlsx", sample_booking_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "multimodal": ("multi.xlsx", sample_multimodal_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "transportes": ("transp.xlsx", sample_transportes_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }
+    client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"})
+    client.get("/api/clear-cache")
+
+    calls = []
+    original = backend_app._read_norm
+    monkeypatch.setattr(backend_app, "_read_norm", lambda ref, kind: calls.append(kind) or original(ref, kind))
+    data = client.get("/api/available-data?client=TEST_CLIENT").json()
+    assert data["embarcadores"] == ["Cliente A", "Cliente B"]
+    assert data["embarcador_roots"]["Cliente A"]
+    assert client.get("/api/available-data?client=TEST_CLIENT&ym=2024-11").json()["embarcadores"] == ["Cliente A"]
+    assert calls == []
+
+    # upload anterior ao catálogo: lê o Parquet uma vez e grava o catálogo
+    with engine.begin() as conn:
+        h = conn.execute(text("SELECT hash FROM uploads WHERE client='TEST_CLIENT' AND kind='booking' LIMIT 1")).scalar()
+        conn.execute(text("DELETE FROM agg_embarcadores WHERE hash=:h"), {"h": h})
+        conn.execute(text("DELETE FROM agg_files WHERE hash=:h AND kind='booking'"), {"h": h})
+    assert client.get("/api/available-data?client=TEST_CLIENT").json()["embarcadores"] == ["Cliente A", "Cliente B"]
+    assert calls == ["booking"]
+    client.get("/api/available-data?client=TEST_CLIENT")
+    assert calls == ["booking"]
+
+    client.delete("/api/flush?client=TEST_CLIENT")
+    with engine.begin() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM agg_embarcadores WHERE hash=:h"), {"h": h}).scalar() == 0
+
+
+
+def test_blank_embarcador_is_not_listed(client, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: Célula de embarcador vazia não vira "nan"/"None" no normalizador, no catálogo nem no upload"""
+    from backend.app import normalize_workbook, shipper_names
+
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["DATA_BOOKING", "NOME_FANTASIA", "QTDE_CONTAINER", "BOOKING",
+               "SIGLA_PORTO_ORIGEM", "SIGLA_PORTO_DESTINO", "DESC_STATUS"])
+    ws.append(["2024-11-05", "Cliente A", 8, "BKG125", "SANTOS", "BUENOS AIRES", "Ativo"])
+    ws.append(["2024-11-06", None, 3, "BKG126", "SANTOS", "BUENOS AIRES", "Ativo"])
+    ws.append(["2024-11-07", "   ", 2, "BKG127", "ITAJAI", "MONTEVIDEO", "Ativo"])
+    buf = io.BytesIO()
+    wb.save(buf)
+    booking = buf.getvalue()
+
+    assert normalize_workbook(booking, "booking")["emb"].isna().sum() == 1
+    mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    files = {"booking": ("booking.xlsx", booking, mime),
+             "multimodal": ("multi.xlsx", sample_multimodal_excel, mime),
+             "transportes": ("transp.xlsx", sample_transportes_excel, mime)}
+    upload = client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"}).json()
+    assert upload["embarcadores"] == ["Cliente A"]
+    assert client.get("/api/available-data?client=TEST_CLIENT").json()["embarcadores"] == ["Cliente A"]
+    # Parquets antigos guardaram a célula vazia como texto
+    assert shipper_names(pd.Series(["nan", "None", " X ", ""])).dropna().tolist() == ["X"]
+
+
+def test_available_data_uses_period_index_with_etag(client, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: Períodos vêm de upload_periods (bits por tipo); ETag igual responde 304 numa consulta só"""
+    from sqlalchemy import event
+
+    files = {
+        "booking": ("booking.xlsx", sample_booking_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "multimodal": ("multi.xlsx", sample_multimodal_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "transportes": ("transp.xlsx", sample_transportes_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }
+    client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"})
+    with engine.begin() as conn:
+        flags = conn.execute(text("SELECT ym, kinds FROM upload_periods WHERE client='TEST_CLIENT' ORDER BY ym")).fetchall()
+        # mês só com booking não conta como disponível
+        conn.execute(text("INSERT INTO upload_periods (client, ym, kinds, updated_at) VALUES ('TEST_CLIENT', '2024-12', 1, 'x')"))
+    assert flags == [("2024-10", 7), ("2024-11", 7)]
+
+    first = client.get("/api/available-data?client=TEST_CLIENT")
+    assert first.json()["periods"] == ["2024-11", "2024-10"]
+    etag = first.headers["etag"]
+
+    statements = []
+    def count(conn, cursor, statement, params, context, executemany):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        again = client.get("/api/available-data?client=TEST_CLIENT", headers={"If-None-Match": etag})
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    assert again.status_code == 304
+    assert len(statements) == 1 and "upload_periods" in statements[0]
+    other = client.get("/api/available-data?client=TEST_CLIENT&ym=2024-11", headers={"If-None-Match": etag})
+    assert other.status_code == 200
+
+    client.delete("/api/flush?client=TEST_CLIENT&ym=2024-11")
+    after = client.get("/api/available-data?client=TEST_CLIENT", headers={"If-None-Match": etag})
+    assert after.status_code == 200
+    assert after.json()["periods"] == ["2024-10"]
+    assert after.headers["etag"] != etag
+
+    # uploads gravados sem o índice (instância antiga no deploy) entram no próximo init do schema
+    from backend.app import migrate_upload_periods
+    with engine.begin() as conn:
+        for kind in ("booking", "multi", "transp"):
+            conn.execute(text("INSERT INTO uploads (client, ym, kind, data, hash, created_at) "
+                              "VALUES ('TEST_CLIENT', '2024-09', :k, x'00', :h, '2099-01-01')"), {"k": kind, "h": "old-" + kind})
+        migrate_upload_periods(conn)
+        migrate_upload_periods(conn)
+    synced = client.get("/api/available-data?client=TEST_CLIENT", headers={"If-None-Match": after.headers["etag"]})
+    assert synced.json()["periods"] == ["2024-10", "2024-09"]
+    assert client.get("/api/available-data?client=TEST_CLIENT",
+                      headers={"If-None-Match": synced.headers["etag"]}).status_code == 304
+
+
 # =============================================================================
 # TESTES - SUMMARY
 # =============================================================================
@@ -268,6 +557,299 @@ def test_summary_with_data(client, sample_booking_excel, sample_multimodal_excel
     assert "kpis" in data
     assert "debug" in data
 
+
+def test_summary_multi_period_reads_each_file_once(client, monkeypatch, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: Vários meses do mesmo arquivo são lidos e filtrados numa única passada"""
+    import backend.app as backend_app
+
+    files = {
+        "booking": ("booking.xlsx", sample_booking_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "multimodal": ("multi.xlsx", sample_multimodal_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "transportes": ("transp.xlsx", sample_transportes_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }
+    client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"})
+    client.get("/api/clear-cache")
+
+    calls = []
+    original = backend_app._read_norm
+    monkeypatch.setattr(backend_app, "_read_norm", lambda ref, kind: calls.append(kind) or original(ref, kind))
+    monkeypatch.setattr(backend_app, "REPORT_AGGREGATES", False)  # caminho do Parquet
+
+    response = client.get("/api/summary?client=TEST_CLIENT&ym=2024-10,2024-11&embarcador=Cliente A,Cliente B")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["kpis"]["total_ops"] == 23
+    assert data["debug"]["booking_len"] == 3
+    assert sorted(calls) == ["booking", "multi", "transp"]
+
+def test_summary_result_cache_and_precise_invalidation(client, monkeypatch, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: Resumo repetido vem do cache de resultados; flush só descarta o que dependia dos arquivos removidos"""
+    import backend.app as backend_app
+
+    files = {
+        "booking": ("booking.xlsx", sample_booking_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "multimodal": ("multi.xlsx", sample_multimodal_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "transportes": ("transp.xlsx", sample_transportes_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }
+    client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"})
+    client.get("/api/clear-cache")
+
+    calls = []
+    original = backend_app._read_norm
+    monkeypatch.setattr(backend_app, "_read_norm", lambda ref, kind: calls.append(kind) or original(ref, kind))
+    monkeypatch.setattr(backend_app, "REPORT_AGGREGATES", False)  # caminho do Parquet
+
+    first = client.get("/api/summary?client=TEST_CLIENT&ym=2024-10&embarcador=Cliente A,Cliente B").json()
+    # mesma seleção em outra ordem: nenhuma leitura nova
+    again = client.get("/api/summary?client=TEST_CLIENT&ym=2024-10&embarcador=Cliente B, Cliente A").json()
+    assert again == first
+    assert len(calls) == 3
+    assert len(backend_app.result_cache) == 1
+
+    # 2024-11 sai, mas os arquivos ainda servem 2024-10: o resultado continua em cache
+    client.delete("/api/flush?client=TEST_CLIENT&ym=2024-11")
+    assert len(backend_app.result_cache) == 1
+
+    client.delete("/api/flush?client=TEST_CLIENT")
+    assert len(backend_app.result_cache) == 0
+
+
+def test_summary_fetches_all_files_in_one_query(client, monkeypatch, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: Resumo de vários meses resolve e busca os arquivos em lote; o que está em cache não volta ao banco"""
+    from sqlalchemy import event
+    import backend.app as backend_app
+
+    files = {
+        "booking": ("booking.xlsx", sample_booking_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "multimodal": ("multi.xlsx", sample_multimodal_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "transportes": ("transp.xlsx", sample_transportes_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }
+    client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"})
+    client.get("/api/clear-cache")
+    monkeypatch.setattr(backend_app, "REPORT_AGGREGATES", False)  # caminho do Parquet
+
+    selects = []
+    def count(conn, cursor, statement, params, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and "upload" in statement:
+            selects.append(statement)
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        url = "/api/summary?client=TEST_CLIENT&ym=2024-10,2024-11&embarcador=Cliente A,Cliente B"
+        assert client.get(url).status_code == 200
+        assert len(selects) == 2          # 1 p/ resolver os 6 (ym, kind) + 1 p/ os 3 Parquets
+
+        selects.clear()
+        backend_app.result_cache.clear()  # frames continuam no cache
+        assert client.get(url).status_code == 200
+        assert len(selects) == 1
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+def test_summary_served_from_monthly_aggregates(client, monkeypatch, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: Upload grava agregados mensais; o resumo sai deles sem ler o Parquet e igual ao caminho antigo"""
+    import backend.app as backend_app
+
+    files = {
+        "booking": ("booking.xlsx", sample_booking_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "multimodal": ("multi.xlsx", sample_multimodal_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "transportes": ("transp.xlsx", sample_transportes_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }
+    client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"})
+    with engine.begin() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM agg_files")).scalar() == 3
+        assert conn.execute(text("SELECT SUM(qtde) FROM agg_booking")).scalar() == 23
+    client.get("/api/clear-cache")
+
+    calls = []
+    original = backend_app._read_norm
+    monkeypatch.setattr(backend_app, "_read_norm", lambda ref, kind: calls.append(kind) or original(ref, kind))
+    url = "/api/summary?client=TEST_CLIENT&ym=2024-10,2024-11&embarcador=Cliente A,Cliente B"
+    hits = client.get("/api/health").json()["aggregates"]["hits"]
+    from_aggregates = client.get(url).json()
+    assert calls == []
+    assert client.get("/api/health").json()["aggregates"]["hits"] == hits + 1
+
+    client.get("/api/clear-cache")
+    monkeypatch.setattr(backend_app, "REPORT_AGGREGATES", False)
+    from_parquet = client.get(url).json()
+    assert sorted(calls) == ["booking", "multi", "transp"]
+    assert from_aggregates == from_parquet
+    assert from_aggregates["debug"]["booking_len"] == 3
+
+    # flush: os agregados saem junto com os arquivos
+    client.delete("/api/flush?client=TEST_CLIENT")
+    with engine.begin() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM agg_files")).scalar() == 0
+        assert conn.execute(text("SELECT COUNT(*) FROM agg_booking")).scalar() == 0
+
+def test_client_match_mask_matches_client_match():
+    """Teste: Filtro vetorizado de embarcador equivale a client_match linha a linha"""
+    from backend.app import client_match, client_match_mask
+
+    values = pd.Series(["ACME SA", "Acme Ltda - Filial Sul", "Beta Corp", "ÉPSILON S/A",
+                        "nan", "", "Gamma Industria", "ACME SA", "epsilon"], index=range(10, 19))
+    for selected in (["acme"], ["Epsilon", "beta"], ["S.A."], ["Gamma Indústria Ltda"]):
+        expected = pd.Series(False, index=values.index)
+        for emb in selected:
+            expected |= values.apply(lambda v: client_match(emb, v))
+        pd.testing.assert_series_equal(client_match_mask(values, selected), expected, check_names=False)
+
+
+def test_extract_period_ym_series_matches_scalar():
+    """Teste: Extração vetorizada de período equivale a extract_period_ym linha a linha"""
+    from backend.app import extract_period_ym, extract_period_ym_series
+
+    mixed = pd.Series([
+        datetime(2024, 10, 5, 8, 30), pd.Timestamp("2024-11-30"), "05/10/2024 08:30:00",
+        "2024-10-05 08:30:00", "31/12/2024", "2024-09-01", "10/2024", "2024-10", "30/02/2024",
+        "05/10/2024 08:30:60", 45580, 45580.75, float("nan"), None, "lixo", "", True,
+    ], dtype=object)
+    columns = [
+        mixed,
+        pd.Series(pd.to_datetime(["2024-10-05", None, "2025-01-31"])),
+        pd.Series([45580.0, float("nan"), 45650.5]),
+    ]
+    for values in columns:
+        expected = [extract_period_ym(v) for v in values]
+        assert list(extract_period_ym_series(values)) == expected
+
+
+def test_filter_booking_norm_matches_legacy_loop():
+    """Teste: Agregação vetorizada de booking equivale ao loop groupby/sort_values"""
+    from backend.app import filter_booking_norm
+    from backend.benchmarks import legacy_filter_booking_norm, synthetic_booking_norm
+
+    norm = synthetic_booking_norm(3000)
+    key = ["ym", "booking_id"]
+    for args in ((None, None), (["2024-08", "2024-11"], None), (["2024-09"], ["ACME"])):
+        expected = legacy_filter_booking_norm(norm, *args).sort_values(key).reset_index(drop=True)
+        result = filter_booking_norm(norm, *args).sort_values(key).reset_index(drop=True)
+        pd.testing.assert_frame_equal(result, expected)
+
+    # empate de qtde: vale a primeira linha da planilha
+    tie = pd.DataFrame({
+        "__ym": ["2024-10"] * 3, "ativo": [True] * 3, "emb": ["ACME"] * 3,
+        "booking_id": ["B1"] * 3, "porto_origem": ["SANTOS", "ITAJAI", "SUAPE"],
+        "porto_destino": ["MANAUS", "PECEM", "SUAPE"], "qtde": [1, 4, 4],
+    })
+    row = filter_booking_norm(tie).iloc[0]
+    assert (row["porto_origem"], row["porto_destino"], row["qtde"]) == ("ITAJAI", "PECEM", 9)
+
+
+def test_compute_kpis_vectorized_breakdowns():
+    """Teste: KPIs vetorizados batem com o loop antigo (inclusive empates) e trazem os recortes usados no e-mail"""
+    from backend.app import compute_kpis, generate_variacao_table, generate_tendencias_movimentacao_html
+
+    booking = pd.DataFrame({
+        "ym": ["2024-10", "2024-10", "2024-11", "2024-11", "2024-11"],
+        "booking_id": ["B1", "B2", "B3", "B4", "B5"],
+        "porto_origem": ["SUAPE", "SANTOS", "SANTOS", "ITAJAI", "SUAPE"],
+        "porto_destino": ["X"] * 5,
+        "qtde": [5, 4, 3, 2, 2],
+        "embarcador": ["A"] * 5,
+    })
+    multi = pd.DataFrame({"motivo_reagenda": ["Janela", "Chuva"], "porto_op": ["SANTOS", "SUAPE"], "flag": [1, 1]})
+    transp = pd.DataFrame({"tipo_norm": ["coleta", "entrega", "coleta"], "porto_origem": ["SANTOS", "SUAPE", "SANTOS"],
+                           "justificativa_atraso": ["Chuva", "Doc", "Doc"]})
+
+    kpis = compute_kpis(booking, multi, transp)
+    # SUAPE e SANTOS empatam em 7: vale o primeiro a aparecer, como no loop com dict
+    assert (kpis["total_ops"], kpis["porto_top"], kpis["porto_low"]) == (16, "SUAPE", "ITAJAI")
+    assert (kpis["atrasos_coleta"], kpis["atrasos_entrega"], kpis["reagendamentos"]) == (2, 1, 2)
+    assert kpis["por_porto"] == {"SUAPE": 7, "SANTOS": 7, "ITAJAI": 2}
+    assert kpis["por_periodo"] == {"2024-10": 9, "2024-11": 7}
+    assert kpis["porto_periodo"]["SANTOS"] == {"2024-10": 4, "2024-11": 3}
+
+    # E-mail com os recortes prontos = e-mail recalculando do booking
+    yms = ["2024-11", "2024-10"]
+    assert generate_variacao_table(booking, yms, kpis) == generate_variacao_table(booking, yms)
+    assert generate_tendencias_movimentacao_html(booking, yms, kpis) == generate_tendencias_movimentacao_html(booking, yms)
+
+    empty = compute_kpis(booking.iloc[:0], multi.iloc[:0], transp.iloc[:0])
+    assert (empty["total_ops"], empty["porto_top"], empty["por_porto"]) == (0, None, {})
+
+def test_report_cube_built_once_per_frame(monkeypatch):
+    """Teste: KPIs, gráficos, tabelas e HTML do e-mail agregam cada frame uma única vez (cubo compartilhado)"""
+    import gc
+    import backend.app as app_module
+
+    builds = []
+    for kind, (keys, agg) in list(app_module.CUBE_SPECS.items()):
+        monkeypatch.setitem(app_module.CUBE_SPECS, kind, (keys, lambda g, kind=kind, agg=agg: builds.append(kind) or agg(g)))
+
+    booking = pd.DataFrame({"ym": ["2024-09", "2024-10", "2024-10"], "booking_id": ["B1", "B2", "B3"],
+                            "porto_origem": ["SANTOS", "SANTOS", "SUAPE"], "porto_destino": ["X", "Y", "X"],
+                            "qtde": [3, 2, 4], "embarcador": ["A"] * 3})
+    transp = pd.DataFrame({"tipo_norm": ["coleta", "entrega", "coleta"], "porto_origem": ["SANTOS", "SUAPE", "SANTOS"],
+                           "justificativa_atraso": ["Chuva", "Doc", "Chuva"]})
+    multi = pd.DataFrame({"motivo_reagenda": ["Janela", "Janela"], "porto_op": ["SANTOS", "SUAPE"], "flag": [1, 1]})
+    yms = ["2024-09", "2024-10"]
+
+    kpis = app_module.compute_kpis(booking, multi, transp)
+    jobs = app_module.email_chart_jobs(yms, booking, transp, multi, backend="html")
+    prompt = app_module.build_ai_prompt(kpis, yms, booking, transp, multi, ["A"])
+    app_module.generate_variacao_table(booking, yms, kpis)
+    app_module.generate_tendencias_movimentacao_html(booking, yms, kpis)
+    html = app_module.generate_detalhamento_por_porto_html(app_module.cube_atrasos(transp, "coleta"), "atrasos")
+    assert sorted(builds) == ["atrasos", "booking", "reagendamentos"]
+
+    assert jobs["movimentacao"][1].loc["SANTOS"].tolist() == [3, 2]
+    assert jobs["origem_dest"][1].loc["SUAPE", "X"] == 4
+    assert "Chuva: 2 ocorrências" in prompt
+    assert "<b>SANTOS</b> (2 atrasos)" in html
+
+    # O cubo vive enquanto o frame vive
+    key = ("booking", id(booking))
+    assert key in app_module._cubes
+    del booking, jobs
+    gc.collect()
+    assert key not in app_module._cubes
+
+def test_streaming_parse_projects_columns_like_read_excel():
+    """Teste: Leitura em streaming só carrega as colunas usadas e normaliza igual ao read_excel"""
+    from backend.app import NORMALIZERS, ROW_HASH_COL, normalize_workbook, parse_workbook
+
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["Obs", "Embarcador", "Situação programação", "Situação prazo programação", "Tipo de programação",
+               "Previsão início atendimento (BRA)", "Justificativa de atraso de programação", "Porto de origem", "Obs"])
+    rows = [
+        ["a", "Cliente A", "Programado", "Atrasado", "Coleta", "05/10/2024 08:00:00", "Falta doc", "SANTOS", 1],
+        ["b", "Cliente A", "Programado", "Atrasado", "Coleta", "05/10/2024 08:00:00", "Falta doc", "SANTOS", 1],
+        ["a", "Cliente A", "Programado", "Atrasado", "Coleta", "05/10/2024 08:00:00", "Falta doc", "SANTOS", 1],
+        [None, "Cliente B", "Cancelado", "Atrasado", "Entrega", "06/10/2024", "-", "ITAJAI", "NA"],
+        [],
+        ["c", "Cliente B", "Programado", "atrasado ", "Entrega", datetime(2024, 11, 2), None, "SUAPE", 2.5],
+    ]
+    for row in rows:
+        ws.append(row)
+    buf = io.BytesIO()
+    wb.save(buf)
+    data = buf.getvalue()
+
+    sheet = parse_workbook(data, "transp")["Sheet"]
+    assert "Obs" not in sheet.columns and "Obs.1" not in sheet.columns
+    assert ROW_HASH_COL in sheet.columns and len(sheet) == len(rows)
+
+    full = pd.read_excel(io.BytesIO(data))
+    full.columns = [str(c).strip() for c in full.columns]
+    expected = NORMALIZERS["transp"](full)
+    result = normalize_workbook(data, "transp")
+    pd.testing.assert_frame_equal(result, expected)
+    # a linha repetida conta uma vez; a que difere só na coluna não lida continua contando
+    assert len(result) == 3
+
+    # mesma linha em outra aba com as colunas em outra ordem: continua sendo duplicada
+    header = [ws.cell(row=1, column=c).value for c in range(1, 10)]
+    order = [0] + list(reversed(range(1, 8))) + [8]  # "Obs" repetido fica onde está (Obs, Obs.1)
+    other = wb.create_sheet("Outra")
+    other.append([header[i] for i in order])
+    other.append([rows[0][i] for i in order])
+    buf = io.BytesIO()
+    wb.save(buf)
+    assert len(normalize_workbook(buf.getvalue(), "transp")) == 3
+
+
 def test_concat_safely_handles_none():
     import pandas as pd
     from backend.app import _concat_safely
@@ -331,6 +913,422 @@ def test_clear_cache(client):
     assert "message" in data
 
 
+# =============================================================================
+# TESTES - GRÁFICOS
+# =============================================================================
+
+def test_chart_pool_matches_serial_render(monkeypatch):
+    """Teste: Gráficos renderizados no pool de processos são idênticos aos renderizados em série"""
+    import backend.app as app_module
+
+    booking = pd.DataFrame({
+        "ym": ["2024-09", "2024-10", "2024-10"],
+        "porto_origem": ["SANTOS", "SANTOS", "ITAJAI"],
+        "porto_destino": ["MANAUS", "SUAPE", "MANAUS"],
+        "qtde": [3, 5, 2],
+    })
+    transp = pd.DataFrame({
+        "tipo_norm": ["coleta", "coleta", "entrega"],
+        "justificativa_atraso": ["CHUVA", "TRANSITO", "CHUVA"],
+        "porto_origem": ["SANTOS", "ITAJAI", "SANTOS"],
+    })
+    multi = pd.DataFrame(columns=["motivo_reagenda", "porto_op", "flag"])
+    jobs = app_module.email_chart_jobs(["2024-09", "2024-10"], booking, transp, multi)
+
+    monkeypatch.setattr(app_module, "CHART_WORKERS", 1)
+    serial = app_module.render_charts(jobs)
+    monkeypatch.setattr(app_module, "CHART_WORKERS", 2)
+    pooled = app_module.render_charts(jobs)
+    app_module._reset_chart_pool()
+
+    assert pooled == serial
+    assert serial["reagendamentos"] == ""
+    assert serial["movimentacao"] == app_module.chart_movimentacao_por_porto(booking, ["2024-09", "2024-10"])
+
+
+def test_chart_cache_skips_render_for_unchanged_pivot(monkeypatch, tmp_path):
+    """Teste: PNG em cache (memória e disco) evita renderizar de novo; pivô alterado renderiza"""
+    import backend.app as app_module
+
+    monkeypatch.setattr(app_module, "CHART_WORKERS", 1)
+    monkeypatch.setattr(app_module, "CHART_CACHE_DIR", str(tmp_path))
+    app_module.chart_cache.clear()
+    calls = []
+
+    def render_fake(pivot, tipo):
+        calls.append(tipo)
+        return f"PNG-{tipo}-{int(pivot.values.sum())}".encode()
+
+    pivot = pd.DataFrame({"SANTOS": [2, 1]}, index=["CHUVA", "TRANSITO"])
+    jobs = {"atraso": (render_fake, pivot, ("coleta",))}
+
+    first = app_module.render_charts(jobs)
+    assert app_module.render_charts(jobs) == first
+    assert len(calls) == 1
+
+    app_module.chart_cache.clear()  # só o disco continua com o PNG
+    assert app_module.render_charts(jobs) == first
+    assert len(calls) == 1
+    assert len(list(tmp_path.glob("*.png"))) == 1
+
+    changed = {"atraso": (render_fake, pivot + 1, ("coleta",))}
+    assert app_module.render_charts(changed) != first
+    assert len(calls) == 2
+    app_module.chart_cache.clear()
+
+
+def test_html_chart_backend_renders_without_images():
+    """Teste: Backend HTML gera as barras/matriz como tabelas, sem PNG"""
+    import backend.app as app_module
+
+    booking = pd.DataFrame({
+        "ym": ["2024-09", "2024-10", "2024-10"],
+        "porto_origem": ["SANTOS", "SANTOS", "ITAJAI"],
+        "porto_destino": ["MANAUS", "SUAPE", "MANAUS"],
+        "qtde": [3, 5, 2],
+    })
+    transp = pd.DataFrame({
+        "tipo_norm": ["coleta", "coleta", "coleta"],
+        "justificativa_atraso": ["CHUVA", "CHUVA", "TRANSITO"],
+        "porto_origem": ["SANTOS", "ITAJAI", "SANTOS"],
+    })
+    charts = app_module.render_charts(
+        app_module.email_chart_jobs(["2024-09", "2024-10"], booking, transp, pd.DataFrame(), backend="html")
+    )
+
+    assert charts["atraso_entrega"] == "" and charts["reagendamentos"] == ""
+    for name in ("movimentacao", "origem_dest", "atraso_coleta"):
+        assert charts[name].startswith("<") and "<table" in charts[name]
+    assert "OUT/24" in charts["movimentacao"] and "SET/24" in charts["movimentacao"]
+    # maior motivo primeiro (o pivô do matplotlib vem em ordem crescente)
+    assert charts["atraso_coleta"].index("CHUVA") < charts["atraso_coleta"].index("TRANSITO")
+    assert "Total: 3 ocorrências" in charts["atraso_coleta"]
+    assert app_module.chart_origem_destino(booking, backend="html") == charts["origem_dest"]
+    assert app_module.resolve_chart_backend("svg-inexistente") == "matplotlib"
+
+
+# =============================================================================
+# TESTES - BOOT
+# =============================================================================
+
+def test_import_does_not_load_lazy_dependencies():
+    """Teste: Importar o app não carrega matplotlib/Gemini/openpyxl (ficam p/ o primeiro uso)"""
+    from backend.benchmarks import import_profile
+
+    seconds, loaded, _ = import_profile()
+    assert loaded == []
+    assert seconds > 0
+
+
+def test_requests_wait_for_deferred_schema(client, monkeypatch):
+    """Teste: Sem DDL no import, a primeira requisição ao banco garante o schema; health não espera"""
+    import backend.app as app_module
+
+    calls = []
+    monkeypatch.setattr(app_module, "init_schema", lambda: calls.append("ddl"))
+    app_module._schema_ready.clear()
+    try:
+        assert client.get("/api/health").status_code == 200
+        assert calls == []
+        assert client.get("/api/available-data?client=TEST_CLIENT").status_code == 200
+        assert calls == ["ddl"]
+        client.get("/api/available-data?client=TEST_CLIENT")
+        assert calls == ["ddl"]
+    finally:
+        app_module._schema_ready.set()
+
+
+def test_report_jobs_resume_when_schema_is_created_late(client, monkeypatch):
+    """Teste: Banco fora no boot: jobs do processo anterior são retomados quando uma requisição cria o schema"""
+    import backend.app as app_module
+
+    attempts, resumed = [], []
+    def flaky_init():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("banco fora")
+    monkeypatch.setattr(app_module, "init_schema", flaky_init)
+    monkeypatch.setattr(app_module, "resume_report_jobs", lambda: resumed.append(1) or True)
+    monkeypatch.setattr(app_module, "_resume_jobs_pending", True)
+    app_module._schema_ready.clear()
+    try:
+        app_module._ensure_schema_background()  # boot: DDL falha
+        assert resumed == []
+        assert client.get("/api/available-data?client=TEST_CLIENT").status_code == 200
+        assert resumed == [1]
+        client.get("/api/available-data?client=TEST_CLIENT")
+        assert len(attempts) == 2 and resumed == [1]
+    finally:
+        app_module._schema_ready.set()
+
+
+def test_concurrent_summaries_share_caches_safely(client, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: Resumos simultâneos (pool de I/O) com o cache sendo invalidado no meio respondem 200 e iguais"""
+    import asyncio
+    import threading
+    import httpx
+    import backend.app as app_module
+
+    files = {
+        "booking": ("booking.xlsx", sample_booking_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "multimodal": ("multi.xlsx", sample_multimodal_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "transportes": ("transp.xlsx", sample_transportes_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }
+    client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"})
+    urls = ["/api/summary?client=TEST_CLIENT&ym=2024-10,2024-11&embarcador=Cliente A",
+            "/api/summary?client=TEST_CLIENT&ym=2024-10&embarcador=Cliente B",
+            "/api/summary?client=TEST_CLIENT&ym=2024-11&embarcador=Cliente A,Cliente B"]
+    expected = {url: client.get(url).json() for url in urls}
+
+    stop = threading.Event()
+    def invalidate():  # outra thread derrubando o cache enquanto o pool de I/O lê e grava
+        while not stop.is_set():
+            app_module.cache.drop_where(lambda key: True)
+            app_module.result_cache.drop_where(lambda key: True)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            responses = []
+            for _ in range(3):
+                responses += await asyncio.gather(*(ac.get(url) for url in urls * 3))
+            return responses
+
+    invalidator = threading.Thread(target=invalidate)
+    invalidator.start()
+    try:
+        responses = asyncio.run(scenario())
+    finally:
+        stop.set()
+        invalidator.join()
+    assert [r.status_code for r in responses] == [200] * len(responses)
+    assert [r.json() for r in responses] == [expected[url] for _ in range(3) for url in urls * 3]
+
+
+def test_heavy_routes_do_not_block_event_loop(monkeypatch):
+    """Teste: Health responde enquanto um relatório pesado roda, e mostra a fila/concorrência"""
+    import asyncio
+    import time
+    import httpx
+    import backend.app as app_module
+
+    def slow_load(client, yms, embarcadores):
+        time.sleep(0.6)  # pandas/SQL síncronos
+        empty = pd.DataFrame(columns=["qtde"])
+        return empty, empty, empty, {"total_ops": 0}
+
+    monkeypatch.setattr(app_module, "load_period_results", slow_load)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            summary = asyncio.create_task(ac.get("/api/summary?client=X&ym=2024-10&embarcador=A"))
+            await asyncio.sleep(0.1)
+            t0 = time.perf_counter()
+            health = await ac.get("/api/health")
+            health_elapsed = time.perf_counter() - t0
+            return health, health_elapsed, summary.done(), await summary
+
+    health, health_elapsed, summary_done_early, summary = asyncio.run(scenario())
+    assert summary.status_code == 200
+    assert health.status_code == 200
+    assert health_elapsed < 0.3 and not summary_done_early
+    report = health.json()["workers"]["report"]
+    assert report["active"] == 1 and report["queued"] == 0
+    assert {"io", "cpu", "upload"} <= set(health.json()["workers"])
+
+
+def test_identical_concurrent_summaries_share_one_computation(monkeypatch):
+    """Teste: Pedidos iguais ao mesmo tempo (filtros em outra ordem) rodam o pipeline uma vez só"""
+    import asyncio
+    import time
+    import httpx
+    import backend.app as app_module
+
+    calls = []
+
+    def slow_load(client, yms, embarcadores):
+        calls.append((client, tuple(yms), tuple(embarcadores)))
+        time.sleep(0.3)
+        frame = pd.DataFrame({"qtde": [7]})
+        return frame, frame, frame, {"total_ops": 7}
+
+    monkeypatch.setattr(app_module, "load_period_results", slow_load)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            same = [ac.get("/api/summary?client=X&ym=2024-10,2024-09&embarcador=A,B"),
+                    ac.get("/api/summary?client=X&ym=2024-09,2024-10&embarcador=B, A"),
+                    ac.get("/api/summary?client=X&ym=2024-10,2024-09&embarcador=A,B")]
+            other = ac.get("/api/summary?client=X&ym=2024-10&embarcador=A")
+            return await asyncio.gather(*same, other)
+
+    before = app_module.report_flight.stats()
+    responses = asyncio.run(scenario())
+    assert [r.status_code for r in responses] == [200] * 4
+    assert all(r.json() == responses[0].json() for r in responses[:3])
+    assert len(calls) == 2
+    after = app_module.report_flight.stats()
+    assert after["shared"] - before["shared"] == 2
+    assert after["in_flight"] == 0
+
+
+# =============================================================================
+# TESTES - FILA DE RELATÓRIOS
+# =============================================================================
+
+def test_report_job_queue_progress_coalescing_and_result(client, monkeypatch, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: Job de e-mail mostra a etapa, agrupa pedidos iguais e entrega o resultado no fim"""
+    import threading
+    import time
+    import backend.app as app_module
+
+    files = {
+        "booking": ("booking.xlsx", sample_booking_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "multimodal": ("multi.xlsx", sample_multimodal_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "transportes": ("transp.xlsx", sample_transportes_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }
+    client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"})
+
+    release = threading.Event()
+    original_ai = app_module.generate_ai_email_analysis
+
+    def slow_ai(*args):
+        release.wait(5)
+        return original_ai(*args)
+
+    monkeypatch.setattr(app_module, "generate_ai_email_analysis", slow_ai)
+    payload = {"type": "email", "client": "TEST_CLIENT", "yms": ["2024-10"], "embarcadores": ["Cliente A"]}
+
+    first = client.post("/api/report-jobs", json=payload)
+    assert first.status_code == 202
+    job_id = first.json()["job_id"]
+    # Mesmo pedido (filtros em outra ordem/espaços) enquanto o primeiro roda: mesmo job
+    again = client.post("/api/report-jobs", json={**payload, "embarcadores": [" Cliente A "]}).json()
+    assert again["job_id"] == job_id and again["coalesced"] is True
+
+    for _ in range(50):
+        status = client.get(f"/api/report-jobs/{job_id}").json()
+        if status["stage"] == "ai":
+            break
+        time.sleep(0.05)
+    assert status["job_status"] == "running" and status["stage"] == "ai"
+    assert 0 < status["progress"] < 100
+    assert client.get(f"/api/report-jobs/{job_id}/result").status_code == 409
+
+    release.set()
+    for _ in range(100):
+        status = client.get(f"/api/report-jobs/{job_id}").json()
+        if status["job_status"] != "running":
+            break
+        time.sleep(0.05)
+    assert status["job_status"] == "done" and status["progress"] == 100
+    result = client.get(f"/api/report-jobs/{job_id}/result").json()
+    assert "email_html" in result and "Cliente A" in result["email"]
+
+    # Terminado, um novo pedido gera outro job; .eml e período sem dados viram erro no job
+    eml = client.post("/api/report-jobs", json={**payload, "type": "eml"}).json()
+    missing = client.post("/api/report-jobs", json={**payload, "yms": ["2030-01"]}).json()
+    for job in (eml, missing):
+        assert job["coalesced"] is False
+        for _ in range(100):
+            if client.get(f"/api/report-jobs/{job['job_id']}").json()["job_status"] in ("done", "error"):
+                break
+            time.sleep(0.05)
+    assert client.get(f"/api/report-jobs/{eml['job_id']}/result").json()["filename"].endswith(".eml")
+    failed = client.get(f"/api/report-jobs/{missing['job_id']}").json()
+    assert failed["job_status"] == "error" and "2030-01" in failed["error"]
+    assert client.get("/api/report-jobs/inexistente").status_code == 404
+    assert client.post("/api/report-jobs", json={**payload, "type": "pdf"}).status_code == 400
+
+
+# =============================================================================
+# TESTES - IA (GEMINI SIMULADO)
+# =============================================================================
+
+def test_ai_timeout_falls_back_then_completes_in_background(client, monkeypatch, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: IA lenta não segura o e-mail (texto padrão + polling) e a resposta fica em cache pelo prompt"""
+    import threading
+    import time
+    import backend.app as app_module
+
+    release = threading.Event()
+    calls = []
+    analise = "Análise da IA: volume estável no período, com concentração das operações no porto principal. " * 2
+
+    class FakeModel:
+        def generate_content(self, prompt):
+            calls.append(prompt)
+            release.wait(5)
+            text = f"**SEÇÃO 1 - ANÁLISE GERAL**\n{analise}\n**SEÇÃO 2 - PONTOS CRÍTICOS**\n• ponto\n" \
+                   "**SEÇÃO 3 - RECOMENDAÇÕES**\n• ação\n**SEÇÃO 4 - CONCLUSÃO**\nfim"
+            return type("Resp", (), {"text": text})()
+
+    monkeypatch.setattr(app_module, "get_gemini_model", lambda: FakeModel())
+    monkeypatch.setattr(app_module, "AI_TIMEOUT_S", 0.2)
+    app_module.ai_cache.clear()
+
+    files = {
+        "booking": ("booking.xlsx", sample_booking_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "multimodal": ("multi.xlsx", sample_multimodal_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "transportes": ("transp.xlsx", sample_transportes_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }
+    client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"})
+    payload = {"client": "TEST_CLIENT", "yms": ["2024-10"], "embarcadores": ["Cliente A"]}
+
+    # Prazo estoura: sai o texto padrão
+    response = client.post("/api/generate-email", json=payload)
+    assert response.status_code == 200
+    assert "Análise da IA" not in response.json()["email"]
+
+    # defer_ai reaproveita a mesma chamada em andamento e responde na hora
+    data = client.post("/api/generate-email", json={**payload, "defer_ai": True}).json()
+    assert data["ai_status"] == "pending"
+    assert client.get(f"/api/generate-email/ai/{data['ai_job']}").json()["ai_status"] == "pending"
+
+    release.set()
+    for _ in range(50):
+        polled = client.get(f"/api/generate-email/ai/{data['ai_job']}").json()
+        if polled["ai_status"] != "pending":
+            break
+        time.sleep(0.1)
+    assert polled["ai_status"] == "done"
+    assert "Análise da IA" in polled["email"]
+
+    # Mesmo prompt: vem do cache, sem nova chamada
+    response = client.post("/api/generate-email", json=payload)
+    assert "Análise da IA" in response.json()["email"]
+    assert len(calls) == 1
+    assert client.get("/api/generate-email/ai/inexistente").status_code == 404
+    app_module.ai_cache.clear()
+
+
+
+def test_deferred_email_with_failed_ai_returns_fallback(client, monkeypatch, sample_booking_excel, sample_multimodal_excel, sample_transportes_excel):
+    """Teste: IA que já falhou antes da resposta sai como fallback, sem job de IA p/ consultar"""
+    from concurrent.futures import Future
+    import backend.app as app_module
+
+    failed = Future()
+    failed.set_exception(RuntimeError("quota do Gemini"))
+    monkeypatch.setattr(app_module, "submit_ai_analysis", lambda *args: failed)
+    jobs_before = len(app_module.ai_jobs)
+
+    files = {
+        "booking": ("booking.xlsx", sample_booking_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "multimodal": ("multi.xlsx", sample_multimodal_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+        "transportes": ("transp.xlsx", sample_transportes_excel, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }
+    client.post("/api/upload", files=files, data={"client": "TEST_CLIENT"})
+    data = client.post("/api/generate-email", json={"client": "TEST_CLIENT", "yms": ["2024-10"],
+                                                    "embarcadores": ["Cliente A"], "defer_ai": True}).json()
+    assert data["ai_status"] == "fallback"
+    assert data["ai_job"] is None
+    assert data["email"]
+    assert len(app_module.ai_jobs) == jobs_before
+
+
 # =============================================================================
 # TESTES - GERAÇÃO DE EMAIL (OPCIONAL - REQUER GEMINI)
 # =============================================================================
@@ -4,10 +4,15 @@ import os
 import base64
 import math
 import hashlib
+import json
+import asyncio
+import uuid
+import weakref
 from datetime import datetime, date
-from typing import List, Optional, Dict, Tuple
-from collections import defaultdict
+from typing import List, Optional, Dict, Tuple, Set, Callable
 from functools import lru_cache
+from contextlib import asynccontextmanager
+import threading
 
 import pandas as pd
 
@@ -30,25 +35,118 @@ def _concat_safely(frames):
 
 import numpy as np
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, text, inspect, event, bindparam
 from sqlalchemy.engine import Engine
 
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
+# matplotlib, google.generativeai e openpyxl são importados no primeiro uso
+# (_plt, get_gemini_model, parse_excel_bytes): o boot fica só com pandas/numpy/FastAPI
 from textwrap import fill as _wrap
 
 from dotenv import load_dotenv
-import google.generativeai as genai
 
-# Cache simples em memória (TTL 30 minutos)
+# Caches em memória limitados por BYTES (e não por nº de itens): LRU ponderado pelo tamanho
 from cachetools import TTLCache
-cache = TTLCache(maxsize=100, ttl=1800)  # 30 minutos
+import sys
+
+def _cache_nbytes(value) -> int:
+    """Peso aproximado de um valor em cache"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (tuple, list)):
+        return sum(_cache_nbytes(v) for v in value) + sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sum(_cache_nbytes(v) for v in value.values()) + sys.getsizeof(value)
+    return sys.getsizeof(value)
+
+class ByteBudgetCache(TTLCache):
+    """
+    TTLCache cujo maxsize é um orçamento em bytes: ao estourar, descarta os menos usados
+    recentemente até caber. Conta hits/misses/evictions p/ o /api/health.
+    Valores maiores que o orçamento inteiro simplesmente não são guardados.
+    Thread-safe: o cachetools não é, e o cache é usado ao mesmo tempo pelo pool de I/O,
+    pelas threads dos jobs de relatório e pelos coletores de gráficos.
+    """
+    def __init__(self, max_bytes: int, ttl: float):
+        super().__init__(maxsize=max_bytes, ttl=ttl, getsizeof=_cache_nbytes)
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    def get(self, key, default=None):
+        # uma consulta só: "key in self" seguido de self[key] pode perder a chave no meio
+        with self._lock:
+            try:
+                value = super().__getitem__(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def __getitem__(self, key):
+        with self._lock:
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            try:
+                super().__setitem__(key, value)
+            except ValueError:
+                self.rejected += 1
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return super().__contains__(key)
+
+    def __len__(self):
+        with self._lock:
+            return super().__len__()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return super().pop(key, default)
+
+    def popitem(self):
+        with self._lock:
+            item = super().popitem()
+            self.evictions += 1
+            return item
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+
+    def drop_where(self, predicate: Callable[[object], bool]) -> int:
+        """Remove as chaves em que predicate(chave) é verdadeiro, numa varredura só sob o lock"""
+        with self._lock:
+            keys = [k for k in list(super().keys()) if predicate(k)]
+            for k in keys:
+                super().pop(k, None)
+            return len(keys)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "items": len(self),
+                "resident_bytes": int(self.currsize),
+                "budget_bytes": int(self.maxsize),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "rejected": self.rejected,
+            }
 
 
 
@@ -57,14 +155,19 @@ cache = TTLCache(maxsize=100, ttl=1800)  # 30 minutos
 # =============================================================================
 load_dotenv()
 
+# Orçamento de memória dos caches, em MB (blobs + Parquet lidos / resultados derivados)
+CACHE_MB = float(os.getenv("CACHE_MB", "96"))
+RESULT_CACHE_MB = float(os.getenv("RESULT_CACHE_MB", "48"))
+cache = ByteBudgetCache(max_bytes=int(CACHE_MB * 1024 * 1024), ttl=1800)  # 30 minutos
+
 from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 import socket
 
 def _prepare_supabase_url(url: str) -> str:
     """
-    Força uso do Session Pooler (6543) e de IPv4 quando possível (adicionando hostaddr=A.B.C.D)
-    e garante sslmode=require para TLS. Mantém SNI e validação usando 'host' enquanto o TCP
-    usa 'hostaddr'.
+    Força uso do Session Pooler (6543) e garante sslmode=require para TLS.
+    O IPv4 (hostaddr=A.B.C.D) é resolvido só na primeira conexão, em _inject_hostaddr:
+    o import não faz DNS. Mantém SNI e validação usando 'host' enquanto o TCP usa 'hostaddr'.
     """
     try:
         u = urlparse(url)
@@ -86,15 +189,6 @@ def _prepare_supabase_url(url: str) -> str:
             q.setdefault("sslmode", "require")
             q.setdefault("connect_timeout", "10")
 
-            # tentar resolver A (IPv4) e inserir hostaddr
-            try:
-                infos = socket.getaddrinfo(u.hostname, port, socket.AF_INET, socket.SOCK_STREAM)
-                if infos:
-                    ipv4 = infos[0][4][0]
-                    q.setdefault("hostaddr", ipv4)
-            except Exception:
-                pass
-
             return urlunparse((u.scheme, netloc, u.path, u.params, urlencode(q), u.fragment))
     except Exception:
         pass
@@ -112,10 +206,19 @@ try:
     _host = _u.hostname
     _port = _u.port
     _has_hostaddr = 'hostaddr' in _q
-    print(f"[DB] Using host={_host} port={_port} sslmode={_q.get('sslmode')} hostaddr={'yes' if _has_hostaddr else 'no'}")
+    _ipv4 = "yes" if _has_hostaddr else "lazy" if _host and "supabase.co" in _host else "no"
+    print(f"[DB] Using host={_host} port={_port} sslmode={_q.get('sslmode')} hostaddr={_ipv4}")
 except Exception:
     pass
 
+@lru_cache(maxsize=8)
+def _resolve_ipv4(host: str, port: int) -> Optional[str]:
+    try:
+        infos = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)
+        return infos[0][4][0] if infos else None
+    except Exception:
+        return None
+
 engine: Engine = create_engine(
     SUPABASE_DB_URL,
     future=True,
@@ -123,11 +226,83 @@ engine: Engine = create_engine(
     pool_size=5,
     max_overflow=10,
 )
-app = FastAPI()
+
+@event.listens_for(engine, "do_connect")
+def _inject_hostaddr(dialect, conn_rec, cargs, cparams):
+    """Resolve o IPv4 do Supabase na primeira conexão (e não no import) e reaproveita nas seguintes"""
+    host = cparams.get("host")
+    if dialect.name == "postgresql" and host and "supabase.co" in host and "hostaddr" not in cparams:
+        ipv4 = _resolve_ipv4(host, int(cparams.get("port") or 5432))
+        if ipv4:
+            cparams["hostaddr"] = ipv4
+
+# Schema: RUN_DB_INIT_AT_IMPORT=true (padrão) mantém o DDL no import; com false o
+# processo sobe sem tocar no banco e o DDL roda em background no lifespan (a
+# primeira requisição que precisar do banco espera por ele). Também dá p/ rodar
+# à parte: python -m backend.app init-db
+RUN_DB_INIT_AT_IMPORT = os.getenv("RUN_DB_INIT_AT_IMPORT", "true").strip().lower() in ("1", "true", "yes")
+_schema_ready = threading.Event()
+_schema_lock = threading.Lock()
+# Marca o forkserver dos pools de processos (e os workers): eles importam este módulo de novo e não rodam DDL
+_POOL_CHILD_ENV = "DIARIO_POOL_CHILD"
+
+# Ligado no lifespan: o servidor retoma os jobs do processo anterior assim que o schema existir
+_resume_jobs_pending = False
+
+def ensure_schema():
+    """
+    Roda init_schema uma única vez por processo (idempotente; threads concorrentes esperam).
+    No servidor, o primeiro ensure_schema bem-sucedido (background ou requisição) retoma os
+    jobs de relatório pendentes; se a retomada falhar, a próxima chamada tenta de novo.
+    """
+    global _resume_jobs_pending
+    if _schema_ready.is_set() and not _resume_jobs_pending:
+        return
+    with _schema_lock:
+        if not _schema_ready.is_set():
+            init_schema()
+            _schema_ready.set()
+        resume, _resume_jobs_pending = _resume_jobs_pending, False
+    if resume and not resume_report_jobs():
+        _resume_jobs_pending = True
+
+def _ensure_schema_background():
+    try:
+        ensure_schema()
+        print("[DB] Schema pronto")
+    except Exception as e:  # a próxima requisição tenta de novo
+        print(f"[DB] WARN: init do schema falhou: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema (se ainda não feito no import) e, em seguida, jobs de relatório deixados pelo processo anterior
+    global _resume_jobs_pending
+    _resume_jobs_pending = True
+    threading.Thread(target=_ensure_schema_background, name="init-schema", daemon=True).start()
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def _wait_for_schema(request, call_next):
+    # /api/health responde já no boot (health check do Fly); o resto espera o DDL (e a retomada dos jobs)
+    if (not _schema_ready.is_set() or _resume_jobs_pending) and request.url.path != "/api/health":
+        from starlette.concurrency import run_in_threadpool
+        try:
+            await run_in_threadpool(ensure_schema)
+        except Exception as e:
+            return JSONResponse({"detail": f"Banco indisponível: {e}"}, status_code=503)
+    return await call_next(request)
 
 @app.get("/api/health")
 def health():
-    return {"ok": True, "cache_size": len(cache)}
+    return {
+        "ok": True,
+        "cache_size": len(cache),
+        "caches": {"blob": cache.stats(), "result": result_cache.stats(), "chart": chart_cache.stats(), "ai": ai_cache.stats()},
+        "workers": work_stats(),
+        "aggregates": aggregate_stats_snapshot(),
+    }
 
 origins_env = os.getenv("FRONTEND_ORIGIN", "http://localhost:5173,http://127.0.0.1:5173,http://localhost:3000,http://127.0.0.1:3000")
 origin_list = [o.strip() for o in origins_env.split(",") if o.strip()]
@@ -166,41 +341,242 @@ else:
 
 # --- Gemini (AI) ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
-gemini_model = None
-try:
-    import google.generativeai as genai  # type: ignore
-    if GEMINI_API_KEY:
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-pro")
+
+@lru_cache(maxsize=1)
+def get_gemini_model():
+    """Carrega o SDK do Gemini só quando a IA é usada pela primeira vez; None -> fallback sem IA"""
+    if not GEMINI_API_KEY:
+        return None
+    try:
+        import google.generativeai as genai  # type: ignore
         genai.configure(api_key=GEMINI_API_KEY)
-        GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-pro")
-        gemini_model = genai.GenerativeModel(GEMINI_MODEL)
+        model = genai.GenerativeModel(GEMINI_MODEL)
         print(f"[AI] Gemini model loaded: {GEMINI_MODEL}")
-except Exception as e:
-    # Mantém gemini_model=None -> o código cai no fallback sem IA
-    print(f"[AI] Gemini not available: {e}")
-    gemini_model = None
+        return model
+    except Exception as e:
+        print(f"[AI] Gemini not available: {e}")
+        return None
 
 # =============================================================================
 # DB SCHEMA
 # =============================================================================
-with engine.begin() as conn:
+# Bit de cada tipo de planilha em upload_periods.kinds; mês completo = todos os bits
+KIND_BITS = {"booking": 1, "multi": 2, "transp": 4}
+KINDS_COMPLETE = sum(KIND_BITS.values())
+
+def _ddl_types() -> Tuple[str, str]:
+    """Tipos de PK autoincremento e binário conforme o dialeto (Postgres em produção, SQLite nos testes)"""
+    if engine.dialect.name == "sqlite":
+        return "INTEGER PRIMARY KEY AUTOINCREMENT", "BLOB"
+    return "SERIAL PRIMARY KEY", "BYTEA"
+
+def _add_column_if_missing(conn, table: str, column: str, ddl_type: str):
+    existing = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column not in existing:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+def init_schema():
+    pk, blob = _ddl_types()
+    with engine.begin() as conn:
+        # uploads = mapeamento (client, ym, kind) -> hash; o conteúdo fica em upload_blobs.
+        # Linhas antigas ainda podem trazer data/norm inline.
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS uploads (
+                id {pk},
+                client TEXT NOT NULL,
+                ym TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                data {blob},
+                hash TEXT,
+                created_at TEXT NOT NULL
+            )
+        """))
+        _add_column_if_missing(conn, "uploads", "hash", "TEXT")
+        # Artefato normalizado (Parquet) gerado uma única vez no upload
+        _add_column_if_missing(conn, "uploads", "norm", blob)
+        # Mapeamento papel -> coluna resolvido no upload (JSON)
+        _add_column_if_missing(conn, "uploads", "col_map", "TEXT")
+        if engine.dialect.name == "postgresql":
+            conn.execute(text("ALTER TABLE uploads ALTER COLUMN data DROP NOT NULL"))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_uploads_client_ym_kind ON uploads (client, ym, kind)"
+        ))
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_uploads_client_ym_kind_hash ON uploads (client, ym, kind, hash)"
+        ))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_uploads_hash ON uploads (hash)"))
+
+        # Store endereçado por conteúdo: uma linha por arquivo único (sha256), não por período
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS upload_blobs (
+                hash TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                data {blob} NOT NULL,
+                norm {blob},
+                size_bytes INTEGER NOT NULL,
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (hash, kind)
+            )
+        """))
+        _add_column_if_missing(conn, "upload_blobs", "col_map", "TEXT")
+        migrate_inline_blobs(conn)
+
+        # Índice de disponibilidade: uma linha por (client, ym) com os tipos presentes em bits
+        # (KIND_BITS), mantido pelo upload e pelo flush; /api/available-data lê só daqui.
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS upload_periods (
+                client TEXT NOT NULL,
+                ym TEXT NOT NULL,
+                kinds INTEGER NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (client, ym)
+            )
+        """))
+        migrate_upload_periods(conn)
+
+        # Agregados mensais por arquivo (hash), gerados no upload: relatórios leem daqui em vez
+        # do Parquet. emb_root = raiz canônica do embarcador (NULL = arquivo sem a coluna);
+        # first_pos = posição da 1ª linha no frame filtrado (mantém a ordem de aparição).
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS agg_files (
+                hash TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                exact INTEGER NOT NULL,
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (hash, kind)
+            )
+        """))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS agg_booking (
+                hash TEXT NOT NULL,
+                ym TEXT NOT NULL,
+                emb_root TEXT,
+                porto_origem TEXT,
+                porto_destino TEXT,
+                qtde BIGINT NOT NULL,
+                bookings INTEGER NOT NULL,
+                first_pos INTEGER NOT NULL
+            )
+        """))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS agg_atrasos (
+                hash TEXT NOT NULL,
+                ym TEXT NOT NULL,
+                emb_root TEXT,
+                tipo TEXT,
+                justificativa TEXT,
+                porto_origem TEXT,
+                ocorrencias INTEGER NOT NULL,
+                first_pos INTEGER NOT NULL
+            )
+        """))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS agg_reagendamentos (
+                hash TEXT NOT NULL,
+                ym TEXT NOT NULL,
+                emb_root TEXT,
+                motivo TEXT,
+                porto_op TEXT,
+                ocorrencias INTEGER NOT NULL,
+                first_pos INTEGER NOT NULL
+            )
+        """))
+        # Catálogo de embarcadores ativos por (arquivo de booking, ym); ym NULL = linha sem data
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS agg_embarcadores (
+                hash TEXT NOT NULL,
+                ym TEXT,
+                embarcador TEXT NOT NULL,
+                emb_root TEXT
+            )
+        """))
+        for table in ("agg_booking", "agg_atrasos", "agg_reagendamentos", "agg_embarcadores"):
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{table}_hash_ym ON {table} (hash, ym)"))
+
+        # Fila de relatórios (e-mail/EML) gerados fora da requisição; job_key agrupa pedidos iguais
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS report_jobs (
+                id TEXT PRIMARY KEY,
+                job_key TEXT NOT NULL,
+                job_type TEXT NOT NULL,
+                client TEXT NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                progress INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )
+        """))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS idx_report_jobs_key_status ON report_jobs (job_key, status)"))
+
+def migrate_upload_periods(conn):
+    """
+    Reconcilia o índice de disponibilidade com uploads, mês a mês: liga os bits que faltam e
+    avança updated_at se há upload mais novo (ex.: gravado por uma instância antiga no deploy).
+    Meses já em dia não mudam, então o ETag de /api/available-data continua o mesmo.
+    """
+    bits = " ".join(f"WHEN '{k}' THEN {b}" for k, b in KIND_BITS.items())
+    conn.execute(text(f"""
+        INSERT INTO upload_periods (client, ym, kinds, updated_at)
+        SELECT client, ym, SUM(CASE kind {bits} ELSE 0 END), MAX(created_at)
+        FROM (SELECT client, ym, kind, MAX(created_at) AS created_at FROM uploads GROUP BY client, ym, kind) u
+        GROUP BY client, ym
+        ON CONFLICT (client, ym) DO UPDATE
+        SET kinds = upload_periods.kinds | excluded.kinds,
+            updated_at = CASE WHEN excluded.updated_at > upload_periods.updated_at
+                              THEN excluded.updated_at ELSE upload_periods.updated_at END
+        WHERE (upload_periods.kinds | excluded.kinds) <> upload_periods.kinds
+           OR excluded.updated_at > upload_periods.updated_at
+    """))
+
+def migrate_inline_blobs(conn):
+    """Move o conteúdo inline de uploads antigos para upload_blobs (uma cópia por hash)"""
     conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS uploads (
-            id SERIAL PRIMARY KEY,
-            client TEXT NOT NULL,
-            ym TEXT NOT NULL,
-            kind TEXT NOT NULL,
-            data BYTEA NOT NULL,
-            hash TEXT,
-            created_at TEXT NOT NULL
+        INSERT INTO upload_blobs (hash, kind, data, norm, col_map, size_bytes, created_at)
+        SELECT u.hash, u.kind, u.data, u.norm, u.col_map, LENGTH(u.data), u.created_at
+        FROM uploads u
+        WHERE u.id IN (
+            SELECT MAX(id) FROM uploads
+            WHERE data IS NOT NULL AND hash IS NOT NULL
+            GROUP BY hash, kind
         )
+        ON CONFLICT (hash, kind) DO NOTHING
+    """))
+    conn.execute(text("""
+        UPDATE uploads SET data = NULL, norm = NULL, col_map = NULL
+        WHERE data IS NOT NULL AND hash IS NOT NULL
+          AND EXISTS (SELECT 1 FROM upload_blobs b WHERE b.hash = uploads.hash AND b.kind = uploads.kind)
     """))
-    conn.execute(text("ALTER TABLE uploads ADD COLUMN IF NOT EXISTS hash TEXT"))
-    conn.execute(text(
-        "CREATE INDEX IF NOT EXISTS idx_uploads_client_ym_kind ON uploads (client, ym, kind)"
-    ))
-    conn.execute(text(
-        "CREATE UNIQUE INDEX IF NOT EXISTS ux_uploads_client_ym_kind_hash ON uploads (client, ym, kind, hash)"
-    ))
+
+def gc_orphan_blobs(conn) -> Set[str]:
+    """
+    Remove de upload_blobs os arquivos que nenhum (client, ym, kind) referencia mais.
+    Devolve os tokens de conteúdo removidos, p/ invalidar os caches que dependem deles.
+    """
+    orphan = """
+        FROM upload_blobs
+        WHERE NOT EXISTS (
+            SELECT 1 FROM uploads u WHERE u.hash = upload_blobs.hash AND u.kind = upload_blobs.kind
+        )
+    """
+    pairs = conn.execute(text("SELECT hash, kind " + orphan)).fetchall()
+    if pairs:
+        conn.execute(text("DELETE " + orphan))
+        delete_aggregates(conn, pairs)
+    return {_content_token(None, h, k) for h, k in pairs}
+
+def _legacy_tokens(conn, where: str, params: Dict[str, object]) -> Set[str]:
+    """Tokens de uploads antigos sem hash (identificados pelo id) que o DELETE vai apagar"""
+    rows = conn.execute(text(f"SELECT id, kind FROM uploads WHERE {where} AND hash IS NULL"), params)
+    return {_content_token(i, None, k) for i, k in rows}
+
+if RUN_DB_INIT_AT_IMPORT and not os.getenv(_POOL_CHILD_ENV):
+    ensure_schema()
 
 # =============================================================================
 # COLUMN CANDIDATES
@@ -258,27 +634,136 @@ def normalize_str(v: str) -> str:
     s = " ".join(s.split())
     return s
 
-def parse_excel_bytes(xlsx_bytes: bytes) -> Dict[str, pd.DataFrame]:
-    """Parser otimizado de Excel"""
+# Coluna auxiliar com o hash da linha inteira, p/ deduplicar sem carregar todas as colunas
+ROW_HASH_COL = "__row_hash"
+
+def _header_names(header_row: list) -> List[str]:
+    """Nomes de coluna exatamente como o read_excel os daria (Unnamed: N, duplicadas .1, .2 ...)"""
+    from pandas.io.parsers import TextParser
+    names = TextParser([header_row], header=0).read().columns
+    return [str(c).strip() for c in names]
+
+def _projected_cols(names: List[str], candidates: List[List[str]]) -> List[int]:
+    """Índices de TODAS as colunas que algum candidato resolveria (exato ou por substring)"""
+    wanted = [w for cands in candidates for w in cands]
+    return [i for i, name in enumerate(names) if first_existing_col([name], wanted) is not None]
+
+def _xlsx_cell(cell):
+    # mesma conversão do leitor openpyxl do pandas
+    v = cell.value
+    if v is None:
+        return ""
+    if cell.data_type == "e":
+        return np.nan
+    if cell.data_type == "n":
+        iv = int(v)
+        return iv if iv == v else float(v)
+    return v
+
+def _row_digest(names: List[str], values: list, filled: List[int]) -> str:
+    """
+    Hash da linha inteira pelos nomes das colunas (não pela posição): abas com as colunas em
+    outra ordem dão o mesmo hash, como no drop_duplicates do frame concatenado.
+    """
+    cells = []
+    for i in filled:
+        v = values[i]
+        if isinstance(v, float) and v.is_integer():
+            v = int(v)
+        cells.append((names[i] if i < len(names) else f"Unnamed: {i}", repr(v)))
+    return hashlib.blake2b(repr(sorted(cells)).encode("utf-8"), digest_size=16).hexdigest()
+
+def _stream_xlsx_sheet(ws, candidates: Optional[List[List[str]]], columns: Optional[List[str]],
+                       row_hash: bool) -> pd.DataFrame:
+    from pandas.io.parsers import TextParser
+    ws.reset_dimensions()
+    rows_iter = ws.iter_rows()
+    header = next(rows_iter, None)
+    if header is None:
+        return pd.DataFrame()
+    header_row = [_xlsx_cell(c) for c in header]
+    while header_row and header_row[-1] == "":
+        header_row.pop()
+    names = _header_names(header_row) if header_row else []
+    if columns is not None:
+        idx = [i for i, name in enumerate(names) if name in columns]
+    elif candidates is not None:
+        idx = _projected_cols(names, candidates)
+    else:
+        idx = list(range(len(names)))
+    width = len(idx)
+
+    # Só as colunas projetadas ficam em memória; as demais são lidas e descartadas linha a linha
+    rows: List[list] = []
+    last_with_data = -1
+    for row in rows_iter:
+        values = [c.value for c in row]
+        filled = [i for i, v in enumerate(values) if v is not None and v != ""]
+        key = _row_digest(names, values, filled) if row_hash else len(rows)
+        if not filled:
+            rows.append([""] * width + [key])
+            continue
+        last_with_data = len(rows)
+        rows.append([_xlsx_cell(row[i]) if i < len(row) else "" for i in idx] + [key])
+    del rows[last_with_data + 1:]
+    if not rows:
+        return pd.DataFrame()
+
+    # a inferência de tipos roda uma vez por coluna, como no read_excel
+    df = TextParser(rows, header=None, names=[names[i] for i in idx] + [ROW_HASH_COL]).read()
+    return df if row_hash else df.drop(columns=[ROW_HASH_COL])
+
+def parse_excel_bytes(xlsx_bytes: bytes,
+                      candidates: Optional[List[List[str]]] = None,
+                      row_hash: bool = False,
+                      columns: Optional[List[str]] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Parser de Excel. Em .xlsx lê em streaming (openpyxl read_only): resolve os cabeçalhos
+    primeiro e guarda só as colunas que algum dos `candidates` usa, então a memória
+    acompanha o nº de colunas úteis e não a largura da planilha. `columns` projeta
+    pelos nomes exatos (mapeamento já resolvido). Sem nenhum dos dois, lê tudo.
+    `row_hash` acrescenta ROW_HASH_COL com o hash da linha completa.
+    """
     dfs = {}
+    if xlsx_bytes[:2] == b"PK":
+        from openpyxl import load_workbook
+        wb = load_workbook(io.BytesIO(xlsx_bytes), read_only=True, data_only=True, keep_links=False)
+        try:
+            for ws in wb.worksheets:
+                df = _stream_xlsx_sheet(ws, candidates, columns, row_hash)
+                if len(df) > 0:
+                    dfs[ws.title] = df
+        finally:
+            wb.close()
+        return dfs
+
+    # .xls (xlrd): sem streaming, mas ainda projeta as colunas na leitura
+    usecols = None
+    if columns is not None:
+        usecols = lambda c: str(c).strip() in columns
+    elif candidates is not None:
+        wanted = [w for cands in candidates for w in cands]
+        usecols = lambda c: first_existing_col([str(c).strip()], wanted) is not None
     with io.BytesIO(xlsx_bytes) as fh:
         xls = pd.ExcelFile(fh)
         for sheet in xls.sheet_names:
             fh.seek(0)
-            df = pd.read_excel(fh, sheet_name=sheet)
+            df = pd.read_excel(fh, sheet_name=sheet, usecols=usecols)
             df.columns = [str(c).strip() for c in df.columns]
             if len(df) > 0:
                 dfs[sheet] = df
     return dfs
 
-def first_existing_col(df: pd.DataFrame, candidates: List[str]) -> Optional[str]:
-    norm_map = {c: normalize_str(c) for c in df.columns}
+def first_existing_col(df, candidates: List[str]) -> Optional[str]:
+    """Aceita um DataFrame ou direto a lista de cabeçalhos"""
+    columns = df.columns if isinstance(df, pd.DataFrame) else list(df)
+    norm_map = {c: normalize_str(c) for c in columns}
     for wanted in candidates:
         wn = normalize_str(wanted)
         for col, normed in norm_map.items():
             if normed == wn:
                 return col
-    for col in df.columns:
+    for col in columns:
         cn = normalize_str(col)
         if any(normalize_str(w) in cn for w in candidates):
             return col
@@ -292,6 +777,87 @@ def ensure_col(df: pd.DataFrame, candidates: List[str]) -> Optional[str]:
     print("       Colunas disponíveis:", list(df.columns)[:20], "...")
     return None
 
+# Papéis de coluna por tipo de planilha; cada papel tenta os grupos de candidatos em ordem
+SCHEMA_ROLES: Dict[str, Dict[str, List[List[str]]]] = {
+    "booking": {
+        "status":     [CANDS_BOOKING_STAT],
+        "dt":         [CANDS_BOOKING_DT],
+        "emb":        [CANDS_BOOKING_EMB],
+        "qtd":        [CANDS_BOOKING_QTD],
+        "booking_id": [CANDS_BOOKING_ID],
+        "porto_orig": [CANDS_BOOKING_PORT_ORIG],
+        "porto_dest": [CANDS_BOOKING_PORT_DEST],
+    },
+    "multi": {
+        "cliente":     [CANDS_MULTI_CLIENTE],
+        "causador":    [CANDS_MULTI_CAUSADOR],
+        "area":        [CANDS_MULTI_AREA],
+        "just":        [CANDS_MULTI_JUST],
+        "agendamento": [["agendamento"], ["data agendamento"], ["ultima alteracao"], CANDS_MULTI_DT],
+        "porto":       [CANDS_MULTI_PORTO],
+        "tipo_op":     [CANDS_MULTI_TIPO_OP],
+    },
+    "transp": {
+        "emb":         [CANDS_TRANSP_EMB],
+        "sit_prog":    [CANDS_TRANSP_SIT_PROG],
+        "sit_prazo":   [CANDS_TRANSP_SIT_PRAZO],
+        "tipo":        [CANDS_TRANSP_TIPO],
+        "dt_ref":      [CANDS_TRANSP_DT_REF],
+        "just":        [CANDS_TRANSP_JUST],
+        "porto_orig":  [CANDS_TRANSP_PORTO_ORIG],
+    },
+}
+
+# Todos os candidatos de cada tipo: definem as colunas lidas da planilha
+KIND_CANDIDATES = {
+    kind: [cands for groups in roles.values() for cands in groups]
+    for kind, roles in SCHEMA_ROLES.items()
+}
+
+@lru_cache(maxsize=256)
+def _resolve_schema_cached(kind: str, headers: Tuple[str, ...]) -> Tuple[Tuple[str, Optional[str]], ...]:
+    resolved = []
+    for role, groups in SCHEMA_ROLES[kind].items():
+        col = None
+        for cands in groups:
+            col = first_existing_col(headers, cands)
+            if col:
+                break
+        if col is None:
+            print("[WARN] Nenhuma coluna encontrada p/ candidatos:", groups[-1])
+            print("       Colunas disponíveis:", list(headers)[:20], "...")
+        resolved.append((role, col))
+    return tuple(resolved)
+
+def resolve_schema(kind: str, columns) -> Dict[str, Optional[str]]:
+    """
+    Mapeamento completo papel -> coluna de um tipo de planilha, resolvido de uma vez.
+    Memoizado pela tupla de cabeçalhos: exports com o mesmo layout não repetem a busca.
+    """
+    return dict(_resolve_schema_cached(kind, tuple(str(c) for c in columns)))
+
+@lru_cache(maxsize=None)
+def schema_fingerprint(kind: str) -> str:
+    """Muda quando os candidatos mudam, invalidando os mapeamentos gravados"""
+    return hashlib.sha256(json.dumps(SCHEMA_ROLES[kind]).encode("utf-8")).hexdigest()[:16]
+
+def schema_to_json(kind: str, schema: Optional[Dict[str, Optional[str]]]) -> Optional[str]:
+    if schema is None:
+        return None
+    return json.dumps({"fp": schema_fingerprint(kind), "cols": schema}, ensure_ascii=False)
+
+def schema_from_json(kind: str, raw: Optional[str]) -> Optional[Dict[str, Optional[str]]]:
+    """Mapeamento gravado no upload, ou None se ausente/obsoleto"""
+    if not raw:
+        return None
+    try:
+        stored = json.loads(raw)
+    except ValueError:
+        return None
+    if stored.get("fp") != schema_fingerprint(kind):
+        return None
+    return stored.get("cols")
+
 def extract_period_ym(dt_raw) -> Optional[str]:
     if pd.isna(dt_raw):
         return None
@@ -301,7 +867,7 @@ def extract_period_ym(dt_raw) -> Optional[str]:
     if isinstance(dt_raw, (int, float)):
         if not (isinstance(dt_raw, float) and math.isnan(dt_raw)):
             if 10000 <= float(dt_raw) <= 60000:
-                d = pd.to_datetime(dt_raw, unit="d", origin="1899-12-30", errors="coerce")
+                d = pd.to_datetime(float(dt_raw), unit="d", origin="1899-12-30", errors="coerce")
                 return f"{d.year:04d}-{d.month:02d}" if pd.notna(d) else None
             return None
     cand = str(dt_raw).strip()
@@ -318,6 +884,97 @@ def extract_period_ym(dt_raw) -> Optional[str]:
     except Exception:
         return None
 
+PERIOD_DATE_FORMATS = ["%d/%m/%Y %H:%M:%S","%d/%m/%Y %H:%M","%d/%m/%Y","%Y-%m-%d %H:%M:%S","%Y-%m-%d"]
+
+def _ym_from_datetimes(d: pd.Series) -> np.ndarray:
+    # formata só os poucos meses distintos e espalha de volta
+    keys = (d.dt.year * 100 + d.dt.month).to_numpy(dtype="int64")
+    uniq, inv = np.unique(keys, return_inverse=True)
+    labels = np.array([f"{k // 100:04d}-{k % 100:02d}" for k in uniq], dtype=object)
+    return labels[inv]
+
+def _periods_from_serials(values: np.ndarray) -> np.ndarray:
+    """Datas seriais do Excel (10000..60000 dias desde 1899-12-30); fora da faixa -> None"""
+    out = np.full(len(values), None, dtype=object)
+    pos = np.flatnonzero((values >= 10000) & (values <= 60000))
+    if len(pos):
+        d = pd.Series(pd.to_datetime(values[pos], unit="D", origin="1899-12-30", errors="coerce"))
+        ok = d.notna().to_numpy()
+        out[pos[ok]] = _ym_from_datetimes(d[ok])
+    return out
+
+def _periods_from_objects(values: np.ndarray) -> np.ndarray:
+    """Valores distintos (sem NA) de uma coluna object -> 'YYYY-MM' ou None"""
+    out = np.full(len(values), None, dtype=object)
+    if pd.api.types.infer_dtype(values, skipna=False) == "string":
+        kinds = np.full(len(values), "str")
+    else:
+        kinds = np.array([
+            "dt" if isinstance(v, (datetime, pd.Timestamp, date)) else
+            "num" if isinstance(v, (int, float)) else
+            "str" if isinstance(v, str) else "other"
+            for v in values
+        ])
+    leftover = list(np.flatnonzero(kinds == "other"))
+
+    pos = np.flatnonzero(kinds == "dt")
+    if len(pos):
+        try:
+            d = pd.Series(pd.to_datetime(list(values[pos]), errors="coerce"))
+            ok = d.notna().to_numpy()
+            out[pos[ok]] = _ym_from_datetimes(d[ok])
+        except (TypeError, ValueError):
+            # fusos horários misturados etc.: resolve um a um
+            leftover.extend(pos)
+
+    pos = np.flatnonzero(kinds == "num")
+    if len(pos):
+        out[pos] = _periods_from_serials(values[pos].astype(float))
+
+    pos = np.flatnonzero(kinds == "str")
+    if len(pos):
+        remaining = pd.Series([v.strip() for v in values[pos]], index=pos)
+        for fmt in PERIOD_DATE_FORMATS:
+            if remaining.empty:
+                break
+            candidates = remaining
+            if "%S" in fmt:
+                # strptime recusa segundos 60/61; o parser do pandas aceitaria (e viraria o minuto)
+                candidates = remaining[~remaining.str.endswith((":60", ":61"))]
+            d = pd.to_datetime(candidates, format=fmt, errors="coerce")
+            hit = d.notna()
+            out[candidates.index[hit]] = _ym_from_datetimes(d[hit])
+            remaining = remaining.drop(candidates.index[hit])
+        # o que nenhum formato fixo reconhece passa pelo parser flexível (dayfirst)
+        leftover.extend(remaining.index)
+
+    for i in leftover:
+        out[i] = extract_period_ym(values[i])
+    return out
+
+def extract_period_ym_series(values: pd.Series) -> pd.Series:
+    """
+    Versão em lote de `values.apply(extract_period_ym)`, com o mesmo resultado.
+    A coluna é classificada uma vez (datetime, número serial do Excel ou texto) e
+    cada formato de data é aplicado de uma vez sobre os valores distintos.
+    """
+    out = np.full(len(values), None, dtype=object)
+    if len(values) == 0:
+        pass
+    elif pd.api.types.is_datetime64_any_dtype(values):
+        ok = values.notna().to_numpy()
+        out[ok] = _ym_from_datetimes(values[ok])
+    elif pd.api.types.is_bool_dtype(values):
+        pass
+    elif pd.api.types.is_numeric_dtype(values):
+        out = _periods_from_serials(values.to_numpy(dtype=float, na_value=np.nan))
+    else:
+        codes, uniques = pd.factorize(values)
+        if len(uniques):
+            out = _periods_from_objects(np.asarray(uniques, dtype=object))[codes]
+            out[codes < 0] = None
+    return pd.Series(out, index=values.index, dtype=object)
+
 def safe_int(x) -> int:
     try:
         return int(x)
@@ -358,6 +1015,33 @@ def client_match(selected: str, value: str) -> bool:
         return False
     return (s_root in v_root) or (v_root in s_root)
 
+@lru_cache(maxsize=8192)
+def _client_root_cached(name: str) -> str:
+    return canonical_client_root(name)
+
+def raw_client_root(raw) -> str:
+    """Raiz de um valor cru da coluna de embarcador; célula vazia (NaN/None) não casa com nada"""
+    if raw is None or (isinstance(raw, float) and math.isnan(raw)):
+        return ""
+    return _client_root_cached(str(raw))
+
+def client_match_mask(values: pd.Series, selected_embarcadores: List[str]) -> pd.Series:
+    """
+    Equivalente vetorizado de `values.apply(lambda v: client_match(emb, v))` para
+    vários embarcadores: a raiz canônica é calculada uma vez por nome distinto e
+    o resultado volta para as linhas via `isin`.
+    """
+    s_roots = {canonical_client_root(e) for e in selected_embarcadores} - {""}
+    if not s_roots or values.empty:
+        return pd.Series(False, index=values.index)
+
+    matched = []
+    for raw in pd.unique(values):
+        v_root = raw_client_root(raw)
+        if v_root and any(s in v_root or v_root in s for s in s_roots):
+            matched.append(raw)
+    return values.isin(matched)
+
 def _wrap_label(s: str, width: int = 22) -> str:
     if not s:
         return s
@@ -388,225 +1072,532 @@ def sha256_bytes(data: bytes) -> str:
 # =============================================================================
 # LOADERS (COM CACHE)
 # =============================================================================
-@lru_cache(maxsize=32)
-def _load_booking_cached(hash_key: str, xlsx_bytes: bytes, 
-                         selected_ym_tuple: tuple, selected_emb_tuple: tuple) -> pd.DataFrame:
-    """Versão cacheável do load_booking_df"""
-    return load_booking_df(xlsx_bytes, list(selected_ym_tuple), list(selected_emb_tuple))
+# Cada planilha é lida UMA vez no upload e reduzida a um frame normalizado
+# (colunas canônicas), persistido como Parquet. Os endpoints de leitura apenas
+# filtram esse frame, sem passar novamente pelo openpyxl.
+BOOKING_NORM_COLUMNS = ["__ym", "ativo", "emb", "booking_id", "porto_origem", "porto_destino", "qtde"]
+MULTI_NORM_COLUMNS   = ["__ym", "cliente", "porto_op", "tipo_operacao", "motivo_reagenda"]
+TRANSP_NORM_COLUMNS  = ["__ym", "embarcador", "tipo_norm", "justificativa_atraso", "porto_origem"]
+
+BOOKING_OUT_COLUMNS = ["ym","booking_id","porto_origem","porto_destino","qtde","embarcador"]
+MULTI_OUT_COLUMNS   = ["__ym", "porto_op", "tipo_operacao", "motivo_reagenda", "flag"]
+TRANSP_OUT_COLUMNS  = ["tipo_norm","justificativa_atraso","__ym","porto_origem"]
+
+def _concat_sheets(sheets: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    if not sheets:
+        return pd.DataFrame()
+    return pd.concat(sheets.values(), ignore_index=True)
 
-def load_booking_df(xlsx_bytes: bytes,
-                    selected_ym_list: Optional[List[str]] = None,
-                    selected_embarcadores: Optional[List[str]] = None) -> pd.DataFrame:
-    sheets = parse_excel_bytes(xlsx_bytes)
-    df_all = pd.concat(sheets.values(), ignore_index=True)
+def _ordered(df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """Reordena para o layout canônico, preservando a ausência das colunas não resolvidas"""
+    return df[[c for c in columns if c in df.columns]].reset_index(drop=True)
 
-    col_status    = ensure_col(df_all, CANDS_BOOKING_STAT)
-    col_dt        = ensure_col(df_all, CANDS_BOOKING_DT)
-    col_emb       = ensure_col(df_all, CANDS_BOOKING_EMB)
-    col_qtd       = ensure_col(df_all, CANDS_BOOKING_QTD)
-    col_booking_id= ensure_col(df_all, CANDS_BOOKING_ID)
-    col_porto_orig= ensure_col(df_all, CANDS_BOOKING_PORT_ORIG)
-    col_porto_dest= ensure_col(df_all, CANDS_BOOKING_PORT_DEST)
+def frame_to_parquet(df: pd.DataFrame) -> bytes:
+    buf = io.BytesIO()
+    df.reset_index(drop=True).to_parquet(buf, engine="pyarrow", index=False, compression="zstd")
+    return buf.getvalue()
+
+def frame_from_parquet(data: bytes, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Lê o artefato normalizado; `columns` projeta só as colunas necessárias (as ausentes são ignoradas)"""
+    import pyarrow.parquet as pq
+    pf = pq.ParquetFile(io.BytesIO(data))
+    if columns is not None:
+        available = set(pf.schema_arrow.names)
+        columns = [c for c in columns if c in available]
+    return pf.read(columns=columns).to_pandas()
+
+def normalize_booking_frame(df_all: pd.DataFrame,
+                            schema: Optional[Dict[str, Optional[str]]] = None) -> pd.DataFrame:
+    """
+    Resolve as colunas do Booking e devolve um frame com BOOKING_NORM_COLUMNS.
+    Colunas não encontradas na planilha ficam AUSENTES no frame (e não vazias),
+    para que o loader saiba distinguir "sem coluna" de "sem valor".
+    """
+    if df_all.empty:
+        return pd.DataFrame(columns=BOOKING_NORM_COLUMNS)
+
+    schema = schema or resolve_schema("booking", df_all.columns)
+    col_status    = schema["status"]
+    col_dt        = schema["dt"]
+    col_emb       = schema["emb"]
+    col_qtd       = schema["qtd"]
+    col_booking_id= schema["booking_id"]
+    col_porto_orig= schema["porto_orig"]
+    col_porto_dest= schema["porto_dest"]
+
+    out = pd.DataFrame(index=df_all.index)
+    if col_dt:
+        out["__ym"] = extract_period_ym_series(df_all[col_dt])
+    if col_status:
+        out["ativo"] = df_all[col_status].astype(str).str.strip().str.lower() == "ativo"
+    else:
+        out["ativo"] = True
+    if col_emb:
+        emb = df_all[col_emb]
+        out["emb"] = emb.where(emb.isna(), emb.astype(str))
+    if col_qtd:
+        out["qtde"] = df_all[col_qtd].apply(safe_int).astype("int64")
+        if col_booking_id:
+            ids = df_all[col_booking_id]
+            out["booking_id"] = ids.where(ids.isna(), ids.astype(str))
+        elif col_dt:
+            out["booking_id"] = (
+                out["__ym"].astype(str) + "|" + out["qtde"].astype(str) + "|row" + df_all.index.astype(str)
+            )
+    out["porto_origem"] = df_all[col_porto_orig].astype(str).str.strip() if col_porto_orig else ""
+    out["porto_destino"] = df_all[col_porto_dest].astype(str).str.strip() if col_porto_dest else ""
+    return _ordered(out, BOOKING_NORM_COLUMNS)
+
+def normalize_multi_frame(df_all: pd.DataFrame,
+                          schema: Optional[Dict[str, Optional[str]]] = None) -> pd.DataFrame:
+    """Aplica as regras de validade do Multimodal (causador/área/justificativa) e devolve MULTI_NORM_COLUMNS"""
+    if df_all.empty:
+        return pd.DataFrame(columns=MULTI_NORM_COLUMNS)
+
+    df_all = df_all.replace("-", "").fillna("")
+
+    schema = schema or resolve_schema("multi", df_all.columns)
+    col_cliente   = schema["cliente"]
+    col_causador  = schema["causador"]
+    col_area_resp = schema["area"]
+    col_just      = schema["just"]
+    col_agendamento = schema["agendamento"]
+    col_porto   = schema["porto"]
+    col_tipoop  = schema["tipo_op"]
 
-    if not col_dt or not col_emb or not col_qtd:
-        return pd.DataFrame(columns=["ym","embarcador","booking_id","porto_origem","porto_destino","qtde"])
+    mask_causador_ok = pd.Series([True]*len(df_all), index=df_all.index)
+    if col_causador:
+        mask_causador_ok = df_all[col_causador].astype(str).str.strip().str.lower().eq("mercosul")
 
-    df_all["__ym"] = df_all[col_dt].apply(extract_period_ym)
+    mask_area_ok = pd.Series([True]*len(df_all), index=df_all.index)
+    if col_area_resp:
+        mask_area_ok = ~df_all[col_area_resp].astype(str).str.strip().str.upper().isin(["CUS","TRA"])
 
-    if col_status:
-        df_all = df_all[df_all[col_status].astype(str).str.strip().str.lower() == "ativo"]
+    just_norm_series = pd.Series([""]*len(df_all), index=df_all.index)
+    mask_just_ok = pd.Series([True]*len(df_all), index=df_all.index)
+    if col_just:
+        just_norm_series = df_all[col_just].astype(str).str.strip()
+        mask_just_ok = just_norm_series.apply(lambda x: len(x) > 1)
+
+    df_valid = df_all[mask_causador_ok & mask_area_ok & mask_just_ok]
+
+    out = pd.DataFrame(index=df_valid.index)
+    if col_agendamento:
+        out["__ym"] = extract_period_ym_series(df_valid[col_agendamento])
+    else:
+        out["__ym"] = None
+    if col_cliente:
+        out["cliente"] = df_valid[col_cliente].astype(str)
+    out["porto_op"] = df_valid[col_porto].astype(str).str.strip() if col_porto else ""
+    out["tipo_operacao"] = df_valid[col_tipoop].astype(str).str.strip() if col_tipoop else ""
+    # Aplicar normalização de justificativa
+    out["motivo_reagenda"] = just_norm_series.loc[df_valid.index].apply(normalize_justificativa)
+    return _ordered(out, MULTI_NORM_COLUMNS)
+
+def normalize_transp_frame(df_all: pd.DataFrame,
+                           schema: Optional[Dict[str, Optional[str]]] = None) -> pd.DataFrame:
+    """Mantém só as programações atrasadas e não canceladas e devolve TRANSP_NORM_COLUMNS"""
+    if df_all.empty:
+        return pd.DataFrame(columns=TRANSP_NORM_COLUMNS)
+
+    schema = schema or resolve_schema("transp", df_all.columns)
+    col_embarc        = schema["emb"]
+    col_situacao_prog = schema["sit_prog"]
+    col_situacao_prazo= schema["sit_prazo"]
+    col_tipo_prog     = schema["tipo"]
+    col_dt_ref        = schema["dt_ref"]
+    col_just_transp   = schema["just"]
+    col_porto_orig    = schema["porto_orig"]
+
+    if not col_tipo_prog:
+        return pd.DataFrame(columns=[c for c in TRANSP_NORM_COLUMNS if c != "tipo_norm"])
+
+    # Linhas idênticas contam uma vez só (pelo hash da linha inteira, quando a leitura foi projetada)
+    if ROW_HASH_COL in df_all.columns:
+        df_all = df_all.drop_duplicates(subset=[ROW_HASH_COL]).drop(columns=[ROW_HASH_COL])
+    else:
+        df_all = df_all.drop_duplicates()
+    if col_situacao_prog:
+        df_all = df_all[~df_all[col_situacao_prog].astype(str).str.lower().str.contains("cancelad", na=False)]
+    if col_situacao_prazo:
+        df_all = df_all[df_all[col_situacao_prazo].astype(str).str.strip().str.lower() == "atrasado"]
+
+    out = pd.DataFrame(index=df_all.index)
+    if col_dt_ref:
+        out["__ym"] = extract_period_ym_series(df_all[col_dt_ref])
+    else:
+        out["__ym"] = None
+    if col_embarc:
+        out["embarcador"] = df_all[col_embarc].astype(str)
+    out["tipo_norm"] = df_all[col_tipo_prog].astype(str).str.strip().str.lower()
+    # Aplicar normalização de justificativa
+    if col_just_transp:
+        out["justificativa_atraso"] = df_all[col_just_transp].apply(normalize_justificativa)
+    else:
+        out["justificativa_atraso"] = "Sem justificativa"
+    out["porto_origem"] = df_all[col_porto_orig].astype(str).str.strip() if col_porto_orig else ""
+    return _ordered(out, TRANSP_NORM_COLUMNS)
+
+NORMALIZERS = {
+    "booking": normalize_booking_frame,
+    "multi":   normalize_multi_frame,
+    "transp":  normalize_transp_frame,
+}
+
+def parse_workbook(xlsx_bytes: bytes, kind: str,
+                   schema: Optional[Dict[str, Optional[str]]] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Lê só as colunas que o normalizador de `kind` usa (transp leva o hash da linha p/ deduplicar).
+    Com o mapeamento já resolvido, projeta direto pelos nomes, sem olhar os candidatos.
+    """
+    row_hash = kind == "transp"
+    if schema is not None:
+        return parse_excel_bytes(xlsx_bytes, row_hash=row_hash, columns=[c for c in schema.values() if c])
+    return parse_excel_bytes(xlsx_bytes, KIND_CANDIDATES[kind], row_hash=row_hash)
+
+def normalize_workbook_with_schema(xlsx_bytes: bytes, kind: str,
+                                   schema: Optional[Dict[str, Optional[str]]] = None
+                                   ) -> Tuple[pd.DataFrame, Optional[Dict[str, Optional[str]]]]:
+    """Frame normalizado + mapeamento de colunas usado (p/ gravar junto do upload)"""
+    df_all = _concat_sheets(parse_workbook(xlsx_bytes, kind, schema))
+    if df_all.empty:
+        return NORMALIZERS[kind](df_all), schema
+    if schema is None:
+        schema = resolve_schema(kind, df_all.columns)
+    return NORMALIZERS[kind](df_all, schema), schema
+
+def normalize_workbook(xlsx_bytes: bytes, kind: str) -> pd.DataFrame:
+    return normalize_workbook_with_schema(xlsx_bytes, kind)[0]
+
+def filter_booking_norm(norm: pd.DataFrame,
+                        selected_ym_list: Optional[List[str]] = None,
+                        selected_embarcadores: Optional[List[str]] = None) -> pd.DataFrame:
+    if norm is None or any(c not in norm.columns for c in ("__ym", "emb", "qtde")):
+        return pd.DataFrame(columns=BOOKING_OUT_COLUMNS)
+
+    df_all = norm[norm["ativo"].astype(bool)]
 
     if selected_embarcadores:
-        mask = pd.Series([False]*len(df_all), index=df_all.index)
-        for emb in selected_embarcadores:
-            mask |= df_all[col_emb].apply(lambda v: client_match(emb, str(v)))
-        df_all = df_all[mask]
+        df_all = df_all[client_match_mask(df_all["emb"], selected_embarcadores)]
 
     if selected_ym_list:
         df_all = df_all[df_all["__ym"].isin(selected_ym_list)]
 
     df_all = df_all[~df_all["__ym"].isna()]
-    df_all["__qtde"] = df_all[col_qtd].apply(safe_int)
 
-    if not col_booking_id:
-        col_booking_id = "__generated_booking_id"
-        df_all[col_booking_id] = (
-            df_all["__ym"].astype(str) + "|" + df_all["__qtde"].astype(str) + "|row" + df_all.index.astype(str)
-        )
+    if df_all.empty:
+        return pd.DataFrame(columns=BOOKING_OUT_COLUMNS)
 
-    if not col_porto_orig:
-        col_porto_orig = "__porto_orig_dummy"; df_all[col_porto_orig] = ""
-    if not col_porto_dest:
-        col_porto_dest = "__porto_dest_dummy"; df_all[col_porto_dest] = ""
-
-    records = []
-    embarcadores_str = ",".join(selected_embarcadores) if selected_embarcadores else ""
-    for (ym_val, bid), sub in df_all.groupby(["__ym", col_booking_id], dropna=False):
-        total_qtde = sub["__qtde"].sum()
-        best_row = sub.sort_values("__qtde", ascending=False).iloc[0]
-        records.append({
-            "ym": ym_val,
-            "booking_id": bid,
-            "porto_origem": str(best_row[col_porto_orig]).strip(),
-            "porto_destino": str(best_row[col_porto_dest]).strip(),
-            "qtde": int(total_qtde),
-            "embarcador": embarcadores_str
-        })
-    return pd.DataFrame(records, columns=["ym","booking_id","porto_origem","porto_destino","qtde","embarcador"]).reset_index(drop=True)
+    # soma por booking + linha de maior qtde (primeira em empate) p/ os portos
+    df_all = df_all.reset_index(drop=True)
+    agg = df_all.groupby(["__ym", "booking_id"], dropna=False).agg(
+        qtde=("qtde", "sum"),
+        best=("qtde", "idxmax"),
+    )
+    best = agg["best"].to_numpy()
+    out = pd.DataFrame({
+        "ym": agg.index.get_level_values(0).to_numpy(dtype=object),
+        "booking_id": agg.index.get_level_values(1).to_numpy(dtype=object),
+        "porto_origem": df_all["porto_origem"].to_numpy(dtype=object)[best],
+        "porto_destino": df_all["porto_destino"].to_numpy(dtype=object)[best],
+        "qtde": agg["qtde"].to_numpy(dtype="int64"),
+        "embarcador": ",".join(selected_embarcadores) if selected_embarcadores else "",
+    })
+    return out[BOOKING_OUT_COLUMNS]
 
-def load_multi_df(xlsx_bytes: bytes,
-                  selected_ym_list: Optional[List[str]] = None,
-                  selected_embarcadores: Optional[List[str]] = None) -> pd.DataFrame:
-    sheets = parse_excel_bytes(xlsx_bytes)
-    if not sheets:
-        return pd.DataFrame(columns=["__ym", "porto_op", "tipo_operacao", "motivo_reagenda", "flag"])
+def filter_multi_norm(norm: pd.DataFrame,
+                      selected_ym_list: Optional[List[str]] = None,
+                      selected_embarcadores: Optional[List[str]] = None) -> pd.DataFrame:
+    if norm is None or norm.empty:
+        return pd.DataFrame(columns=MULTI_OUT_COLUMNS)
+
+    df_all = norm
+    if selected_ym_list:
+        df_all = df_all[df_all["__ym"].isin(selected_ym_list)]
 
-    df_all = pd.concat(sheets.values(), ignore_index=True).replace("-", "").fillna("")
+    if selected_embarcadores and "cliente" in df_all.columns:
+        df_all = df_all[client_match_mask(df_all["cliente"], selected_embarcadores)]
 
-    col_cliente   = ensure_col(df_all, CANDS_MULTI_CLIENTE)
-    col_causador  = ensure_col(df_all, CANDS_MULTI_CAUSADOR)
-    col_area_resp = ensure_col(df_all, CANDS_MULTI_AREA)
-    col_just      = ensure_col(df_all, CANDS_MULTI_JUST)
-    col_agendamento = None
-    for term in ["agendamento","data agendamento","ultima alteracao"]:
-        col_agendamento = col_agendamento or first_existing_col(df_all, [term])
-    col_agendamento = col_agendamento or ensure_col(df_all, CANDS_MULTI_DT)
-    col_porto   = ensure_col(df_all, CANDS_MULTI_PORTO)
-    col_tipoop  = ensure_col(df_all, CANDS_MULTI_TIPO_OP)
+    df_valid = df_all.copy()
+    df_valid["flag"] = 1
+    return df_valid[MULTI_OUT_COLUMNS].reset_index(drop=True)
 
-    if col_agendamento:
-        df_all["__ym"] = df_all[col_agendamento].apply(extract_period_ym)
-    else:
-        df_all["__ym"] = None
+def filter_transp_norm(norm: pd.DataFrame,
+                       selected_ym_list: Optional[List[str]] = None,
+                       selected_embarcadores: Optional[List[str]] = None) -> pd.DataFrame:
+    if norm is None or "tipo_norm" not in norm.columns:
+        return pd.DataFrame(columns=TRANSP_OUT_COLUMNS)
 
+    df_all = norm
     if selected_ym_list:
         df_all = df_all[df_all["__ym"].isin(selected_ym_list)]
 
-    if selected_embarcadores and col_cliente:
-        mask = pd.Series([False]*len(df_all), index=df_all.index)
-        for emb in selected_embarcadores:
-            mask |= df_all[col_cliente].astype(str).apply(lambda v: client_match(emb, v))
-        df_all = df_all[mask]
+    if selected_embarcadores and "embarcador" in df_all.columns:
+        df_all = df_all[client_match_mask(df_all["embarcador"], selected_embarcadores)]
 
-    mask_causador_ok = pd.Series([True]*len(df_all), index=df_all.index)
-    if col_causador:
-        mask_causador_ok = df_all[col_causador].astype(str).str.strip().str.lower().eq("mercosul")
-
-    mask_area_ok = pd.Series([True]*len(df_all), index=df_all.index)
-    if col_area_resp:
-        mask_area_ok = ~df_all[col_area_resp].astype(str).str.strip().str.upper().isin(["CUS","TRA"])
+    return df_all[TRANSP_OUT_COLUMNS].reset_index(drop=True)
 
-    just_norm_series = pd.Series([""]*len(df_all), index=df_all.index)
-    mask_just_ok = pd.Series([True]*len(df_all), index=df_all.index)
-    if col_just:
-        just_norm_series = df_all[col_just].astype(str).str.strip()
-        mask_just_ok = just_norm_series.apply(lambda x: len(x) > 1)
-
-    df_valid = df_all[mask_causador_ok & mask_area_ok & mask_just_ok].copy()
-    
-    # Aplicar normalização de justificativa
-    df_valid["motivo_reagenda"] = just_norm_series.loc[df_valid.index].apply(normalize_justificativa)
-    df_valid["porto_op"] = df_valid[col_porto].astype(str).str.strip() if col_porto else ""
-    df_valid["tipo_operacao"] = df_valid[col_tipoop].astype(str).str.strip() if col_tipoop else ""
-    df_valid["flag"] = 1
+def load_booking_df(xlsx_bytes: bytes,
+                    selected_ym_list: Optional[List[str]] = None,
+                    selected_embarcadores: Optional[List[str]] = None) -> pd.DataFrame:
+    return filter_booking_norm(normalize_workbook(xlsx_bytes, "booking"), selected_ym_list, selected_embarcadores)
 
-    return df_valid[["__ym", "porto_op", "tipo_operacao", "motivo_reagenda", "flag"]].reset_index(drop=True)
+def load_multi_df(xlsx_bytes: bytes,
+                  selected_ym_list: Optional[List[str]] = None,
+                  selected_embarcadores: Optional[List[str]] = None) -> pd.DataFrame:
+    return filter_multi_norm(normalize_workbook(xlsx_bytes, "multi"), selected_ym_list, selected_embarcadores)
 
 def load_transp_df(xlsx_bytes: bytes,
                    selected_ym_list: Optional[List[str]] = None,
                    selected_embarcadores: Optional[List[str]] = None) -> pd.DataFrame:
-    sheets = parse_excel_bytes(xlsx_bytes)
-    if not sheets:
-        return pd.DataFrame(columns=["tipo_norm","justificativa_atraso","__ym","porto_origem"])
+    return filter_transp_norm(normalize_workbook(xlsx_bytes, "transp"), selected_ym_list, selected_embarcadores)
 
-    df_all = pd.concat(sheets.values(), ignore_index=True)
+# =============================================================================
+# AGREGADOS MENSAIS (materializados no upload)
+# =============================================================================
+# Cada arquivo novo é reduzido, no upload, a contagens por (ym, raiz do embarcador, ...):
+# o filtro por embarcador compara raízes, então agregar pela raiz não perde nada.
+# Remontados, esses agregados dão frames equivalentes aos filtrados p/ KPIs, cubo e e-mail.
+# O booking também gera o catálogo de embarcadores (agg_embarcadores) lido por /api/available-data.
+AGG_VERSION = 3
+AGG_TABLES = {
+    "booking": ("agg_booking", ["ym", "emb_root", "porto_origem", "porto_destino", "qtde", "bookings", "first_pos"]),
+    "transp": ("agg_atrasos", ["ym", "emb_root", "tipo", "justificativa", "porto_origem", "ocorrencias", "first_pos"]),
+    "multi": ("agg_reagendamentos", ["ym", "emb_root", "motivo", "porto_op", "ocorrencias", "first_pos"]),
+}
+CATALOG_COLUMNS = ["ym", "embarcador", "emb_root"]
 
-    col_embarc        = ensure_col(df_all, CANDS_TRANSP_EMB)
-    col_situacao_prog = ensure_col(df_all, CANDS_TRANSP_SIT_PROG)
-    col_situacao_prazo= ensure_col(df_all, CANDS_TRANSP_SIT_PRAZO)
-    col_tipo_prog     = ensure_col(df_all, CANDS_TRANSP_TIPO)
-    col_dt_ref        = ensure_col(df_all, CANDS_TRANSP_DT_REF)
-    col_just_transp   = ensure_col(df_all, CANDS_TRANSP_JUST)
-    col_porto_orig    = ensure_col(df_all, CANDS_TRANSP_PORTO_ORIG)
+def _client_roots(values: pd.Series) -> np.ndarray:
+    """Raiz canônica de cada linha (uma vez por nome distinto, como em client_match_mask)"""
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    roots = np.array([raw_client_root(u) for u in uniques], dtype=object)
+    return roots[codes]
 
-    if col_dt_ref:
-        df_all["__ym"] = df_all[col_dt_ref].apply(extract_period_ym)
-    else:
-        df_all["__ym"] = None
+def _agg_rows(df: pd.DataFrame) -> List[tuple]:
+    """Linhas p/ o banco: NaN -> NULL, inteiros numpy -> int"""
+    return [tuple(None if v is None or (isinstance(v, float) and math.isnan(v))
+                  else int(v) if isinstance(v, (np.integer, int)) else v for v in row)
+            for row in df.itertuples(index=False, name=None)]
 
-    if selected_ym_list:
-        df_all = df_all[df_all["__ym"].isin(selected_ym_list)]
+def booking_aggregates(norm: pd.DataFrame) -> Tuple[List[tuple], bool]:
+    """
+    TEUs e nº de bookings por (ym, raiz, porto_origem, porto_destino), com a mesma regra de
+    filter_booking_norm (soma por booking, portos da linha de maior qtde) aplicada por raiz.
+    exact=False se algum booking mistura embarcadores: aí a soma por raiz pode divergir.
+    """
+    if norm is None or any(c not in norm.columns for c in ("__ym", "emb", "qtde")):
+        return [], True
+    df = norm[norm["ativo"].astype(bool)]
+    df = df[~df["__ym"].isna()].reset_index(drop=True)
+    if df.empty:
+        return [], True
+
+    # posição de cada booking na saída de filter_booking_norm (ordenada por ym, booking_id)
+    df = df.assign(__root=_client_roots(df["emb"]),
+                   __pos=df.groupby(["__ym", "booking_id"], dropna=False).ngroup())
+    exact = not df.groupby(["__ym", "booking_id"], dropna=False)["__root"].nunique(dropna=False).gt(1).any()
+    per_booking = df.groupby(["__ym", "__root", "booking_id"], dropna=False).agg(
+        qtde=("qtde", "sum"), best=("qtde", "idxmax"), pos=("__pos", "min"))
+    best = per_booking["best"].to_numpy()
+    cells = pd.DataFrame({
+        "ym": per_booking.index.get_level_values(0).to_numpy(dtype=object),
+        "emb_root": per_booking.index.get_level_values(1).to_numpy(dtype=object),
+        "porto_origem": df["porto_origem"].to_numpy(dtype=object)[best],
+        "porto_destino": df["porto_destino"].to_numpy(dtype=object)[best],
+        "qtde": per_booking["qtde"].to_numpy(dtype="int64"),
+        "pos": per_booking["pos"].to_numpy(dtype="int64"),
+    })
+    out = cells.groupby(["ym", "emb_root", "porto_origem", "porto_destino"], dropna=False).agg(
+        qtde=("qtde", "sum"), bookings=("qtde", "size"), first_pos=("pos", "min")).reset_index()
+    return _agg_rows(out), bool(exact)
 
-    if selected_embarcadores and col_embarc:
-        mask = pd.Series([False]*len(df_all), index=df_all.index)
-        for emb in selected_embarcadores:
-            mask |= df_all[col_embarc].astype(str).apply(lambda v: client_match(emb, v))
-        df_all = df_all[mask]
+def _count_aggregates(norm: pd.DataFrame, emb_col: str, keys: Dict[str, str]) -> List[tuple]:
+    """Ocorrências (linhas) por (ym, raiz, *keys) de multi/transp; a ordem das linhas é preservada"""
+    df = norm[~norm["__ym"].isna()] if "__ym" in norm.columns else norm.iloc[:0]
+    if df.empty:
+        return []
+    cols = {"ym": df["__ym"].to_numpy(dtype=object),
+            "emb_root": _client_roots(df[emb_col]) if emb_col in df.columns else None}
+    for out_col, src in keys.items():
+        cols[out_col] = df[src].to_numpy(dtype=object)
+    cols["pos"] = np.arange(len(norm))[~norm["__ym"].isna().to_numpy()]
+    out = pd.DataFrame(cols).groupby(["ym", "emb_root", *keys], dropna=False).agg(
+        ocorrencias=("pos", "size"), first_pos=("pos", "min")).reset_index()
+    return _agg_rows(out)
+
+def shipper_names(emb: pd.Series) -> pd.Series:
+    """
+    Nomes de embarcador p/ listar, linha a linha: sem espaços nas pontas e NaN nas células
+    vazias. "nan"/"None" são células vazias de Parquets gravados antes do normalizador
+    preservar o NaN.
+    """
+    names = emb.where(emb.isna(), emb.astype(str)).str.strip()
+    return names.where(names.notna() & (names != "") & ~names.isin(["nan", "None"]))
+
+def booking_catalog(norm: pd.DataFrame) -> List[tuple]:
+    """(ym, embarcador, raiz) distintos das linhas ativas do booking (colunas em CATALOG_COLUMNS)"""
+    if norm is None or "emb" not in norm.columns:
+        return []
+    df = norm[norm["ativo"].astype(bool)]
+    cat = pd.DataFrame({
+        "ym": df["__ym"].to_numpy(dtype=object) if "__ym" in df.columns else None,
+        "embarcador": shipper_names(df["emb"]).to_numpy(dtype=object),
+    }).dropna(subset=["embarcador"]).drop_duplicates()
+    cat["emb_root"] = [_client_root_cached(n) for n in cat["embarcador"]]
+    return _agg_rows(cat[CATALOG_COLUMNS])
+
+def upload_aggregates(norm: pd.DataFrame, kind: str) -> Dict[str, object]:
+    """
+    Agregados de um frame normalizado: {"rows": [...], "exact": bool} (colunas em AGG_TABLES);
+    o booking leva também o catálogo de embarcadores em "catalog".
+    """
+    if kind == "booking":
+        rows, exact = booking_aggregates(norm)
+        return {"rows": rows, "exact": exact, "catalog": booking_catalog(norm)}
+    if kind == "transp":
+        if norm is None or "tipo_norm" not in norm.columns:
+            return {"rows": [], "exact": True}
+        keys = {"tipo": "tipo_norm", "justificativa": "justificativa_atraso", "porto_origem": "porto_origem"}
+        return {"rows": _count_aggregates(norm, "embarcador", keys), "exact": True}
+    if norm is None or norm.empty:
+        return {"rows": [], "exact": True}
+    keys = {"motivo": "motivo_reagenda", "porto_op": "porto_op"}
+    return {"rows": _count_aggregates(norm, "cliente", keys), "exact": True}
 
-    if col_situacao_prog:
-        df_all = df_all[~df_all[col_situacao_prog].astype(str).str.lower().str.contains("cancelad", na=False)]
-    if col_situacao_prazo:
-        df_all = df_all[df_all[col_situacao_prazo].astype(str).str.strip().str.lower() == "atrasado"]
+# =============================================================================
+# CUBO DO RELATÓRIO
+# =============================================================================
+# Uma agregação por frame: KPIs, pivôs dos gráficos, tabelas e seções HTML leem daqui
+# (O(células)) em vez de reagrupar os frames linha a linha. Grupos na ordem de aparição
+# (sort=False) e com NaN (dropna=False): as derivações reproduzem os desempates e
+# exclusões de groupby/value_counts sobre as linhas. O cubo fica associado ao objeto do
+# frame (weakref): frames servidos pelo result_cache reaproveitam o cubo já montado.
+CUBE_SPECS = {
+    # TEUs por (porto_origem, ym, porto_destino)
+    "booking": (["porto_origem", "ym", "porto_destino"], lambda g: g["qtde"].sum()),
+    # ocorrências por (tipo_norm, justificativa_atraso, porto_origem)
+    "atrasos": (["tipo_norm", "justificativa_atraso", "porto_origem"], lambda g: g.size()),
+    # linhas (size) e soma de flag (sum) por (motivo_reagenda, porto_op)
+    "reagendamentos": (["motivo_reagenda", "porto_op"], lambda g: g["flag"].agg(["sum", "size"])),
+}
+_cubes: Dict[Tuple[str, int], Tuple[object, object]] = {}
+_cubes_lock = threading.Lock()
 
-    if not col_tipo_prog:
-        return pd.DataFrame(columns=["tipo_norm","justificativa_atraso","__ym","porto_origem"])
+def report_cube(df: Optional[pd.DataFrame], kind: str):
+    """Cubo `kind` (ver CUBE_SPECS) do frame; None se o frame está vazio ou sem as colunas"""
+    if df is None:
+        return None
+    key = (kind, id(df))
+    with _cubes_lock:
+        hit = _cubes.get(key)
+    if hit is not None and hit[0]() is df:
+        return hit[1]
+
+    keys, agg = CUBE_SPECS[kind]
+    cube = None
+    if len(df) and all(k in df.columns for k in keys):
+        cube = agg(df.groupby(keys, sort=False, dropna=False))
+    ref = weakref.ref(df, lambda _, key=key: _cubes.pop(key, None))
+    with _cubes_lock:
+        _cubes[key] = (ref, cube)
+    return cube
+
+def cube_atrasos(transp_df: pd.DataFrame, tipo: str) -> Optional[pd.Series]:
+    """Ocorrências do tipo por (justificativa_atraso, porto_origem)"""
+    cube = report_cube(transp_df, "atrasos")
+    if cube is None or tipo not in cube.index.get_level_values(0):
+        return None
+    return cube.xs(tipo, level=0)
 
-    df_all["tipo_norm"] = df_all[col_tipo_prog].astype(str).str.strip().str.lower()
-    
-    # Aplicar normalização de justificativa
-    if col_just_transp:
-        df_all["justificativa_atraso"] = df_all[col_just_transp].apply(normalize_justificativa)
-    else:
-        df_all["justificativa_atraso"] = "Sem justificativa"
-        
-    df_all["porto_origem"] = df_all[col_porto_orig].astype(str).str.strip() if col_porto_orig else ""
-    df_all = df_all.drop_duplicates()
+def cube_reagendamentos(multi_df: pd.DataFrame, col: str = "size") -> Optional[pd.Series]:
+    """Reagendamentos por (motivo_reagenda, porto_op): col="size" conta linhas, "sum" soma flag"""
+    cube = report_cube(multi_df, "reagendamentos")
+    return None if cube is None else cube[col]
 
-    return df_all[["tipo_norm","justificativa_atraso","__ym","porto_origem"]].reset_index(drop=True)
+def cube_motivos(counts: Optional[pd.Series]) -> pd.Series:
+    """Totais por motivo (1º nível), como value_counts: sem NaN, do maior p/ o menor"""
+    if counts is None:
+        return pd.Series(dtype="int64")
+    return counts.groupby(level=0, sort=False).sum().sort_values(ascending=False)
 
 # =============================================================================
 # KPIs
 # =============================================================================
 def compute_kpis(booking_df: pd.DataFrame, multi_df: pd.DataFrame, transp_df: pd.DataFrame) -> Dict[str, object]:
+    """
+    KPIs do período a partir do cubo do relatório (porto × mês × destino, tipo × motivo × porto).
+    Além dos totais, devolve os recortes que o e-mail reaproveita em vez de recalcular:
+      por_porto     {porto: TEUs}          (ordem de aparição no booking)
+      por_periodo   {ym: TEUs}
+      porto_periodo {porto: {ym: TEUs}}
+      por_tipo      {tipo_norm: atrasos}
+    """
     total_ops = int(booking_df["qtde"].sum()) if len(booking_df) else 0
 
-    porto_stats = defaultdict(int)
-    for _, row in booking_df.iterrows():
-        porto_stats[row["porto_origem"]] += safe_int(row["qtde"])
-    if porto_stats:
-        porto_top = max(porto_stats.items(), key=lambda x: x[1])[0]
-        porto_low = min(porto_stats.items(), key=lambda x: x[1])[0]
-    else:
-        porto_top = None
-        porto_low = None
+    porto_periodo: Dict[str, Dict[str, int]] = {}
+    por_porto = pd.Series(dtype="int64")
+    por_periodo = pd.Series(dtype="int64")
+    cube = report_cube(booking_df, "booking")
+    if cube is not None:
+        cells = cube.groupby(level=[0, 1], sort=False).sum()
+        por_porto = cells.groupby(level=0, sort=False).sum()
+        por_periodo = cells.groupby(level=1).sum()
+        for (porto, ym), teus in cells.items():
+            porto_periodo.setdefault(porto, {})[ym] = int(teus)
+
+    # idxmax/idxmin: primeiro porto em caso de empate, como antes
+    porto_top = por_porto.idxmax() if len(por_porto) else None
+    porto_low = por_porto.idxmin() if len(por_porto) else None
 
     reagendamentos = int(multi_df["flag"].sum()) if len(multi_df) else 0
-
-    if len(transp_df):
-        coleta_total = (transp_df["tipo_norm"] == "coleta").sum()
-        entrega_total = (transp_df["tipo_norm"] == "entrega").sum()
-    else:
-        coleta_total = 0
-        entrega_total = 0
+    por_tipo = cube_motivos(report_cube(transp_df, "atrasos"))
 
     return {
         "total_ops": total_ops,
         "porto_top": porto_top,
         "porto_low": porto_low,
-        "atrasos_coleta": int(coleta_total),
-        "atrasos_entrega": int(entrega_total),
+        "atrasos_coleta": int(por_tipo.get("coleta", 0)),
+        "atrasos_entrega": int(por_tipo.get("entrega", 0)),
         "reagendamentos": reagendamentos,
+        "por_porto": {p: int(v) for p, v in por_porto.items()},
+        "por_periodo": {ym: int(v) for ym, v in por_periodo.items()},
+        "porto_periodo": porto_periodo,
+        "por_tipo": {t: int(v) for t, v in por_tipo.items()},
     }
 
+def kpi_porto_periodo(kpis: Optional[Dict[str, object]], booking_df: pd.DataFrame, yms: List[str]) -> pd.DataFrame:
+    """TEUs porto × mês (colunas = yms ordenados, portos na ordem de aparição) a partir dos KPIs"""
+    if not kpis or "porto_periodo" not in kpis:
+        kpis = compute_kpis(booking_df, pd.DataFrame(), pd.DataFrame())  # só lê o cubo do booking
+    matrix = pd.DataFrame.from_dict(kpis["porto_periodo"], orient="index")
+    return matrix.reindex(columns=sorted(yms)).fillna(0).astype("int64")
+
 # =============================================================================
 # GRÁFICOS (DPI reduzido para performance)
 # =============================================================================
-def _save_fig_to_b64(fig) -> str:
+_pyplot = None
+
+def _plt():
+    """pyplot (backend Agg) importado no primeiro gráfico: custa ~0,5s e dezenas de MB no boot"""
+    global _pyplot
+    if _pyplot is None:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as pyplot
+        _pyplot = pyplot
+    return _pyplot
+
+def _save_fig_to_png(fig) -> bytes:
     buf = io.BytesIO()
     fig.savefig(buf, format='png', bbox_inches='tight', dpi=100)  # Reduzido de 140 para 100
-    plt.close(fig)
-    buf.seek(0)
-    return base64.b64encode(buf.read()).decode('ascii')
+    _plt().close(fig)
+    return buf.getvalue()
+
+def _png_to_b64(png: bytes) -> str:
+    return base64.b64encode(png).decode('ascii') if png else ""
+
+def _save_fig_to_b64(fig) -> str:
+    return _png_to_b64(_save_fig_to_png(fig))
 
 def safe_format_value(val) -> str:
     if val is None or (isinstance(val, float) and (math.isnan(val) or math.isinf(val))):
@@ -615,16 +1606,52 @@ def safe_format_value(val) -> str:
         return "Sem evidência"
     return str(val)
 
-def chart_movimentacao_por_porto(booking_df: pd.DataFrame, yms: List[str]) -> str:
-    if booking_df.empty or not yms:
-        return ""
-    pivot = booking_df.groupby(["porto_origem", "ym"])["qtde"].sum().unstack(fill_value=0)
+# ---- Pivôs: a parte pandas de cada gráfico (processo principal) ----
+def pivot_movimentacao_por_porto(booking_df: pd.DataFrame, yms: List[str]) -> Optional[pd.DataFrame]:
+    cube = report_cube(booking_df, "booking")
+    if cube is None or not yms:
+        return None
+    pivot = cube.groupby(level=[0, 1]).sum().unstack(fill_value=0)
     pivot = pivot.reindex(columns=sorted(yms), fill_value=0)
     pivot["__total"] = pivot.sum(axis=1)
     pivot = pivot.sort_values("__total", ascending=False).drop("__total", axis=1)
-    if len(pivot) == 0:
-        return ""
-    fig, ax = plt.subplots(figsize=(8, 5), dpi=100)
+    return pivot if len(pivot) else None
+
+def pivot_origem_destino(booking_df: pd.DataFrame) -> Optional[pd.DataFrame]:
+    cube = report_cube(booking_df, "booking")
+    if cube is None:
+        return None
+    pivot = cube.groupby(level=[0, 2]).sum().unstack(fill_value=0)
+    return pivot if len(pivot) else None
+
+def pivot_atrasos_por_motivo_e_porto(transp_df: pd.DataFrame, tipo: str) -> Optional[pd.DataFrame]:
+    counts = cube_atrasos(transp_df, tipo)
+    if counts is None:
+        return None
+    grouped = counts.groupby(level=[0, 1]).sum().reset_index(name="count")
+    top_motivos = grouped.groupby("justificativa_atraso")["count"].sum().nlargest(8).index
+    grouped = grouped[grouped["justificativa_atraso"].isin(top_motivos)]
+    pivot = grouped.pivot_table(index="justificativa_atraso", columns="porto_origem", values="count", fill_value=0)
+    pivot["__total"] = pivot.sum(axis=1)
+    pivot = pivot.sort_values("__total", ascending=True).drop("__total", axis=1)
+    return pivot if len(pivot) else None
+
+def pivot_reagendamentos_por_causa_e_porto(multi_df: pd.DataFrame) -> Optional[pd.DataFrame]:
+    flags = cube_reagendamentos(multi_df, "sum")
+    if flags is None:
+        return None
+    grouped = flags.groupby(level=[0, 1]).sum().rename("flag").reset_index()
+    top_motivos = grouped.groupby("motivo_reagenda")["flag"].sum().nlargest(8).index
+    grouped = grouped[grouped["motivo_reagenda"].isin(top_motivos)]
+    pivot = grouped.pivot_table(index="motivo_reagenda", columns="porto_op", values="flag", fill_value=0)
+    pivot["__total"] = pivot.sum(axis=1)
+    pivot = pivot.sort_values("__total", ascending=True).drop("__total", axis=1)
+    return pivot if len(pivot) else None
+
+# ---- Renderizadores: pivô -> PNG (só matplotlib; rodam no pool de processos) ----
+def render_movimentacao_por_porto(pivot: pd.DataFrame) -> bytes:
+    from matplotlib.ticker import MaxNLocator
+    fig, ax = _plt().subplots(figsize=(8, 5), dpi=100)
     x = np.arange(len(pivot.index))
     width = 0.8 / max(len(pivot.columns), 1)
     colors = ['#1f77b4','#ff7f0e','#2ca02c','#d62728','#9467bd','#8c564b']
@@ -643,15 +1670,10 @@ def chart_movimentacao_por_porto(booking_df: pd.DataFrame, yms: List[str]) -> st
     ax.yaxis.set_major_locator(MaxNLocator(integer=True))
     ax.grid(axis='y', alpha=0.3, linestyle='--')
     fig.tight_layout()
-    return _save_fig_to_b64(fig)
+    return _save_fig_to_png(fig)
 
-def chart_origem_destino(booking_df: pd.DataFrame) -> str:
-    if booking_df.empty:
-        return ""
-    pivot = booking_df.groupby(["porto_origem", "porto_destino"])["qtde"].sum().unstack(fill_value=0)
-    if len(pivot) == 0:
-        return ""
-    fig, ax = plt.subplots(figsize=(10, 6), dpi=120)
+def render_origem_destino(pivot: pd.DataFrame) -> bytes:
+    fig, ax = _plt().subplots(figsize=(10, 6), dpi=120)
     data = []
     row_labels = []
     col_labels = list(pivot.columns)
@@ -674,23 +1696,10 @@ def chart_origem_destino(booking_df: pd.DataFrame) -> str:
     ax.axis('off')
     ax.set_title("Origem x Destino", fontsize=12, fontweight='bold', pad=20)
     fig.tight_layout()
-    return _save_fig_to_b64(fig)
+    return _save_fig_to_png(fig)
 
-def chart_atrasos_por_motivo_e_porto(transp_df: pd.DataFrame, tipo: str) -> str:
-    if transp_df.empty:
-        return ""
-    df_tipo = transp_df[transp_df["tipo_norm"] == tipo]
-    if df_tipo.empty:
-        return ""
-    grouped = df_tipo.groupby(["justificativa_atraso", "porto_origem"]).size().reset_index(name="count")
-    top_motivos = grouped.groupby("justificativa_atraso")["count"].sum().nlargest(8).index
-    grouped = grouped[grouped["justificativa_atraso"].isin(top_motivos)]
-    pivot = grouped.pivot_table(index="justificativa_atraso", columns="porto_origem", values="count", fill_value=0)
-    pivot["__total"] = pivot.sum(axis=1)
-    pivot = pivot.sort_values("__total", ascending=True).drop("__total", axis=1)
-    if len(pivot) == 0:
-        return ""
-    fig, ax = plt.subplots(figsize=(8, 4.5), dpi=100)
+def _render_barh_por_porto(pivot: pd.DataFrame, xlabel: str, title: str) -> bytes:
+    fig, ax = _plt().subplots(figsize=(8, 4.5), dpi=100)
     colors = ['#1f77b4','#ff7f0e','#2ca02c','#d62728','#9467bd']
     x = np.arange(len(pivot))
     width = 0.8 / len(pivot.columns) if len(pivot.columns) > 0 else 0.8
@@ -702,51 +1711,340 @@ def chart_atrasos_por_motivo_e_porto(transp_df: pd.DataFrame, tipo: str) -> str:
                 ax.text(val + max(col_data.values) * 0.02, pos, str(int(val)), ha="left", va="center", fontsize=6)
     ax.set_yticks(x)
     ax.set_yticklabels([_wrap_label(str(lbl), 30) for lbl in pivot.index], fontsize=8)
-    ax.set_xlabel("Ocorrências", fontsize=9)
+    ax.set_xlabel(xlabel, fontsize=9)
     ax.set_ylabel("")
-    ax.set_title(f"Atrasos em {tipo.capitalize()} - Total: {int(pivot.sum().sum())} ocorrências", fontsize=11, fontweight='bold')
+    ax.set_title(title, fontsize=11, fontweight='bold')
     ax.legend(title="Porto", fontsize=7, title_fontsize=8, loc='lower right')
     ax.grid(axis='x', alpha=0.3, linestyle='--')
     fig.tight_layout()
-    return _save_fig_to_b64(fig)
+    return _save_fig_to_png(fig)
 
-def chart_reagendamentos_por_causa_e_porto(multi_df: pd.DataFrame) -> str:
-    if multi_df.empty:
-        return ""
-    grouped = multi_df.groupby(["motivo_reagenda", "porto_op"])["flag"].sum().reset_index()
-    top_motivos = grouped.groupby("motivo_reagenda")["flag"].sum().nlargest(8).index
-    grouped = grouped[grouped["motivo_reagenda"].isin(top_motivos)]
-    pivot = grouped.pivot_table(index="motivo_reagenda", columns="porto_op", values="flag", fill_value=0)
-    pivot["__total"] = pivot.sum(axis=1)
-    pivot = pivot.sort_values("__total", ascending=True).drop("__total", axis=1)
-    if len(pivot) == 0:
+def render_atrasos_por_motivo_e_porto(pivot: pd.DataFrame, tipo: str) -> bytes:
+    return _render_barh_por_porto(
+        pivot, "Ocorrências",
+        f"Atrasos em {tipo.capitalize()} - Total: {int(pivot.sum().sum())} ocorrências",
+    )
+
+def render_reagendamentos_por_causa_e_porto(pivot: pd.DataFrame) -> bytes:
+    return _render_barh_por_porto(
+        pivot, "Quantidade de reagendamentos",
+        f"Reagendamentos - Total: {int(pivot.sum().sum())} ocorrências",
+    )
+
+# ---- Backend HTML: tabelas com barras (sem matplotlib, ~KB em vez de PNG base64) ----
+# SVG inline é removido pelo Gmail/Outlook; tabelas com largura % renderizam em todos.
+_HTML_BAR_COLORS = ['#1f77b4','#ff7f0e','#2ca02c','#d62728','#9467bd','#8c564b']
+
+def _html_bar(val, vmax, color) -> str:
+    pct = int(round(100 * val / vmax)) if vmax > 0 else 0
+    bar = f'<td width="{pct}%" style="background:{color};height:12px;font-size:0;line-height:0;">&nbsp;</td>' if pct > 0 else ''
+    return (
+        '<table width="100%" cellpadding="0" cellspacing="0" style="border-collapse:collapse;"><tr>'
+        f'{bar}<td style="padding-left:4px;font-size:10px;white-space:nowrap;">{int(val) if val > 0 else ""}</td>'
+        '</tr></table>'
+    )
+
+def _html_legend(labels, title: str = "") -> str:
+    items = "".join(
+        f'<span style="display:inline-block;margin-right:12px;white-space:nowrap;">'
+        f'<span style="display:inline-block;width:10px;height:10px;background:{_HTML_BAR_COLORS[i % len(_HTML_BAR_COLORS)]};"></span> {lbl}</span>'
+        for i, lbl in enumerate(labels)
+    )
+    prefix = f"<b>{title}:</b> " if title else ""
+    return f'<div style="font-size:11px;margin:6px 0;">{prefix}{items}</div>'
+
+def _html_grouped_bars(pivot: pd.DataFrame, title: str, series_labels, legend_title: str = "", label_width: int = 30) -> bytes:
+    """Uma linha por índice do pivô, uma barra por coluna (série)"""
+    vmax = float(pivot.values.max()) if pivot.size else 0.0
+    rows = []
+    for idx in pivot.index:
+        bars = "".join(
+            _html_bar(pivot.loc[idx, col], vmax, _HTML_BAR_COLORS[i % len(_HTML_BAR_COLORS)])
+            for i, col in enumerate(pivot.columns)
+        )
+        rows.append(
+            f'<tr><td style="padding:4px 8px;font-size:11px;vertical-align:middle;width:{label_width}%;'
+            f'border-bottom:1px solid #eee;">{idx}</td>'
+            f'<td style="padding:4px 0;border-bottom:1px solid #eee;">{bars}</td></tr>'
+        )
+    html = (
+        f'<div style="font-size:13px;font-weight:bold;margin-bottom:4px;">{title}</div>'
+        + _html_legend(series_labels, legend_title)
+        + '<table width="100%" cellpadding="0" cellspacing="0" style="border-collapse:collapse;">'
+        + "".join(rows) + '</table>'
+    )
+    return html.encode("utf-8")
+
+def html_movimentacao_por_porto(pivot: pd.DataFrame) -> bytes:
+    return _html_grouped_bars(
+        pivot, "Movimentação Mensal por Porto (contêineres)",
+        [format_ym_label(c) for c in pivot.columns], label_width=20,
+    )
+
+def html_origem_destino(pivot: pd.DataFrame) -> bytes:
+    html = '<table border="1" cellpadding="5" cellspacing="0" style="border-collapse:collapse;font-size:11px;">'
+    html += '<thead><tr style="background-color:#1f77b4;color:white;"><th>Origem × Destino</th>'
+    html += "".join(f'<th>{d}</th>' for d in pivot.columns)
+    html += '</tr></thead><tbody>'
+    for origem in pivot.index:
+        html += f'<tr><td><b>{origem}</b></td>'
+        for destino in pivot.columns:
+            val = pivot.loc[origem, destino]
+            val = int(val) if val > 0 else 0
+            bg = "background:#e6f2ff;" if val > 0 else ""
+            html += f'<td style="text-align:center;{bg}">{val}</td>'
+        html += '</tr>'
+    html += '</tbody></table>'
+    return html.encode("utf-8")
+
+def html_atrasos_por_motivo_e_porto(pivot: pd.DataFrame, tipo: str) -> bytes:
+    # O pivô vem em ordem crescente (barh desenha de baixo p/ cima); na tabela o maior vai no topo
+    return _html_grouped_bars(
+        pivot.iloc[::-1],
+        f"Atrasos em {tipo.capitalize()} - Total: {int(pivot.sum().sum())} ocorrências",
+        [safe_format_value(c) for c in pivot.columns], "Porto",
+    )
+
+def html_reagendamentos_por_causa_e_porto(pivot: pd.DataFrame) -> bytes:
+    return _html_grouped_bars(
+        pivot.iloc[::-1],
+        f"Reagendamentos - Total: {int(pivot.sum().sum())} ocorrências",
+        [safe_format_value(c) for c in pivot.columns], "Porto",
+    )
+
+# ---- Backends de gráfico: nome do gráfico -> renderizador ----
+# "matplotlib" (padrão) gera PNG; "html" gera tabelas inline, leves e sem pool.
+CHART_RENDERERS = {
+    "matplotlib": {
+        "movimentacao": render_movimentacao_por_porto,
+        "origem_destino": render_origem_destino,
+        "atrasos": render_atrasos_por_motivo_e_porto,
+        "reagendamentos": render_reagendamentos_por_causa_e_porto,
+    },
+    "html": {
+        "movimentacao": html_movimentacao_por_porto,
+        "origem_destino": html_origem_destino,
+        "atrasos": html_atrasos_por_motivo_e_porto,
+        "reagendamentos": html_reagendamentos_por_causa_e_porto,
+    },
+}
+_INLINE_RENDERERS = set(CHART_RENDERERS["html"].values())
+CHART_BACKEND = os.getenv("CHART_BACKEND", "matplotlib").strip().lower()
+
+def resolve_chart_backend(backend: Optional[str] = None) -> str:
+    name = (backend or CHART_BACKEND).strip().lower()
+    if name not in CHART_RENDERERS:
+        print(f"[CHARTS] WARN: backend '{name}' desconhecido, usando matplotlib")
+        return "matplotlib"
+    return name
+
+def _chart_output(renderer, data: bytes) -> str:
+    """PNG -> base64 (p/ <img>); HTML -> fragmento pronto p/ o corpo do e-mail"""
+    if renderer in _INLINE_RENDERERS:
+        return data.decode("utf-8")
+    return _png_to_b64(data)
+
+def _render_one(chart: str, pivot: Optional[pd.DataFrame], args: tuple, backend: Optional[str]) -> str:
+    if pivot is None:
         return ""
-    fig, ax = plt.subplots(figsize=(8, 4.5), dpi=100)
-    colors = ['#1f77b4','#ff7f0e','#2ca02c','#d62728','#9467bd']
-    x = np.arange(len(pivot))
-    width = 0.8 / len(pivot.columns) if len(pivot.columns) > 0 else 0.8
-    for i, (col_name, col_data) in enumerate(pivot.items()):
-        offset = x + (i - len(pivot.columns)/2 + 0.5) * width
-        ax.barh(offset, col_data.values, width * 0.95, label=safe_format_value(col_name), color=colors[i % len(colors)])
-        for pos, val in zip(offset, col_data.values):
-            if val > 0:
-                ax.text(val + max(col_data.values) * 0.02, pos, str(int(val)), ha="left", va="center", fontsize=6)
-    ax.set_yticks(x)
-    ax.set_yticklabels([_wrap_label(str(lbl), 30) for lbl in pivot.index], fontsize=8)
-    ax.set_xlabel("Quantidade de reagendamentos", fontsize=9)
-    ax.set_ylabel("")
-    ax.set_title(f"Reagendamentos - Total: {int(pivot.sum().sum())} ocorrências", fontsize=11, fontweight='bold')
-    ax.legend(title="Porto", fontsize=7, title_fontsize=8, loc='lower right')
-    ax.grid(axis='x', alpha=0.3, linestyle='--')
-    fig.tight_layout()
-    return _save_fig_to_b64(fig)
+    renderer = CHART_RENDERERS[resolve_chart_backend(backend)][chart]
+    return _chart_output(renderer, renderer(pivot, *args))
+
+# ---- API antiga: DataFrame -> gráfico (PNG base64 por padrão), tudo no processo atual ----
+def chart_movimentacao_por_porto(booking_df: pd.DataFrame, yms: List[str], backend: Optional[str] = None) -> str:
+    return _render_one("movimentacao", pivot_movimentacao_por_porto(booking_df, yms), (), backend)
+
+def chart_origem_destino(booking_df: pd.DataFrame, backend: Optional[str] = None) -> str:
+    return _render_one("origem_destino", pivot_origem_destino(booking_df), (), backend)
+
+def chart_atrasos_por_motivo_e_porto(transp_df: pd.DataFrame, tipo: str, backend: Optional[str] = None) -> str:
+    return _render_one("atrasos", pivot_atrasos_por_motivo_e_porto(transp_df, tipo), (tipo,), backend)
+
+def chart_reagendamentos_por_causa_e_porto(multi_df: pd.DataFrame, backend: Optional[str] = None) -> str:
+    return _render_one("reagendamentos", pivot_reagendamentos_por_causa_e_porto(multi_df), (), backend)
+
+# ---- Pool de renderização ----
+# Cada gráfico é um job independente: recebe só o pivô e devolve os bytes do PNG.
+# Os workers saem de um forkserver (processo de uma thread só que já importou este módulo):
+# fork direto daqui, com threads de I/O/jobs/IA rodando, pode herdar um lock preso (ex.: o
+# do stdout nos prints) e travar o worker.
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", str(min(4, os.cpu_count() or 1))))
+_chart_pool = None
+_forkserver_lock = threading.Lock()
+# Pools/executors são criados no primeiro uso, que pode vir de várias threads ao mesmo tempo
+_executors_lock = threading.RLock()
+
+def new_process_pool(workers: int):
+    """ProcessPoolExecutor com forkserver onde houver (módulo pré-carregado uma vez no servidor)"""
+    import multiprocessing
+    from multiprocessing import forkserver
+    from concurrent.futures import ProcessPoolExecutor
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=workers)
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload([__name__])
+    with _forkserver_lock:
+        # o forkserver herda o ambiente de quando sobe: a marca vale só p/ ele e os workers
+        os.environ[_POOL_CHILD_ENV] = "1"
+        try:
+            forkserver.ensure_running()
+        finally:
+            os.environ.pop(_POOL_CHILD_ENV, None)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+
+def _get_chart_pool():
+    """Pool limitado a CHART_WORKERS processos, criado no primeiro uso; None = renderiza no processo atual"""
+    global _chart_pool
+    if CHART_WORKERS <= 1:
+        return None
+    with _executors_lock:
+        if _chart_pool is None:
+            _chart_pool = new_process_pool(CHART_WORKERS)
+        return _chart_pool
+
+def _reset_chart_pool():
+    global _chart_pool
+    with _executors_lock:
+        pool, _chart_pool = _chart_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+# ---- Cache de PNGs: tipo do gráfico + hash do pivô ----
+# Memória limitada por bytes; disco opcional (CHART_CACHE_DIR) sobrevive a restarts/workers.
+CHART_CACHE_MB = float(os.getenv("CHART_CACHE_MB", "16"))
+CHART_CACHE_DIR = os.getenv("CHART_CACHE_DIR", "").strip()
+CHART_CACHE_DISK_MB = float(os.getenv("CHART_CACHE_DISK_MB", "256"))
+CHART_RENDER_VERSION = "1"  # incrementar ao mudar o visual dos renderizadores
+chart_cache = ByteBudgetCache(max_bytes=int(CHART_CACHE_MB * 1024 * 1024), ttl=6 * 3600)
+
+def chart_cache_key(renderer, pivot: pd.DataFrame, args: tuple) -> str:
+    """sha256 de renderizador + args + pivô (índice, colunas, dtypes e valores)"""
+    h = hashlib.sha256()
+    h.update(f"{CHART_RENDER_VERSION}|{renderer.__name__}|{args!r}|".encode("utf-8"))
+    h.update(repr([(str(c), str(t)) for c, t in pivot.dtypes.items()]).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(pivot, index=True).values.tobytes())
+    return h.hexdigest()
+
+def _chart_disk_path(key: str) -> str:
+    return os.path.join(CHART_CACHE_DIR, f"{key}.png")
+
+def _prune_chart_disk() -> None:
+    """Remove os PNGs mais antigos quando o diretório passa de CHART_CACHE_DISK_MB"""
+    budget = int(CHART_CACHE_DISK_MB * 1024 * 1024)
+    entries = []
+    with os.scandir(CHART_CACHE_DIR) as it:
+        for e in it:
+            if e.name.endswith(".png"):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
 
-def generate_variacao_table(booking_df: pd.DataFrame, yms: List[str]) -> str:
+def chart_cache_get(key: str) -> Optional[bytes]:
+    png = chart_cache.get(key)
+    if png is not None or not CHART_CACHE_DIR:
+        return png
+    try:
+        with open(_chart_disk_path(key), "rb") as f:
+            png = f.read()
+    except OSError:
+        return None
+    chart_cache[key] = png
+    return png
+
+def chart_cache_put(key: str, png: bytes) -> None:
+    chart_cache[key] = png
+    if not CHART_CACHE_DIR:
+        return
+    try:
+        os.makedirs(CHART_CACHE_DIR, exist_ok=True)
+        tmp = f"{_chart_disk_path(key)}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(png)
+        os.replace(tmp, _chart_disk_path(key))
+        _prune_chart_disk()
+    except OSError as e:
+        print(f"[CHART CACHE] WARN: falha ao gravar em disco: {e}")
+
+def submit_chart_renders(jobs: Dict[str, Tuple[object, Optional[pd.DataFrame], tuple]]) -> Dict[str, Tuple[object, Optional[str]]]:
+    """
+    Dispara os gráficos em paralelo. `jobs` = {nome: (renderizador, pivô, args extras)};
+    pivô None = gráfico vazio. Gráficos já em cache não passam pelo matplotlib.
+    Devolve {nome: (future, chave do cache)} p/ collect_chart_renders.
+    """
+    from concurrent.futures import Future
+    pool = _get_chart_pool()
+    futures = {}
+    for name, (renderer, pivot, args) in jobs.items():
+        key = None
+        fut = None
+        if pivot is None:
+            png = b""
+        elif renderer in _INLINE_RENDERERS:  # barato: não vale hash, cache nem pool
+            png = renderer(pivot, *args)
+        else:
+            key = chart_cache_key(renderer, pivot, args)
+            png = chart_cache_get(key)
+            if png is None and pool is not None:
+                try:
+                    fut = pool.submit(renderer, pivot, *args)
+                except RuntimeError:  # pool quebrado/encerrado: segue sem ele
+                    _reset_chart_pool()
+                    pool = None
+            if png is None and fut is None:
+                png = renderer(pivot, *args)
+                chart_cache_put(key, png)
+        if fut is None:  # vazio, cache ou render local: nada a gravar depois
+            fut = Future()
+            fut.set_result(png)
+            key = None
+        futures[name] = (fut, key)
+    return futures
+
+def collect_chart_renders(futures: Dict[str, Tuple[object, Optional[str]]],
+                          jobs: Dict[str, Tuple[object, Optional[pd.DataFrame], tuple]]) -> Dict[str, str]:
+    """Espera os gráficos e devolve {nome: PNG base64 ou HTML}; se um worker morrer, refaz no processo atual"""
+    from concurrent.futures.process import BrokenProcessPool
+    out = {}
+    for name, (fut, key) in futures.items():
+        try:
+            png = fut.result()
+        except BrokenProcessPool:
+            _reset_chart_pool()
+            renderer, pivot, args = jobs[name]
+            png = renderer(pivot, *args)
+        if key is not None:
+            chart_cache_put(key, png)
+        out[name] = _chart_output(jobs[name][0], png)
+    return out
+
+def render_charts(jobs: Dict[str, Tuple[object, Optional[pd.DataFrame], tuple]]) -> Dict[str, str]:
+    return collect_chart_renders(submit_chart_renders(jobs), jobs)
+
+def email_chart_jobs(yms: List[str], booking_df: pd.DataFrame, transp_df: pd.DataFrame,
+                     multi_df: pd.DataFrame, backend: Optional[str] = None) -> Dict[str, Tuple[object, Optional[pd.DataFrame], tuple]]:
+    """Os cinco gráficos do e-mail como jobs (pivôs montados aqui, render no pool)"""
+    r = CHART_RENDERERS[resolve_chart_backend(backend)]
+    return {
+        "movimentacao":  (r["movimentacao"], pivot_movimentacao_por_porto(booking_df, yms), ()),
+        "origem_dest":   (r["origem_destino"], pivot_origem_destino(booking_df), ()),
+        "atraso_coleta": (r["atrasos"], pivot_atrasos_por_motivo_e_porto(transp_df, "coleta"), ("coleta",)),
+        "atraso_entrega": (r["atrasos"], pivot_atrasos_por_motivo_e_porto(transp_df, "entrega"), ("entrega",)),
+        "reagendamentos": (r["reagendamentos"], pivot_reagendamentos_por_causa_e_porto(multi_df), ()),
+    }
+
+def generate_variacao_table(booking_df: pd.DataFrame, yms: List[str], kpis: Optional[Dict[str, object]] = None) -> str:
     if booking_df.empty or len(yms) < 2:
         return ""
     yms_sorted = sorted(yms)
-    pivot = booking_df.groupby(["porto_origem", "ym"])["qtde"].sum().unstack(fill_value=0)
-    pivot = pivot.reindex(columns=yms_sorted, fill_value=0)
+    pivot = kpi_porto_periodo(kpis, booking_df, yms).sort_index()
     html_rows = []
     for porto in pivot.index:
         row_data = {"Porto": porto}
@@ -784,35 +2082,36 @@ def generate_variacao_table(booking_df: pd.DataFrame, yms: List[str]) -> str:
 # =============================================================================
 # NOVAS FUNÇÕES - DETALHAMENTO POR PORTO
 # =============================================================================
-def generate_detalhamento_por_porto_html(df: pd.DataFrame, tipo: str, col_justificativa: str, col_porto: str) -> str:
+def generate_detalhamento_por_porto_html(counts: Optional[pd.Series], tipo: str) -> str:
     """
-    Gera HTML com detalhamento de atrasos/reagendas por porto
+    Gera HTML com detalhamento de atrasos/reagendas por porto, a partir das contagens
+    (justificativa, porto) do cubo do relatório
     Exemplo:
     MAO (44 atrasos)
       • Falta de documento do cliente: 10
       • Problemas com o DEPOT: 3
       • Sem justificativa: 29
     """
-    if df.empty:
+    if counts is None or counts.empty:
         return "<p><i>Nenhum registro encontrado.</i></p>"
     
     html_parts = ["<div style='margin-top:20px;padding:15px;background:#f8f9fa;border-radius:8px;'>"]
     html_parts.append(f"<h4 style='color:#1976d2;margin-top:0;'>📍 Detalhamento por Porto</h4>")
     
-    # Agrupar por porto
-    grouped_porto = df.groupby(col_porto)
+    # Agrupar por porto (o total inclui linhas sem justificativa, a lista não)
+    totais_porto = counts.groupby(level=1).sum()
     
-    for porto, grupo in grouped_porto:
+    for porto, total_porto in totais_porto.items():
+        grupo = counts.xs(porto, level=1)
         if not porto or str(porto).strip() == "":
             porto = "Porto não identificado"
         
-        total_porto = len(grupo)
         html_parts.append(f"<div style='margin-bottom:20px;padding:12px;background:white;border-left:3px solid #1f77b4;'>")
-        html_parts.append(f"<h5 style='color:#333;margin-top:0;'><b>{porto}</b> ({total_porto} {tipo})</h5>")
+        html_parts.append(f"<h5 style='color:#333;margin-top:0;'><b>{porto}</b> ({int(total_porto)} {tipo})</h5>")
         html_parts.append("<ul style='margin:8px 0;padding-left:20px;'>")
         
         # Contar justificativas
-        contagem = grupo[col_justificativa].value_counts()
+        contagem = cube_motivos(grupo)
         for justif, count in contagem.items():
             html_parts.append(f"<li style='margin:4px 0;'><b>{justif}</b>: {int(count)}</li>")
         
@@ -821,7 +2120,8 @@ def generate_detalhamento_por_porto_html(df: pd.DataFrame, tipo: str, col_justif
     html_parts.append("</div>")
     return "".join(html_parts)
 
-def generate_tendencias_movimentacao_html(booking_df: pd.DataFrame, yms: List[str]) -> str:
+def generate_tendencias_movimentacao_html(booking_df: pd.DataFrame, yms: List[str],
+                                          kpis: Optional[Dict[str, object]] = None) -> str:
     """
     Gera seção de Tendências de Movimentação com análise de crescimento
     """
@@ -829,10 +2129,8 @@ def generate_tendencias_movimentacao_html(booking_df: pd.DataFrame, yms: List[st
         return "<p><i>Dados insuficientes para análise de tendências (mínimo 2 períodos).</i></p>"
     
     yms_sorted = sorted(yms)
-    volumes = []
-    for ym in yms_sorted:
-        vol = booking_df[booking_df['ym'] == ym]['qtde'].sum()
-        volumes.append(int(vol))
+    matrix = kpi_porto_periodo(kpis, booking_df, yms)
+    volumes = [int(v) for v in matrix.sum(axis=0)]
     
     # Calcular variação total
     variacao_total = ((volumes[-1] - volumes[0]) / volumes[0] * 100) if volumes[0] > 0 else 0
@@ -872,10 +2170,7 @@ def generate_tendencias_movimentacao_html(booking_df: pd.DataFrame, yms: List[st
         
         # Porto com maior crescimento
         porto_crescimento = {}
-        for porto in booking_df['porto_origem'].unique():
-            df_porto = booking_df[booking_df['porto_origem'] == porto]
-            vol_inicio = df_porto[df_porto['ym'] == yms_sorted[0]]['qtde'].sum()
-            vol_fim = df_porto[df_porto['ym'] == yms_sorted[-1]]['qtde'].sum()
+        for porto, vol_inicio, vol_fim in zip(matrix.index, matrix[yms_sorted[0]], matrix[yms_sorted[-1]]):
             if vol_inicio > 0:
                 crescimento = ((vol_fim - vol_inicio) / vol_inicio * 100)
                 porto_crescimento[porto] = crescimento
@@ -924,12 +2219,11 @@ def generate_alinhamento_operacional_html(kpis: Dict, transp_df: pd.DataFrame, m
     html_parts.append(f"• Total de atrasos: <b style='color:#d32f2f;'>{atrasos_coleta}</b><br>")
     html_parts.append(f"• Taxa de atraso: <b style='color:#d32f2f;'>{taxa_atraso_coleta:.2f}%</b><br>")
     
-    if not transp_df.empty:
-        df_coleta = transp_df[transp_df['tipo_norm'] == 'coleta']
-        if not df_coleta.empty:
-            top_causa_coleta = df_coleta['justificativa_atraso'].value_counts().iloc[0]
-            top_causa_nome = df_coleta['justificativa_atraso'].value_counts().index[0]
-            html_parts.append(f"• Principal causa: <b>{top_causa_nome}</b> ({int(top_causa_coleta)} ocorrências)<br>")
+    causas_coleta = cube_motivos(cube_atrasos(transp_df, 'coleta'))
+    if len(causas_coleta):
+        top_causa_coleta = causas_coleta.iloc[0]
+        top_causa_nome = causas_coleta.index[0]
+        html_parts.append(f"• Principal causa: <b>{top_causa_nome}</b> ({int(top_causa_coleta)} ocorrências)<br>")
     
     html_parts.append("</p>")
     
@@ -939,12 +2233,11 @@ def generate_alinhamento_operacional_html(kpis: Dict, transp_df: pd.DataFrame, m
     html_parts.append(f"• Total de atrasos: <b style='color:#d32f2f;'>{atrasos_entrega}</b><br>")
     html_parts.append(f"• Taxa de atraso: <b style='color:#d32f2f;'>{taxa_atraso_entrega:.2f}%</b><br>")
     
-    if not transp_df.empty:
-        df_entrega = transp_df[transp_df['tipo_norm'] == 'entrega']
-        if not df_entrega.empty:
-            top_causa_entrega = df_entrega['justificativa_atraso'].value_counts().iloc[0]
-            top_causa_nome_ent = df_entrega['justificativa_atraso'].value_counts().index[0]
-            html_parts.append(f"• Principal causa: <b>{top_causa_nome_ent}</b> ({int(top_causa_entrega)} ocorrências)<br>")
+    causas_entrega = cube_motivos(cube_atrasos(transp_df, 'entrega'))
+    if len(causas_entrega):
+        top_causa_entrega = causas_entrega.iloc[0]
+        top_causa_nome_ent = causas_entrega.index[0]
+        html_parts.append(f"• Principal causa: <b>{top_causa_nome_ent}</b> ({int(top_causa_entrega)} ocorrências)<br>")
     
     html_parts.append("</p>")
     
@@ -954,9 +2247,10 @@ def generate_alinhamento_operacional_html(kpis: Dict, transp_df: pd.DataFrame, m
     html_parts.append(f"• Total de reagendamentos: <b style='color:#f57c00;'>{reagendamentos}</b><br>")
     html_parts.append(f"• Taxa de reagendamento: <b style='color:#f57c00;'>{taxa_reagendamento:.2f}%</b><br>")
     
-    if not multi_df.empty:
-        top_causa_reag = multi_df['motivo_reagenda'].value_counts().iloc[0]
-        top_causa_nome_reag = multi_df['motivo_reagenda'].value_counts().index[0]
+    causas_reag = cube_motivos(cube_reagendamentos(multi_df))
+    if len(causas_reag):
+        top_causa_reag = causas_reag.iloc[0]
+        top_causa_nome_reag = causas_reag.index[0]
         html_parts.append(f"• Principal causa: <b>{top_causa_nome_reag}</b> ({int(top_causa_reag)} ocorrências)<br>")
     
     html_parts.append("</p>")
@@ -1036,58 +2330,67 @@ def generate_default_recomendacoes(kpis: Dict) -> str:
     recs.append("• Manter monitoramento contínuo dos indicadores operacionais")
     return "\n".join(recs)
 
-def generate_ai_email_analysis(kpis: Dict[str, object], yms: List[str],
-                               booking_df: pd.DataFrame, transp_df: pd.DataFrame,
-                               multi_df: pd.DataFrame, embarcadores: List[str]) -> Dict[str, str]:
-    if not gemini_model:
-        return {
-            'analise_geral': generate_default_analise_geral(kpis, yms),
-            'pontos_criticos': generate_default_pontos_criticos(kpis, transp_df, multi_df),
-            'recomendacoes': generate_default_recomendacoes(kpis),
-            'conclusao': default_conclusao(kpis)
-        }
-    try:
-        periodo_label = format_periodos_label(yms)
-        emb_label = ", ".join(embarcadores)
-
-        tendencia_volume = ""
-        serie_volumes = ""
-        if not booking_df.empty and len(yms) >= 2:
-            yms_sorted = sorted(yms)
-            volumes = []
-            for ym in yms_sorted:
-                vol = booking_df[booking_df['ym'] == ym]['qtde'].sum()
-                volumes.append(int(vol))
-            if len(volumes) >= 2:
-                variacao = ((volumes[-1] - volumes[0]) / volumes[0] * 100) if volumes[0] > 0 else 0
-                tendencia_volume = f"Variação: {variacao:+.1f}% ({volumes[0]} → {volumes[-1]} TEUs)"
-                serie_volumes = " → ".join([f"{format_ym_label(yms_sorted[i])}: {volumes[i]}" for i in range(len(volumes))])
-
-        top_atrasos_coleta = ""
-        if not transp_df.empty:
-            df_coleta = transp_df[transp_df['tipo_norm'] == 'coleta']
-            if not df_coleta.empty:
-                top_5 = df_coleta['justificativa_atraso'].value_counts().head(5)
-                top_atrasos_coleta = "\n".join([f"  • {motivo}: {count} ocorrências" for motivo, count in top_5.items()])
-
-        top_atrasos_entrega = ""
-        if not transp_df.empty:
-            df_entrega = transp_df[transp_df['tipo_norm'] == 'entrega']
-            if not df_entrega.empty:
-                top_5 = df_entrega['justificativa_atraso'].value_counts().head(5)
-                top_atrasos_entrega = "\n".join([f"  • {motivo}: {count} ocorrências" for motivo, count in top_5.items()])
-
-        top_reagendamentos = ""
-        if not multi_df.empty:
-            top_5_reag = multi_df['motivo_reagenda'].value_counts().head(5)
-            top_reagendamentos = "\n".join([f"  • {motivo}: {int(count)} ocorrências" for motivo, count in top_5_reag.items()])
-
-        portos_volume = ""
-        if not booking_df.empty:
-            porto_stats = booking_df.groupby('porto_origem')['qtde'].sum().sort_values(ascending=False)
-            portos_volume = "\n".join([f"  • {porto}: {int(qtde)} TEUs" for porto, qtde in porto_stats.head(5).items()])
-
-        prompt = f"""
+# ---- Análise com IA (Gemini) ----
+# A chamada ao Gemini roda num pool de threads próprio, com prazo (AI_TIMEOUT_S): estourou,
+# o e-mail sai com o texto padrão e a resposta, quando chegar, fica em cache pelo hash do
+# prompt. Prompts iguais em andamento compartilham a mesma chamada.
+AI_TIMEOUT_S = float(os.getenv("AI_TIMEOUT_S", "20"))
+AI_JOB_TIMEOUT_S = float(os.getenv("AI_JOB_TIMEOUT_S", "120"))
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "2"))
+ai_cache = ByteBudgetCache(max_bytes=4 * 1024 * 1024, ttl=6 * 3600)
+ai_jobs = TTLCache(maxsize=256, ttl=1800)  # e-mails com IA pendente (defer_ai)
+_ai_executor = None
+_ai_inflight: Dict[str, object] = {}
+_ai_lock = threading.RLock()
+
+def default_email_analysis(kpis: Dict[str, object], yms: List[str],
+                           transp_df: pd.DataFrame, multi_df: pd.DataFrame) -> Dict[str, str]:
+    return {
+        'analise_geral': generate_default_analise_geral(kpis, yms),
+        'pontos_criticos': generate_default_pontos_criticos(kpis, transp_df, multi_df),
+        'recomendacoes': generate_default_recomendacoes(kpis),
+        'conclusao': default_conclusao(kpis)
+    }
+
+def build_ai_prompt(kpis: Dict[str, object], yms: List[str],
+                    booking_df: pd.DataFrame, transp_df: pd.DataFrame,
+                    multi_df: pd.DataFrame, embarcadores: List[str]) -> str:
+    periodo_label = format_periodos_label(yms)
+    emb_label = ", ".join(embarcadores)
+
+    tendencia_volume = ""
+    serie_volumes = ""
+    if not booking_df.empty and len(yms) >= 2:
+        yms_sorted = sorted(yms)
+        por_periodo = kpis.get("por_periodo") or compute_kpis(booking_df, pd.DataFrame(), pd.DataFrame())["por_periodo"]
+        volumes = [int(por_periodo.get(ym, 0)) for ym in yms_sorted]
+        if len(volumes) >= 2:
+            variacao = ((volumes[-1] - volumes[0]) / volumes[0] * 100) if volumes[0] > 0 else 0
+            tendencia_volume = f"Variação: {variacao:+.1f}% ({volumes[0]} → {volumes[-1]} TEUs)"
+            serie_volumes = " → ".join([f"{format_ym_label(yms_sorted[i])}: {volumes[i]}" for i in range(len(volumes))])
+
+    top_atrasos_coleta = ""
+    top_5 = cube_motivos(cube_atrasos(transp_df, 'coleta')).head(5)
+    if len(top_5):
+        top_atrasos_coleta = "\n".join([f"  • {motivo}: {count} ocorrências" for motivo, count in top_5.items()])
+
+    top_atrasos_entrega = ""
+    top_5 = cube_motivos(cube_atrasos(transp_df, 'entrega')).head(5)
+    if len(top_5):
+        top_atrasos_entrega = "\n".join([f"  • {motivo}: {count} ocorrências" for motivo, count in top_5.items()])
+
+    top_reagendamentos = ""
+    top_5_reag = cube_motivos(cube_reagendamentos(multi_df)).head(5)
+    if len(top_5_reag):
+        top_reagendamentos = "\n".join([f"  • {motivo}: {int(count)} ocorrências" for motivo, count in top_5_reag.items()])
+
+    portos_volume = ""
+    if not booking_df.empty:
+        por_porto = kpis.get("por_porto") or compute_kpis(booking_df, pd.DataFrame(), pd.DataFrame())["por_porto"]
+        porto_stats = pd.Series(por_porto, dtype="int64").sort_index().sort_values(ascending=False)
+        portos_volume = "\n".join([f"  • {porto}: {int(qtde)} TEUs" for porto, qtde in porto_stats.head(5).items()])
+
+    prompt = f"""
 Você é um analista sênior de operações logísticas com 15 anos de experiência. Analise os dados operacionais abaixo e gere um relatório executivo profissional em português.
 
 === CONTEXTO ===
@@ -1148,84 +2451,163 @@ IMPORTANTE:
 - Foque em insights acionáveis
 - Mantenha tom construtivo e orientado a soluções
 """
-        response = gemini_model.generate_content(prompt)
-        ai_text = response.text.strip()
-
-        sections = {
-            'analise_geral': '',
-            'pontos_criticos': '',
-            'recomendacoes': '',
-            'conclusao': ''
-        }
+    return prompt
+
+def parse_ai_sections(ai_text: str) -> Dict[str, str]:
+    sections = {
+        'analise_geral': '',
+        'pontos_criticos': '',
+        'recomendacoes': '',
+        'conclusao': ''
+    }
 
-        current_section = None
-        lines = ai_text.split('\n')
-        for line in lines:
-            line_lower = line.lower().strip()
-            if 'seção 1' in line_lower or 'análise geral' in line_lower or 'analise geral' in line_lower:
-                current_section = 'analise_geral'; continue
-            elif 'seção 2' in line_lower or 'pontos críticos' in line_lower or 'pontos criticos' in line_lower:
-                current_section = 'pontos_criticos'; continue
-            elif 'seção 3' in line_lower or 'recomendações' in line_lower or 'recomendacoes' in line_lower:
-                current_section = 'recomendacoes'; continue
-            elif 'seção 4' in line_lower or 'conclusão' in line_lower or 'conclusao' in line_lower:
-                current_section = 'conclusao'; continue
-            if current_section and line.strip():
-                clean_line = line.replace('**', '').strip()
-                if clean_line and not clean_line.startswith('SEÇÃO'):
-                    sections[current_section] += clean_line + '\n'
-
-        for key in sections:
-            sections[key] = sections[key].strip()
-
-        if len(sections['analise_geral']) < 100:
-            raise Exception("Resposta da IA muito curta")
-
-        return sections
+    current_section = None
+    lines = ai_text.split('\n')
+    for line in lines:
+        line_lower = line.lower().strip()
+        if 'seção 1' in line_lower or 'análise geral' in line_lower or 'analise geral' in line_lower:
+            current_section = 'analise_geral'; continue
+        elif 'seção 2' in line_lower or 'pontos críticos' in line_lower or 'pontos criticos' in line_lower:
+            current_section = 'pontos_criticos'; continue
+        elif 'seção 3' in line_lower or 'recomendações' in line_lower or 'recomendacoes' in line_lower:
+            current_section = 'recomendacoes'; continue
+        elif 'seção 4' in line_lower or 'conclusão' in line_lower or 'conclusao' in line_lower:
+            current_section = 'conclusao'; continue
+        if current_section and line.strip():
+            clean_line = line.replace('**', '').strip()
+            if clean_line and not clean_line.startswith('SEÇÃO'):
+                sections[current_section] += clean_line + '\n'
+
+    for key in sections:
+        sections[key] = sections[key].strip()
+
+    if len(sections['analise_geral']) < 100:
+        raise Exception("Resposta da IA muito curta")
+
+    return sections
+
+def _call_gemini(model, prompt: str) -> Dict[str, str]:
+    response = model.generate_content(prompt)
+    return parse_ai_sections(response.text.strip())
+
+def _get_ai_executor():
+    global _ai_executor
+    if _ai_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _ai_executor = ThreadPoolExecutor(max_workers=max(1, AI_MAX_CONCURRENCY), thread_name_prefix="gemini")
+    return _ai_executor
+
+def _ai_done(key: str, fut) -> None:
+    with _ai_lock:
+        _ai_inflight.pop(key, None)
+    if fut.cancelled():
+        return
+    if fut.exception() is not None:
+        print(f"[WARN] Erro ao gerar análise com IA: {fut.exception()}")
+        return
+    ai_cache[key] = fut.result()
+
+def submit_ai_analysis(kpis: Dict[str, object], yms: List[str],
+                       booking_df: pd.DataFrame, transp_df: pd.DataFrame,
+                       multi_df: pd.DataFrame, embarcadores: List[str]):
+    """
+    Dispara a análise com IA sem esperar. Devolve um Future com as seções
+    (já resolvido se estiver em cache) ou None se a IA não estiver configurada.
+    """
+    from concurrent.futures import Future
+    model = get_gemini_model()
+    if not model:
+        return None
+    prompt = build_ai_prompt(kpis, yms, booking_df, transp_df, multi_df, embarcadores)
+    key = hashlib.sha256(f"{GEMINI_MODEL}\n{prompt}".encode("utf-8")).hexdigest()
+    hit = ai_cache.get(key)
+    if hit is not None:
+        fut = Future()
+        fut.set_result(hit)
+        return fut
+    with _ai_lock:
+        fut = _ai_inflight.get(key)
+        if fut is None:
+            fut = _get_ai_executor().submit(_call_gemini, model, prompt)
+            _ai_inflight[key] = fut
+            fut.add_done_callback(lambda f, key=key: _ai_done(key, f))
+    return fut
 
-    except Exception as e:
-        print(f"[WARN] Erro ao gerar análise com IA: {e}")
-        return {
-            'analise_geral': generate_default_analise_geral(kpis, yms),
-            'pontos_criticos': generate_default_pontos_criticos(kpis, transp_df, multi_df),
-            'recomendacoes': generate_default_recomendacoes(kpis),
-            'conclusao': default_conclusao(kpis)
-        }
+def generate_ai_email_analysis(kpis: Dict[str, object], yms: List[str],
+                               booking_df: pd.DataFrame, transp_df: pd.DataFrame,
+                               multi_df: pd.DataFrame, embarcadores: List[str]) -> Dict[str, str]:
+    from concurrent.futures import TimeoutError as FutureTimeout
+    fut = submit_ai_analysis(kpis, yms, booking_df, transp_df, multi_df, embarcadores)
+    if fut is not None:
+        try:
+            return fut.result(timeout=AI_TIMEOUT_S)
+        except FutureTimeout:
+            print(f"[AI] WARN: sem resposta em {AI_TIMEOUT_S:.0f}s, usando texto padrão")
+        except Exception as e:
+            print(f"[WARN] Erro ao gerar análise com IA: {e}")
+    return default_email_analysis(kpis, yms, transp_df, multi_df)
+
+async def generate_ai_email_analysis_async(kpis: Dict[str, object], yms: List[str],
+                                           booking_df: pd.DataFrame, transp_df: pd.DataFrame,
+                                           multi_df: pd.DataFrame, embarcadores: List[str]) -> Dict[str, str]:
+    """Igual a generate_ai_email_analysis, mas espera a IA sem travar o event loop"""
+    fut = await run_blocking(submit_ai_analysis, kpis, yms, booking_df, transp_df, multi_df, embarcadores)
+    if fut is not None:
+        try:
+            # shield: o prazo estoura só a espera; a chamada termina e alimenta o cache
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(fut)), AI_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            print(f"[AI] WARN: sem resposta em {AI_TIMEOUT_S:.0f}s, usando texto padrão")
+        except Exception as e:
+            print(f"[WARN] Erro ao gerar análise com IA: {e}")
+    return default_email_analysis(kpis, yms, transp_df, multi_df)
 
 def build_email_v2(kpis: Dict[str, object], yms: List[str], embarcadores: List[str],
-                   booking_df: pd.DataFrame, transp_df: pd.DataFrame, multi_df: pd.DataFrame):
+                   booking_df: pd.DataFrame, transp_df: pd.DataFrame, multi_df: pd.DataFrame,
+                   ai_analysis: Optional[Dict[str, str]] = None, charts: Optional[Dict[str, str]] = None):
     label = format_periodos_label(yms)
     emb_label = ", ".join(embarcadores)
 
-    ai_analysis = generate_ai_email_analysis(kpis, yms, booking_df, transp_df, multi_df, embarcadores)
-
-    graf_movimentacao_b64 = chart_movimentacao_por_porto(booking_df, yms)
-    graf_origem_dest_b64  = chart_origem_destino(booking_df)
-    graf_atraso_col_b64   = chart_atrasos_por_motivo_e_porto(transp_df, "coleta")
-    graf_atraso_ent_b64   = chart_atrasos_por_motivo_e_porto(transp_df, "entrega")
-    graf_reag_b64         = chart_reagendamentos_por_causa_e_porto(multi_df)
-
-    tabela_variacao_html  = generate_variacao_table(booking_df, yms)
+    # Gráficos renderizam no pool enquanto a análise (IA) é gerada aqui
+    chart_backend = resolve_chart_backend()
+    if charts is None:
+        chart_jobs = email_chart_jobs(yms, booking_df, transp_df, multi_df, chart_backend)
+        chart_futures = submit_chart_renders(chart_jobs)
+
+    if ai_analysis is None:
+        ai_analysis = generate_ai_email_analysis(kpis, yms, booking_df, transp_df, multi_df, embarcadores)
+
+    if charts is None:
+        charts = collect_chart_renders(chart_futures, chart_jobs)
+    graf_movimentacao_b64 = charts["movimentacao"]
+    graf_origem_dest_b64  = charts["origem_dest"]
+    graf_atraso_col_b64   = charts["atraso_coleta"]
+    graf_atraso_ent_b64   = charts["atraso_entrega"]
+    graf_reag_b64         = charts["reagendamentos"]
+
+    # Recortes porto × mês já vêm prontos em kpis (compute_kpis, a partir do cubo)
+    tabela_variacao_html  = generate_variacao_table(booking_df, yms, kpis)
     
     # NOVAS SEÇÕES
-    tendencias_html = generate_tendencias_movimentacao_html(booking_df, yms)
+    tendencias_html = generate_tendencias_movimentacao_html(booking_df, yms, kpis)
     alinhamento_html = generate_alinhamento_operacional_html(kpis, transp_df, multi_df)
     
-    # Detalhamento por porto
-    df_coleta = transp_df[transp_df['tipo_norm'] == 'coleta'] if not transp_df.empty else pd.DataFrame()
-    df_entrega = transp_df[transp_df['tipo_norm'] == 'entrega'] if not transp_df.empty else pd.DataFrame()
+    # Detalhamento por porto (contagens do cubo)
+    atrasos_coleta_cube = cube_atrasos(transp_df, "coleta")
+    atrasos_entrega_cube = cube_atrasos(transp_df, "entrega")
+    reag_cube = cube_reagendamentos(multi_df)
     
     detalhamento_coleta_html = generate_detalhamento_por_porto_html(
-        df_coleta, "atrasos", "justificativa_atraso", "porto_origem"
-    ) if not df_coleta.empty else ""
+        atrasos_coleta_cube, "atrasos"
+    ) if atrasos_coleta_cube is not None else ""
     
     detalhamento_entrega_html = generate_detalhamento_por_porto_html(
-        df_entrega, "atrasos", "justificativa_atraso", "porto_origem"
-    ) if not df_entrega.empty else ""
+        atrasos_entrega_cube, "atrasos"
+    ) if atrasos_entrega_cube is not None else ""
     
     detalhamento_reag_html = generate_detalhamento_por_porto_html(
-        multi_df, "reagendamentos", "motivo_reagenda", "porto_op"
-    ) if not multi_df.empty else ""
+        reag_cube, "reagendamentos"
+    ) if reag_cube is not None else ""
 
     total_ops = kpis["total_ops"]
     porto_top = safe_format_value(kpis["porto_top"])
@@ -1265,6 +2647,12 @@ def build_email_v2(kpis: Dict[str, object], yms: List[str], embarcadores: List[s
     def img_tag(b64, title):
         if not b64:
             return ""
+        if chart_backend == "html":
+            return (
+                f'<h4 style="margin:20px 0 12px 0;color:#1f77b4;border-left:4px solid #1f77b4;'
+                f'padding-left:12px;">{title}</h4>'
+                f'<div style="max-width:100%;overflow-x:auto;margin-bottom:24px;">{b64}</div>'
+            )
         return (
             f'<h4 style="margin:20px 0 12px 0;color:#1f77b4;border-left:4px solid #1f77b4;'
             f'padding-left:12px;">{title}</h4>'
@@ -1341,6 +2729,68 @@ def build_email_v2(kpis: Dict[str, object], yms: List[str], embarcadores: List[s
     html_full = '<div style="font-family:Segoe UI,Roboto,Arial,sans-serif;font-size:14px;color:#1a1a1a;line-height:1.6;max-width:900px;">' + "".join(html_parts) + "</div>"
     return txt_text, html_full
 
+async def build_email_async(kpis: Dict[str, object], yms: List[str], embarcadores: List[str],
+                            booking_df: pd.DataFrame, transp_df: pd.DataFrame, multi_df: pd.DataFrame):
+    """build_email_v2 p/ rotas async: nada de pandas/matplotlib no loop e a IA é aguardada sem bloquear"""
+    def submit_charts():
+        jobs = email_chart_jobs(yms, booking_df, transp_df, multi_df)
+        return jobs, submit_chart_renders(jobs)
+
+    chart_jobs, chart_futures = await run_blocking(submit_charts)
+    ai_analysis = await generate_ai_email_analysis_async(kpis, yms, booking_df, transp_df, multi_df, embarcadores)
+    charts = await run_blocking(collect_chart_renders, chart_futures, chart_jobs)
+    return await run_blocking(build_email_v2, kpis, yms, embarcadores, booking_df, transp_df, multi_df,
+                              ai_analysis=ai_analysis, charts=charts)
+
+def build_email_deferred(kpis: Dict[str, object], yms: List[str], embarcadores: List[str],
+                         booking_df: pd.DataFrame, transp_df: pd.DataFrame, multi_df: pd.DataFrame):
+    """
+    Devolve já o e-mail com o texto padrão e deixa a IA terminando em segundo plano.
+    Retorna (txt, html, ai_status, ai_job): ai_job != None -> consultar /api/generate-email/ai/{ai_job}.
+    """
+    fut = submit_ai_analysis(kpis, yms, booking_df, transp_df, multi_df, embarcadores)
+    charts = render_charts(email_chart_jobs(yms, booking_df, transp_df, multi_df))
+    if fut is None:
+        ai_analysis, status = default_email_analysis(kpis, yms, transp_df, multi_df), "disabled"
+    elif fut.done() and (fut.cancelled() or fut.exception() is not None):
+        # a IA já falhou (ex.: erro rápido do Gemini): nada a esperar
+        ai_analysis, status = default_email_analysis(kpis, yms, transp_df, multi_df), "fallback"
+    elif fut.done():
+        ai_analysis, status = fut.result(), "done"  # veio do cache
+    else:
+        ai_analysis, status = None, "pending"
+    if status != "pending":
+        txt, html = build_email_v2(kpis, yms, embarcadores, booking_df, transp_df, multi_df,
+                                   ai_analysis=ai_analysis, charts=charts)
+        return txt, html, status, None
+
+    txt, html = build_email_v2(kpis, yms, embarcadores, booking_df, transp_df, multi_df,
+                               ai_analysis=default_email_analysis(kpis, yms, transp_df, multi_df), charts=charts)
+    job_id = uuid.uuid4().hex
+    with _ai_lock:
+        ai_jobs[job_id] = {"status": "pending", "started": datetime.now().timestamp()}
+
+    def finish(f):
+        # roda na thread da IA; ai_jobs (TTLCache) também é lido pelas requisições: só sob _ai_lock
+        if f.cancelled() or f.exception() is not None:
+            job = {"status": "fallback"}
+        else:
+            t, h = build_email_v2(kpis, yms, embarcadores, booking_df, transp_df, multi_df,
+                                  ai_analysis=f.result(), charts=charts)
+            job = {"status": "done", "email": t, "email_html": h}
+        with _ai_lock:
+            ai_jobs[job_id] = job
+
+    fut.add_done_callback(finish)
+    return txt, html, "pending", job_id
+
+def eml_payload(txt: str, html: str, yms: List[str], embarcadores: List[str]) -> Dict[str, str]:
+    """.eml do e-mail em base64, no formato de /api/generate-eml-by"""
+    emb_label = ", ".join(embarcadores)
+    subject = f"Diário Operacional – {format_periodos_label(yms)} – {emb_label}"
+    raw_eml = build_eml(subject, html, txt)
+    return {"filename": "diario_operacional.eml", "file_b64": base64.b64encode(raw_eml).decode("ascii")}
+
 def build_eml(subject: str, body_html: str, body_txt: str,
               from_addr="ops@empresa.com", to_addr="cliente@empresa.com") -> bytes:
     import uuid
@@ -1372,21 +2822,860 @@ def build_eml(subject: str, body_html: str, body_txt: str,
 # =============================================================================
 # DB HELPERS
 # =============================================================================
+# Conteúdo em cache é endereçado pelo hash: vários períodos que apontam para o
+# mesmo arquivo compartilham uma única entrada.
+_LATEST_UPLOAD_SQL = text("""
+    SELECT u.id, u.hash, b.hash IS NOT NULL AS in_store
+    FROM uploads u
+    LEFT JOIN upload_blobs b ON b.hash = u.hash AND b.kind = u.kind
+    WHERE u.client=:c AND u.ym=:y AND u.kind=:k
+    ORDER BY u.id DESC LIMIT 1
+""")
+
+# Mesma regra p/ vários (ym, kind) numa consulta só: o id mais recente de cada par
+_LATEST_UPLOADS_SQL = text("""
+    SELECT u.ym, u.kind, u.id, u.hash, b.hash IS NOT NULL AS in_store
+    FROM uploads u
+    LEFT JOIN upload_blobs b ON b.hash = u.hash AND b.kind = u.kind
+    WHERE u.id IN (
+        SELECT MAX(id) FROM uploads
+        WHERE client=:c AND ym IN :yms AND kind IN :kinds
+        GROUP BY ym, kind
+    )
+""").bindparams(bindparam("yms", expanding=True), bindparam("kinds", expanding=True))
+
+def _content_token(upload_id: Optional[int], h: Optional[str], kind: str) -> str:
+    # Uploads muito antigos não têm hash: usa o id da linha
+    return f"{h or f'row{upload_id}'}_{kind}"
+
+def _content_key(prefix: str, upload_id: int, h: Optional[str], kind: str) -> str:
+    return f"{prefix}_{_content_token(upload_id, h, kind)}"
+
+def _resolve_upload(client: str, ym: str, kind: str) -> Optional[Tuple[int, Optional[str], bool]]:
+    """(upload_id, hash, in_store) do upload mais recente de (client, ym, kind)"""
+    with engine.begin() as conn:
+        row = conn.execute(_LATEST_UPLOAD_SQL, {"c": client, "y": ym, "k": kind}).fetchone()
+    return (row[0], row[1], bool(row[2])) if row else None
+
+def _resolve_uploads(client: str, yms, kinds) -> Dict[Tuple[str, str], Tuple[int, Optional[str], bool]]:
+    """{(ym, kind): (upload_id, hash, in_store)} dos uploads mais recentes, num único round trip"""
+    yms, kinds = sorted(set(yms)), sorted(set(kinds))
+    if not yms or not kinds:
+        return {}
+    with engine.connect() as conn:
+        rows = conn.execute(_LATEST_UPLOADS_SQL, {"c": client, "yms": yms, "kinds": kinds}).fetchall()
+    return {(r[0], r[1]): (r[2], r[3], bool(r[4])) for r in rows}
+
+def prefetch_content(items, prefix: str) -> int:
+    """
+    Coloca no cache, de uma vez, o conteúdo ("blob" = planilha, "norm" = Parquet) de vários
+    arquivos: no máximo uma consulta p/ o store (por hash) e uma p/ linhas antigas (por id).
+    O que já está em cache não é buscado. Parquet ausente fica p/ _read_norm converter.
+    Devolve quantos arquivos vieram do banco.
+    """
+    column = "data" if prefix == "blob" else "norm"
+    by_hash: Dict[Tuple[str, str], str] = {}
+    by_id: Dict[int, str] = {}
+    for ref, kind in items:
+        key = _content_key(prefix, ref[0], ref[1], kind)
+        if key in cache:
+            continue
+        if ref[2]:
+            by_hash[(ref[1], kind)] = key
+        else:
+            by_id[ref[0]] = key
+    if not by_hash and not by_id:
+        return 0
+
+    fetched = 0
+    with engine.connect() as conn:
+        rows = []
+        if by_hash:
+            rows += [((h, k), v) for h, k, v in conn.execute(
+                text(f"SELECT hash, kind, {column} FROM upload_blobs WHERE hash IN :hs")
+                .bindparams(bindparam("hs", expanding=True)),
+                {"hs": sorted({h for h, _ in by_hash})})]
+        if by_id:
+            rows += [(i, v) for i, v in conn.execute(
+                text(f"SELECT id, {column} FROM uploads WHERE id IN :ids")
+                .bindparams(bindparam("ids", expanding=True)),
+                {"ids": sorted(by_id)})]
+    for ident, value in rows:
+        key = by_hash.get(ident) if isinstance(ident, tuple) else by_id.get(ident)
+        if key is None or value is None:
+            continue
+        cache[key] = bytes(value) if prefix == "blob" else frame_from_parquet(value)
+        fetched += 1
+    return fetched
+
+def _read_blob(ref: Tuple[int, Optional[str], bool], kind: str) -> bytes:
+    upload_id, h, in_store = ref
+    cache_key = _content_key("blob", upload_id, h, kind)
+    data = cache.get(cache_key)
+    if data is not None:
+        return data
+    with engine.begin() as conn:
+        if in_store:
+            data = conn.execute(text("SELECT data FROM upload_blobs WHERE hash=:h AND kind=:k"),
+                                {"h": h, "k": kind}).scalar()
+        else:
+            data = conn.execute(text("SELECT data FROM uploads WHERE id=:i"), {"i": upload_id}).scalar()
+    cache[cache_key] = data
+    return data
+
+def _read_norm(ref: Tuple[int, Optional[str], bool], kind: str) -> pd.DataFrame:
+    """Frame normalizado de um arquivo; arquivos antigos sem Parquet são convertidos uma vez"""
+    upload_id, h, in_store = ref
+    cache_key = _content_key("norm", upload_id, h, kind)
+    df = cache.get(cache_key)
+    if df is not None:
+        return df
+    with engine.begin() as conn:
+        if in_store:
+            row = conn.execute(text("SELECT norm, col_map FROM upload_blobs WHERE hash=:h AND kind=:k"),
+                               {"h": h, "k": kind}).fetchone()
+        else:
+            row = conn.execute(text("SELECT norm, col_map FROM uploads WHERE id=:i"), {"i": upload_id}).fetchone()
+    norm_bytes, col_map = row if row else (None, None)
+
+    if norm_bytes is not None:
+        df = frame_from_parquet(norm_bytes)
+    else:
+        # mapeamento gravado no upload: pula a resolução de cabeçalhos
+        df, schema = normalize_workbook_with_schema(_read_blob(ref, kind), kind, schema_from_json(kind, col_map))
+        params = {"n": frame_to_parquet(df), "m": schema_to_json(kind, schema)}
+        with engine.begin() as conn:
+            if in_store:
+                conn.execute(text("UPDATE upload_blobs SET norm=:n, col_map=:m WHERE hash=:h AND kind=:k"),
+                             {**params, "h": h, "k": kind})
+            else:
+                conn.execute(text("UPDATE uploads SET norm=:n, col_map=:m WHERE id=:i"),
+                             {**params, "i": upload_id})
+
+    cache[cache_key] = df
+    return df
+
+def get_latest_blobs(client: str, keys) -> Dict[Tuple[str, str], Optional[bytes]]:
+    """Planilhas mais recentes de vários (ym, kind): 1 consulta p/ resolver + 1 p/ os bytes que faltam no cache"""
+    keys = list(keys)
+    refs = _resolve_uploads(client, {y for y, _ in keys}, {k for _, k in keys})
+    prefetch_content([(refs[key], key[1]) for key in keys if key in refs], "blob")
+    return {key: _read_blob(refs[key], key[1]) if key in refs else None for key in keys}
+
+def get_latest_norms(client: str, keys) -> Dict[Tuple[str, str], Optional[pd.DataFrame]]:
+    """Como get_latest_blobs, mas devolve os frames normalizados"""
+    keys = list(keys)
+    refs = _resolve_uploads(client, {y for y, _ in keys}, {k for _, k in keys})
+    prefetch_content([(refs[key], key[1]) for key in keys if key in refs], "norm")
+    return {key: _read_norm(refs[key], key[1]) if key in refs else None for key in keys}
+
 def get_latest_blob(client: str, ym: str, kind: str) -> Optional[bytes]:
-    cache_key = f"{client}_{ym}_{kind}"
-    if cache_key in cache:
-        return cache[cache_key]
-    
+    return get_latest_blobs(client, [(ym, kind)])[(ym, kind)]
+
+def get_latest_norm(client: str, ym: str, kind: str) -> Optional[pd.DataFrame]:
+    return get_latest_norms(client, [(ym, kind)])[(ym, kind)]
+
+FILTERS = {
+    "booking": filter_booking_norm,
+    "multi":   filter_multi_norm,
+    "transp":  filter_transp_norm,
+}
+
+# Resultados derivados (frames filtrados + KPIs) por conteúdo e filtros.
+# Cada entrada pesa o que os seus DataFrames ocupam.
+result_cache = ByteBudgetCache(max_bytes=int(RESULT_CACHE_MB * 1024 * 1024), ttl=1800)
+
+def invalidate_content(tokens: Set[str]) -> int:
+    """Descarta só o que foi derivado dos conteúdos em `tokens` (blobs, Parquet e resultados)"""
+    if not tokens:
+        return 0
+    dropped = cache.drop_where(lambda key: isinstance(key, str) and key.split("_", 1)[-1] in tokens)
+    dropped += result_cache.drop_where(lambda key: any(token in tokens for _, _, token in key[1]))
+    return dropped
+
+def _normalize_filters(yms: List[str], embarcadores: List[str]) -> Tuple[List[str], List[str]]:
+    """Ordem e repetições não mudam o resultado: vira a mesma chave de cache"""
+    norm_yms = sorted({str(y).strip() for y in yms if str(y).strip()})
+    norm_embs = sorted({str(e).strip() for e in embarcadores if str(e).strip()})
+    return norm_yms, norm_embs
+
+def _load_period_frames(refs: Dict[Tuple[str, str], Tuple[int, Optional[str], bool]], yms: List[str],
+                        embarcadores: List[str]) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Carrega booking/multi/transp de vários meses de uma vez.
+    Os meses são agrupados pelo arquivo (hash) de onde vêm: cada arquivo é lido
+    uma única vez e filtrado para todos os seus meses numa só passada.
+    """
+    groups: Dict[str, Dict[str, Tuple[Tuple[int, Optional[str], bool], List[str]]]] = {k: {} for k in FILTERS}
+    for y in yms:
+        for kind in FILTERS:
+            ref = refs[(y, kind)]
+            key = _content_key("norm", ref[0], ref[1], kind)
+            groups[kind].setdefault(key, (ref, []))[1].append(y)
+
+    # Todos os arquivos que faltam no cache chegam numa consulta só
+    prefetch_content([(ref, kind) for kind, by_file in groups.items() for ref, _ in by_file.values()], "norm")
+
+    frames = {}
+    for kind, by_file in groups.items():
+        frames[kind] = _concat_safely([
+            FILTERS[kind](_read_norm(ref, kind), file_yms, embarcadores)
+            for ref, file_yms in by_file.values()
+        ])
+    return frames["booking"], frames["multi"], frames["transp"]
+
+# ---- Agregados mensais no banco ----
+REPORT_AGGREGATES = os.getenv("REPORT_AGGREGATES", "true").strip().lower() in ("1", "true", "yes")
+aggregate_stats = {"hits": 0, "fallbacks": 0, "backfilled": 0}
+_aggregate_stats_lock = threading.Lock()  # contadores incrementados pelas threads de I/O e de jobs
+
+def aggregate_stats_snapshot() -> Dict[str, int]:
+    with _aggregate_stats_lock:
+        return dict(aggregate_stats)
+
+def _count_aggregate(name: str) -> None:
+    with _aggregate_stats_lock:
+        aggregate_stats[name] += 1
+
+def _insert_many(conn, table: str, columns: List[str], rows: List[tuple], chunk: int = 500) -> None:
+    """INSERT multi-linha em lotes (limite de parâmetros por comando)"""
+    for i in range(0, len(rows), chunk):
+        values, params = _values_clause([dict(zip(columns, r)) for r in rows[i:i + chunk]], "r")
+        conn.execute(text(f"INSERT INTO {table} ({','.join(columns)}) VALUES {values}"), params)
+
+def store_aggregates(conn, h: str, kind: str, aggs: Dict[str, object], now: str) -> bool:
+    """
+    Grava os agregados de um arquivo. A linha em agg_files é o "lock": quem a insere (ou
+    atualiza de versão) grava as linhas; escritor concorrente do mesmo arquivo não duplica.
+    """
+    claimed = conn.execute(text("""
+        INSERT INTO agg_files (hash, kind, version, exact, created_at) VALUES (:h, :k, :v, :e, :t)
+        ON CONFLICT (hash, kind) DO UPDATE SET version = excluded.version, exact = excluded.exact,
+                                               created_at = excluded.created_at
+        WHERE agg_files.version <> excluded.version
+        RETURNING hash
+    """), {"h": h, "k": kind, "v": AGG_VERSION, "e": int(bool(aggs["exact"])), "t": now}).fetchone()
+    if claimed is None:
+        return False
+    table, columns = AGG_TABLES[kind]
+    conn.execute(text(f"DELETE FROM {table} WHERE hash=:h"), {"h": h})
+    _insert_many(conn, table, ["hash"] + columns, [(h,) + tuple(r) for r in aggs["rows"]])
+    if kind == "booking":
+        conn.execute(text("DELETE FROM agg_embarcadores WHERE hash=:h"), {"h": h})
+        _insert_many(conn, "agg_embarcadores", ["hash"] + CATALOG_COLUMNS,
+                     [(h,) + tuple(r) for r in aggs.get("catalog", [])])
+    return True
+
+def delete_aggregates(conn, pairs) -> None:
+    """Remove os agregados dos arquivos (hash, kind) que saíram do store"""
+    for kind, (table, _) in AGG_TABLES.items():
+        hs = sorted({h for h, k in pairs if k == kind})
+        if not hs:
+            continue
+        tables = (table, "agg_embarcadores", "agg_files") if kind == "booking" else (table, "agg_files")
+        for t in tables:
+            extra = " AND kind=:k" if t == "agg_files" else ""
+            conn.execute(text(f"DELETE FROM {t} WHERE hash IN :hs{extra}")
+                         .bindparams(bindparam("hs", expanding=True)), {"hs": hs, "k": kind})
+
+def _matching_roots(roots, embarcadores: List[str]) -> Set[Optional[str]]:
+    """Raízes gravadas que passam no filtro (mesma regra de client_match_mask; NULL = sem filtro)"""
+    if not embarcadores:
+        return set(roots)
+    s_roots = {canonical_client_root(e) for e in embarcadores} - {""}
+    return {r for r in roots if r is None or (r and any(s in r or r in s for s in s_roots))}
+
+def load_period_aggregates(refs: Dict[Tuple[str, str], Tuple[int, Optional[str], bool]], yms: List[str],
+                           embarcadores: List[str]):
+    """
+    (booking, multi, transp) remontados dos agregados mensais: equivalentes aos frames de
+    _load_period_frames p/ KPIs, cubo e e-mail (multi/transp com uma linha por ocorrência,
+    booking com uma linha por porto × destino; nº de bookings em booking.attrs["bookings"]).
+    Devolve (frames ou None, arquivos sem agregado): None = usar o Parquet.
+    """
+    # ordem dos arquivos = ordem da concatenação em _load_period_frames
+    order: Dict[Tuple[str, str], int] = {}
+    file_refs = {}
+    for y in yms:
+        for kind in FILTERS:
+            ref = refs[(y, kind)]
+            if not ref[2]:
+                return None, []  # upload antigo, sem conteúdo no store
+            order.setdefault((ref[1], kind), len(order))
+            file_refs.setdefault((ref[1], kind), ref)
+
+    hs = sorted({h for h, _ in order})
+    with engine.connect() as conn:
+        files = {(h, k): (v, e) for h, k, v, e in conn.execute(
+            text("SELECT hash, kind, version, exact FROM agg_files WHERE hash IN :hs")
+            .bindparams(bindparam("hs", expanding=True)), {"hs": hs})}
+        missing = [(ref, k) for (h, k), ref in file_refs.items() if files.get((h, k), (None,))[0] != AGG_VERSION]
+        if missing or not all(files[(h, k)][1] for (h, k) in order):
+            return None, missing
+
+        rows = {}
+        for kind, (table, columns) in AGG_TABLES.items():
+            kind_hs = sorted({h for h, k in order if k == kind})
+            rows[kind] = conn.execute(
+                text(f"SELECT hash, {', '.join(columns)} FROM {table} WHERE hash IN :hs AND ym IN :yms")
+                .bindparams(bindparam("hs", expanding=True), bindparam("yms", expanding=True)),
+                {"hs": kind_hs, "yms": yms}).fetchall()
+
+    frames = {}
+    for kind, (table, columns) in AGG_TABLES.items():
+        df = pd.DataFrame(rows[kind], columns=["hash"] + columns)
+        # só as linhas do arquivo vigente de cada mês, dos embarcadores pedidos
+        current = {(y, refs[(y, kind)][1]) for y in yms}
+        roots = _matching_roots(set(df["emb_root"]), embarcadores)
+        keep = np.array([(y, h) in current and r in roots for y, h, r in zip(df["ym"], df["hash"], df["emb_root"])], dtype=bool)
+        df = df.loc[keep]
+        df = df.assign(__file=[order[(h, kind)] for h in df["hash"]]).sort_values(["__file", "first_pos"])
+        frames[kind] = df.reset_index(drop=True)
+
+    b = frames["booking"]
+    booking_df = pd.DataFrame({
+        "ym": b["ym"].to_numpy(dtype=object),
+        "booking_id": None,
+        "porto_origem": b["porto_origem"].to_numpy(dtype=object),
+        "porto_destino": b["porto_destino"].to_numpy(dtype=object),
+        "qtde": b["qtde"].to_numpy(dtype="int64"),
+        "embarcador": ",".join(embarcadores) if embarcadores else "",
+    }, columns=BOOKING_OUT_COLUMNS)
+    booking_df.attrs["bookings"] = int(b["bookings"].sum())
+
+    t = frames["transp"].loc[frames["transp"].index.repeat(frames["transp"]["ocorrencias"])]
+    transp_df = pd.DataFrame({
+        "tipo_norm": t["tipo"].to_numpy(dtype=object),
+        "justificativa_atraso": t["justificativa"].to_numpy(dtype=object),
+        "__ym": t["ym"].to_numpy(dtype=object),
+        "porto_origem": t["porto_origem"].to_numpy(dtype=object),
+    }, columns=TRANSP_OUT_COLUMNS)
+
+    m = frames["multi"].loc[frames["multi"].index.repeat(frames["multi"]["ocorrencias"])]
+    multi_df = pd.DataFrame({
+        "__ym": m["ym"].to_numpy(dtype=object),
+        "porto_op": m["porto_op"].to_numpy(dtype=object),
+        "tipo_operacao": None,
+        "motivo_reagenda": m["motivo"].to_numpy(dtype=object),
+        "flag": np.ones(len(m), dtype="int64"),
+    }, columns=MULTI_OUT_COLUMNS)
+    return (booking_df, multi_df, transp_df), []
+
+def backfill_aggregates(missing, computed: Optional[Dict] = None) -> None:
+    """
+    Gera os agregados de arquivos enviados antes deles existirem (frame normalizado já em cache).
+    `computed` = {(ref, kind): agregados} já calculados pelo chamador.
+    """
+    now = datetime.utcnow().isoformat()
+    computed = computed or {}
+    try:
+        with engine.begin() as conn:
+            for ref, kind in missing:
+                aggs = computed.get((ref, kind)) or upload_aggregates(_read_norm(ref, kind), kind)
+                if store_aggregates(conn, ref[1], kind, aggs, now):
+                    _count_aggregate("backfilled")
+    except Exception as e:
+        print(f"[AGG] WARN: backfill falhou: {e}")
+
+# Catálogo de embarcadores dos bookings vigentes: arquivo, versão dos agregados e linhas numa consulta
+_CATALOG_SQL = text("""
+    SELECT u.ym, u.id, u.hash, b.hash IS NOT NULL AS in_store, f.version, e.ym, e.embarcador, e.emb_root
+    FROM uploads u
+    LEFT JOIN upload_blobs b ON b.hash = u.hash AND b.kind = u.kind
+    LEFT JOIN agg_files f ON f.hash = u.hash AND f.kind = u.kind
+    LEFT JOIN agg_embarcadores e ON e.hash = f.hash
+    WHERE u.id IN (
+        SELECT MAX(id) FROM uploads
+        WHERE client=:c AND kind='booking' AND ym IN :yms
+        GROUP BY ym
+    )
+""").bindparams(bindparam("yms", expanding=True))
+
+def embarcador_catalog(client: str, yms: List[str], whole_file: bool = False) -> Dict[str, Optional[str]]:
+    """
+    {embarcador: raiz} dos bookings vigentes dos meses pedidos, lido de agg_embarcadores.
+    Só as linhas daqueles meses; whole_file=True lista o arquivo inteiro (todas as datas).
+    Arquivos sem catálogo (anteriores a ele) são lidos do Parquet e ganham o catálogo.
+    """
+    if not yms:
+        return {}
+    with engine.connect() as conn:
+        rows = conn.execute(_CATALOG_SQL, {"c": client, "yms": sorted(set(yms))}).fetchall()
+
+    catalog: Dict[str, Optional[str]] = {}
+    missing = {}
+    for ym, upload_id, h, in_store, version, e_ym, name, root in rows:
+        if version != AGG_VERSION:
+            missing[(upload_id, h, bool(in_store))] = ym
+        elif name is not None and (whole_file or e_ym == ym):
+            catalog[name] = root
+    computed = {(ref, "booking"): upload_aggregates(_read_norm(ref, "booking"), "booking") for ref in missing}
+    for (ref, _), aggs in computed.items():
+        for e_ym, name, root in aggs["catalog"]:
+            if whole_file or e_ym == missing[ref]:
+                catalog[name] = root
+    if missing:
+        backfill_aggregates([key for key in computed if key[0][2]], computed)
+    return catalog
+
+def load_period_results(client: str, yms: List[str], embarcadores: List[str],
+                        on_stage: Optional[Callable[[str], None]] = None
+                        ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, Dict[str, object]]:
+    """
+    (booking, multi, transp, kpis) dos meses/embarcadores pedidos.
+    A chave é o conteúdo (hash) de cada arquivo + filtros normalizados: trocar a seleção
+    de embarcadores e voltar reaproveita o resultado, e um upload novo muda a chave sozinho.
+    Os frames devolvidos são compartilhados pelo cache: não alterar in-place.
+    `on_stage("kpis")` avisa quando os frames foram lidos (progresso dos jobs).
+    """
+    yms, embarcadores = _normalize_filters(yms, embarcadores)
+    refs = _resolve_uploads(client, yms, FILTERS)
+    for y in yms:
+        if any((y, kind) not in refs for kind in FILTERS):
+            raise HTTPException(status_code=400, detail=f"Faltam planilhas p/ {y}.")
+
+    key = ("period",
+           tuple((y, kind, _content_token(*ref[:2], kind)) for (y, kind), ref in refs.items()),
+           tuple(embarcadores))
+    hit = result_cache.get(key)
+    if hit is not None:
+        return hit
+
+    # Agregados mensais (poucas linhas, SQL indexado); sem eles, o Parquet de cada arquivo
+    frames, missing = load_period_aggregates(refs, yms, embarcadores) if REPORT_AGGREGATES else (None, [])
+    _count_aggregate("hits" if frames is not None else "fallbacks")
+    if frames is None:
+        frames = _load_period_frames(refs, yms, embarcadores)
+        if missing:
+            backfill_aggregates(missing)
+    booking_df, multi_df, transp_df = frames
+    if on_stage:
+        on_stage("kpis")
+    result = (booking_df, multi_df, transp_df, compute_kpis(booking_df, multi_df, transp_df))
+    result_cache[key] = result
+    return result
+
+# =============================================================================
+# EXECUÇÃO FORA DO EVENT LOOP
+# =============================================================================
+# O uvicorn roda com 1 worker: pandas/SQL/matplotlib direto numa rota async travam
+# todas as requisições (inclusive o health check). SQL e montagem de resultado vão
+# p/ um pool de threads, parse de planilha p/ processos, e cada tipo de rota pesada
+# tem limite de concorrência com métricas de fila (expostas em /api/health).
+IO_WORKERS = int(os.getenv("IO_WORKERS", "5"))  # = pool_size do engine
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(min(2, os.cpu_count() or 1))))
+REPORT_CONCURRENCY = int(os.getenv("REPORT_CONCURRENCY", "2"))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "1"))
+WORK_QUEUE_MAX = int(os.getenv("WORK_QUEUE_MAX", "16"))
+
+_io_executor = None
+_cpu_pool = None
+_in_flight = {"io": 0, "cpu": 0}
+
+def _get_io_executor():
+    global _io_executor
+    with _executors_lock:
+        if _io_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _io_executor = ThreadPoolExecutor(max_workers=max(1, IO_WORKERS), thread_name_prefix="io")
+        return _io_executor
+
+def _get_cpu_pool():
+    """Pool de processos p/ parse; None (CPU_WORKERS <= 1) = usa as threads de I/O"""
+    global _cpu_pool
+    if CPU_WORKERS <= 1:
+        return None
+    with _executors_lock:
+        if _cpu_pool is None:
+            _cpu_pool = new_process_pool(CPU_WORKERS)
+        return _cpu_pool
+
+def _reset_cpu_pool():
+    global _cpu_pool
+    with _executors_lock:
+        pool, _cpu_pool = _cpu_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+async def run_blocking(fn, *args, **kwargs):
+    """Roda `fn` no pool de threads de I/O sem bloquear o event loop"""
+    import functools
+    _in_flight["io"] += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_io_executor(), functools.partial(fn, *args, **kwargs))
+    finally:
+        _in_flight["io"] -= 1
+
+async def run_cpu(fn, *args):
+    """Roda `fn` (módulo-level, args/retorno picklable) no pool de processos; sem pool, em thread"""
+    from concurrent.futures.process import BrokenProcessPool
+    pool = _get_cpu_pool()
+    if pool is not None:
+        _in_flight["cpu"] += 1
+        try:
+            try:
+                fut = pool.submit(fn, *args)
+            except RuntimeError:  # pool encerrado
+                _reset_cpu_pool()
+                fut = None
+            if fut is not None:
+                return await asyncio.wrap_future(fut)
+        except BrokenProcessPool:
+            _reset_cpu_pool()
+        finally:
+            _in_flight["cpu"] -= 1
+    return await run_blocking(fn, *args)
+
+class WorkLimiter:
+    """Limita requisições simultâneas de um tipo de rota; a fila passa de max_queue -> 503"""
+
+    def __init__(self, name: str, limit: int, max_queue: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self._sem = None
+        self.active = self.waiting = self.max_waiting = 0
+        self.completed = self.rejected = 0
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.limit)
+        return self._sem
+
+    async def __aenter__(self):
+        if self.active >= self.limit and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Servidor ocupado, tente novamente em instantes.",
+                                headers={"Retry-After": "5"})
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await self._semaphore().acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        self.active -= 1
+        self.completed += 1
+        self._semaphore().release()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "limit": self.limit, "active": self.active, "queued": self.waiting,
+            "max_queued": self.max_waiting, "completed": self.completed, "rejected": self.rejected,
+        }
+
+report_limiter = WorkLimiter("report", REPORT_CONCURRENCY, WORK_QUEUE_MAX)
+upload_limiter = WorkLimiter("upload", UPLOAD_CONCURRENCY, WORK_QUEUE_MAX)
+
+class SingleFlight:
+    """
+    Requisições idênticas simultâneas (mesma chave normalizada) compartilham uma única
+    execução e o seu resultado (ou erro). A execução roda numa task própria: se quem
+    começou desconectar, os demais continuam esperando o mesmo cálculo.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+        self.executed = self.shared = 0
+
+    async def run(self, key: tuple, fn):
+        loop = asyncio.get_running_loop()
+        task = self._inflight.get(key)
+        if task is not None and task.get_loop() is loop:
+            self.shared += 1
+            return await asyncio.shield(task)
+        task = loop.create_task(fn())
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._inflight.pop(key, None) if self._inflight.get(key) is t else None)
+        self.executed += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, int]:
+        return {"executed": self.executed, "shared": self.shared, "in_flight": len(self._inflight)}
+
+report_flight = SingleFlight()
+
+def report_flight_key(route: str, client: str, yms: List[str], embarcadores: List[str], *extra) -> tuple:
+    """Chave normalizada (filtros sem espaços/duplicatas, ordenados) + o que mais mudar a resposta"""
+    yms, embarcadores = _normalize_filters(yms, embarcadores)
+    return (route, client, tuple(yms), tuple(embarcadores)) + extra
+
+def work_stats() -> Dict[str, object]:
+    return {
+        "report": report_limiter.stats(),
+        "upload": upload_limiter.stats(),
+        "singleflight": report_flight.stats(),
+        "io": {"workers": IO_WORKERS, "in_flight": _in_flight["io"]},
+        "cpu": {"workers": CPU_WORKERS, "in_flight": _in_flight["cpu"]},
+    }
+
+# ---- Upload em etapas (parse em processos, SQL em threads) ----
+UPLOAD_KINDS = ("booking", "multi", "transp")
+
+def upload_artifacts(blob: bytes, kind: str) -> Tuple[bytes, Optional[str], Dict[str, object]]:
+    """Parquet normalizado + mapeamento de colunas + agregados mensais de um arquivo (roda no pool de processos)"""
+    df, schema = normalize_workbook_with_schema(blob, kind)
+    return frame_to_parquet(df), schema_to_json(kind, schema), upload_aggregates(df, kind)
+
+def booking_upload_artifacts(blob: bytes) -> Dict[str, object]:
+    """
+    Parse do booking no upload (roda no pool de processos). Devolve períodos, embarcadores e
+    artefatos, ou {"error": ...}: HTTPException não atravessa o pickle do pool.
+    """
+    df, schema = normalize_workbook_with_schema(blob, "booking")
+    if schema is None:
+        return {"error": "Arquivo booking vazio/inválido"}
+    if "__ym" not in df.columns:
+        return {"error": "Coluna de data não encontrada no Booking."}
+    if "emb" not in df.columns:
+        return {"error": "Coluna de embarcador/cliente não encontrada no Booking."}
+    df_active = df[df["ativo"]]
+    return {
+        "periods": sorted(df["__ym"].dropna().unique().tolist()),
+        "embarcadores": sorted(shipper_names(df_active["emb"]).dropna().unique().tolist()),
+        "artifacts": (frame_to_parquet(df), schema_to_json("booking", schema), upload_aggregates(df, "booking")),
+    }
+
+# Estado atual de todos os (ym, kind) do upload e quais conteúdos novos já estão no store,
+# numa consulta só e sem trafegar bytes: só hashes são comparados
+_UPLOAD_PLAN_SQL = text("""
+    SELECT ym, kind, hash FROM uploads
+    WHERE client=:c AND ym IN :yms AND kind IN :kinds
+    UNION ALL
+    SELECT NULL, kind, hash FROM upload_blobs WHERE hash IN :hs
+""").bindparams(bindparam("yms", expanding=True), bindparam("kinds", expanding=True),
+                bindparam("hs", expanding=True))
+
+def plan_upload(client: str, periods: List[str], blobs: Dict[str, bytes]) -> Tuple[Dict[str, str], List[str], Dict[str, List[str]]]:
+    """
+    Hash de cada arquivo, os tipos cujo conteúdo ainda não está em upload_blobs e, por tipo,
+    os períodos cujo hash gravado difere do novo. Reenvio idêntico = 1 round trip e nada a gravar.
+    """
+    hashes = {kind: sha256_bytes(blob) for kind, blob in blobs.items()}
+    if not periods:
+        return hashes, [], {}
+    current: Dict[Tuple[str, str], Set[Optional[str]]] = {}
+    stored: Set[Tuple[str, str]] = set()
+    with engine.connect() as conn:
+        rows = conn.execute(_UPLOAD_PLAN_SQL, {"c": client, "yms": sorted(set(periods)),
+                                               "kinds": sorted(hashes), "hs": sorted(set(hashes.values()))})
+        for ym, kind, h in rows:
+            if ym is None:
+                stored.add((h, kind))
+            else:
+                current.setdefault((ym, kind), set()).add(h)
+
+    pending = {}
+    for kind, h in hashes.items():
+        yms = [ym for ym in periods if current.get((ym, kind)) != {h}]
+        if yms:
+            pending[kind] = yms
+    needed = [kind for kind in pending if (hashes[kind], kind) not in stored]
+    return hashes, needed, pending
+
+def _values_clause(rows: List[Dict[str, object]], prefix: str) -> Tuple[str, Dict[str, object]]:
+    """VALUES (...), (...) com parâmetros numerados p/ um INSERT multi-linha"""
+    params: Dict[str, object] = {}
+    groups = []
+    for i, row in enumerate(rows):
+        names = []
+        for col, value in row.items():
+            params[f"{prefix}{col}{i}"] = value
+            names.append(f":{prefix}{col}{i}")
+        groups.append("(" + ",".join(names) + ")")
+    return ",".join(groups), params
+
+def store_upload(client: str, periods_list: List[str], blobs: Dict[str, bytes], hashes: Dict[str, str],
+                 artifacts: Dict[str, Tuple[bytes, Optional[str], Dict[str, object]]],
+                 pending: Optional[Dict[str, List[str]]] = None) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Grava numa transação só os períodos que mudaram (pending, vindo do plan_upload) com comandos
+    em lote: um INSERT multi-linha p/ os arquivos novos (e seus agregados mensais), um DELETE dos
+    mapeamentos substituídos e um INSERT ... ON CONFLICT p/ os novos. Invalida o conteúdo que
+    deixou de ser usado.
+    """
+    if pending is None:
+        _, _, pending = plan_upload(client, periods_list, blobs)
+    inserted = [{"ym": ym, "kind": kind} for kind in UPLOAD_KINDS for ym in pending.get(kind, [])]
+    skipped = [{"ym": ym, "kind": kind, "reason": "hash_igual"}
+               for kind in UPLOAD_KINDS for ym in periods_list if ym not in pending.get(kind, [])]
+    if not inserted:
+        return inserted, skipped
+
+    kinds = [kind for kind in UPLOAD_KINDS if kind in pending]
+    stale: Set[str] = set()
+    now = datetime.utcnow().isoformat()
     with engine.begin() as conn:
-        row = conn.execute(
-            text("SELECT data FROM uploads WHERE client=:c AND ym=:y AND kind=:k ORDER BY id DESC LIMIT 1"),
-            {"c": client, "y": ym, "k": kind},
-        ).fetchone()
-    
-    if row:
-        cache[cache_key] = row[0]
-        return row[0]
-    return None
+        # O plano rodou fora da transação: confere (só hashes) quais arquivos ainda faltam no store
+        stored = {(h, k) for h, k in conn.execute(
+            text("SELECT hash, kind FROM upload_blobs WHERE hash IN :hs").bindparams(bindparam("hs", expanding=True)),
+            {"hs": sorted({hashes[k] for k in kinds})})}
+        new_blobs = []
+        new_aggs = []
+        for kind in kinds:
+            if (hashes[kind], kind) in stored:
+                continue
+            # Normalmente já veio do pool; outro upload pode ter mudado o banco entre o plano e aqui
+            norm, col_map, aggs = artifacts[kind] if kind in artifacts else upload_artifacts(blobs[kind], kind)
+            new_blobs.append({"h": hashes[kind], "k": kind, "d": blobs[kind], "n": norm, "m": col_map,
+                              "s": len(blobs[kind]), "t": now})
+            new_aggs.append((hashes[kind], kind, aggs))
+        if new_blobs:
+            values, params = _values_clause(new_blobs, "b")
+            conn.execute(text(
+                "INSERT INTO upload_blobs (hash,kind,data,norm,col_map,size_bytes,created_at) "
+                f"VALUES {values} ON CONFLICT (hash, kind) DO NOTHING"
+            ), params)
+            for h, kind, aggs in new_aggs:
+                store_aggregates(conn, h, kind, aggs, now)
+
+        # Mapeamentos antigos dos períodos que mudaram (inclusive linhas legadas sem hash)
+        where, params = [], {"c": client}
+        for i, kind in enumerate(kinds):
+            where.append(f"(kind=:k{i} AND ym IN :y{i} AND (hash IS NULL OR hash <> :h{i}))")
+            params.update({f"k{i}": kind, f"y{i}": pending[kind], f"h{i}": hashes[kind]})
+        delete = text(f"DELETE FROM uploads WHERE client=:c AND ({' OR '.join(where)}) RETURNING id, kind, hash")
+        delete = delete.bindparams(*(bindparam(f"y{i}", expanding=True) for i in range(len(kinds))))
+        stale |= {_content_token(i, None, k) for i, k, h in conn.execute(delete, params) if h is None}
+
+        values, params = _values_clause(
+            [{"c": client, "y": row["ym"], "k": row["kind"], "h": hashes[row["kind"]], "t": now} for row in inserted], "u")
+        conn.execute(text(
+            f"INSERT INTO uploads (client,ym,kind,hash,created_at) VALUES {values} "
+            "ON CONFLICT (client, ym, kind, hash) DO NOTHING"
+        ), params)
+
+        # Disponibilidade: liga os bits dos tipos gravados em cada mês
+        flags: Dict[str, int] = {}
+        for row in inserted:
+            flags[row["ym"]] = flags.get(row["ym"], 0) | KIND_BITS[row["kind"]]
+        values, params = _values_clause([{"c": client, "y": ym, "f": f, "t": now} for ym, f in flags.items()], "p")
+        conn.execute(text(
+            f"INSERT INTO upload_periods (client,ym,kinds,updated_at) VALUES {values} "
+            "ON CONFLICT (client, ym) DO UPDATE SET kinds = upload_periods.kinds | excluded.kinds, "
+            "updated_at = excluded.updated_at"
+        ), params)
+
+        # Arquivos substituídos que não são mais referenciados por nenhum período
+        stale |= gc_orphan_blobs(conn)
+
+    # Resultados de outros arquivos continuam válidos: a chave deles é o conteúdo
+    invalidate_content(stale)
+    return inserted, skipped
+
+# =============================================================================
+# FILA DE RELATÓRIOS
+# =============================================================================
+# E-mails longos (12 meses, vários embarcadores) passam do timeout do proxy se gerados
+# dentro da requisição. Aqui o pedido vira uma linha em report_jobs e roda num pool
+# local de threads; o estado (etapa/progresso/resultado) fica no banco, então sobrevive
+# a restarts (jobs pendentes são retomados no boot). Pedido igual em andamento = mesmo job.
+REPORT_STAGES = ("load", "kpis", "charts", "ai", "assemble")
+REPORT_JOB_TYPES = ("email", "eml")
+REPORT_JOB_WORKERS = int(os.getenv("REPORT_JOB_WORKERS", "1"))
+REPORT_JOB_TTL_H = float(os.getenv("REPORT_JOB_TTL_H", "24"))
+_job_executor = None
+_job_lock = threading.Lock()
+
+def _get_job_executor():
+    global _job_executor
+    with _executors_lock:
+        if _job_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _job_executor = ThreadPoolExecutor(max_workers=max(1, REPORT_JOB_WORKERS), thread_name_prefix="report-job")
+        return _job_executor
+
+def report_job_key(job_type: str, client: str, yms: List[str], embarcadores: List[str]) -> str:
+    yms, embarcadores = _normalize_filters(yms, embarcadores)
+    return hashlib.sha256(json.dumps([job_type, client, yms, embarcadores]).encode("utf-8")).hexdigest()
+
+def _update_job(job_id: str, **fields) -> None:
+    fields["updated_at"] = datetime.utcnow().isoformat()
+    sets = ", ".join(f"{k}=:{k}" for k in fields)
+    with engine.begin() as conn:
+        conn.execute(text(f"UPDATE report_jobs SET {sets} WHERE id=:id"), {**fields, "id": job_id})
+
+def _job_stage(job_id: str, stage: str) -> None:
+    progress = int(100 * REPORT_STAGES.index(stage) / len(REPORT_STAGES))
+    _update_job(job_id, status="running", stage=stage, progress=progress)
+
+def run_report_job(job_id: str) -> None:
+    """Executa um job da fila, gravando a etapa atual, o resultado (JSON) ou o erro"""
+    with engine.connect() as conn:
+        row = conn.execute(text("SELECT job_type, client, params, status FROM report_jobs WHERE id=:id"),
+                           {"id": job_id}).fetchone()
+    if row is None or row.status not in ("queued", "running"):
+        return
+    params = json.loads(row.params)
+    yms, embarcadores = params["yms"], params["embarcadores"]
+    try:
+        _job_stage(job_id, "load")
+        booking_df, multi_df, transp_df, kpis = load_period_results(
+            row.client, yms, embarcadores, on_stage=lambda stage: _job_stage(job_id, stage))
+        _job_stage(job_id, "charts")
+        charts = render_charts(email_chart_jobs(yms, booking_df, transp_df, multi_df))
+        _job_stage(job_id, "ai")
+        ai_analysis = generate_ai_email_analysis(kpis, yms, booking_df, transp_df, multi_df, embarcadores)
+        _job_stage(job_id, "assemble")
+        txt, html = build_email_v2(kpis, yms, embarcadores, booking_df, transp_df, multi_df,
+                                   ai_analysis=ai_analysis, charts=charts)
+        result = eml_payload(txt, html, yms, embarcadores) if row.job_type == "eml" else {"email": txt, "email_html": html}
+        _update_job(job_id, status="done", stage="done", progress=100, result=json.dumps(result))
+    except HTTPException as e:
+        _update_job(job_id, status="error", error=str(e.detail))
+    except Exception as e:
+        print(f"[JOBS] WARN: job {job_id} falhou: {e}")
+        _update_job(job_id, status="error", error=str(e))
+
+def enqueue_report_job(job_type: str, client: str, yms: List[str], embarcadores: List[str]) -> Tuple[str, bool]:
+    """Cria o job (ou reaproveita um igual ainda na fila/rodando). Devolve (job_id, reaproveitado)"""
+    key = report_job_key(job_type, client, yms, embarcadores)
+    now = datetime.utcnow()
+    cutoff = datetime.fromtimestamp(now.timestamp() - REPORT_JOB_TTL_H * 3600).isoformat()
+    with _job_lock, engine.begin() as conn:
+        conn.execute(text("DELETE FROM report_jobs WHERE status IN ('done', 'error') AND updated_at < :t"),
+                     {"t": cutoff})
+        row = conn.execute(text(
+            "SELECT id FROM report_jobs WHERE job_key=:k AND status IN ('queued', 'running') "
+            "ORDER BY created_at DESC LIMIT 1"
+        ), {"k": key}).fetchone()
+        if row is not None:
+            return row.id, True
+        job_id = uuid.uuid4().hex
+        conn.execute(text(
+            "INSERT INTO report_jobs (id, job_key, job_type, client, params, status, progress, created_at, updated_at) "
+            "VALUES (:id, :k, :tp, :c, :p, 'queued', 0, :t, :t)"
+        ), {"id": job_id, "k": key, "tp": job_type, "c": client,
+            "p": json.dumps({"yms": list(yms), "embarcadores": list(embarcadores)}), "t": now.isoformat()})
+    _get_job_executor().submit(run_report_job, job_id)
+    return job_id, False
+
+def resume_report_jobs() -> bool:
+    """Recoloca no pool os jobs que o processo anterior deixou na fila ou no meio (False = banco indisponível)"""
+    try:
+        with engine.connect() as conn:
+            ids = [r.id for r in conn.execute(text(
+                "SELECT id FROM report_jobs WHERE status IN ('queued', 'running') ORDER BY created_at"))]
+    except Exception as e:
+        print(f"[JOBS] WARN: não foi possível retomar jobs: {e}")
+        return False
+    for job_id in ids:
+        _get_job_executor().submit(run_report_job, job_id)
+    if ids:
+        print(f"[JOBS] {len(ids)} job(s) retomado(s)")
+    return True
+
+def get_report_job(job_id: str, with_result: bool = False) -> Dict[str, object]:
+    cols = "id, job_type, status, stage, progress, error, created_at, updated_at" + (", result" if with_result else "")
+    with engine.connect() as conn:
+        row = conn.execute(text(f"SELECT {cols} FROM report_jobs WHERE id=:id"), {"id": job_id}).fetchone()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado ou expirado.")
+    return dict(row._mapping)
 
 # =============================================================================
 # API ROUTES
@@ -1396,75 +3685,37 @@ async def upload(client: str = Form(...),
                  booking: UploadFile = File(...),
                  multimodal: UploadFile = File(...),
                  transportes: UploadFile = File(...)):
-    b_booking = await booking.read()
-    b_multi = await multimodal.read()
-    b_transp = await transportes.read()
-
-    booking_sheets = parse_excel_bytes(b_booking)
-    if not booking_sheets:
-        raise HTTPException(status_code=400, detail="Arquivo booking vazio/inválido")
-    df_all = pd.concat(booking_sheets.values(), ignore_index=True)
-
-    col_dt  = ensure_col(df_all, CANDS_BOOKING_DT)
-    col_emb = ensure_col(df_all, CANDS_BOOKING_EMB)
-    col_stat= ensure_col(df_all, CANDS_BOOKING_STAT)
-
-    if col_dt is None:
-        raise HTTPException(status_code=400, detail="Coluna de data não encontrada no Booking.")
-    if col_emb is None:
-        raise HTTPException(status_code=400, detail="Coluna de embarcador/cliente não encontrada no Booking.")
-
-    df_all["__ym"] = df_all[col_dt].apply(extract_period_ym)
-    df_active = df_all[df_all[col_stat].astype(str).str.strip().str.lower() == "ativo"] if col_stat else df_all
+    blobs = {
+        "booking": await booking.read(),
+        "multi": await multimodal.read(),
+        "transp": await transportes.read(),
+    }
 
-    embarcadores_list = sorted(df_active[col_emb].astype(str).str.strip().dropna().unique().tolist())
-    periods_list = sorted(df_all["__ym"].dropna().unique().tolist())
+    async with upload_limiter:
+        parsed = await run_cpu(booking_upload_artifacts, blobs["booking"])
+        if "error" in parsed:
+            raise HTTPException(status_code=400, detail=parsed["error"])
+        periods_list = parsed["periods"]
 
-    h_booking = sha256_bytes(b_booking)
-    h_multi   = sha256_bytes(b_multi)
-    h_transp  = sha256_bytes(b_transp)
+        # Só normaliza (em paralelo) os arquivos que algum período ainda não tem gravados
+        hashes, needed, pending = await run_blocking(plan_upload, client, periods_list, blobs)
+        artifacts: Dict[str, Tuple[bytes, Optional[str], Dict[str, object]]] = {"booking": parsed["artifacts"]}
+        others = [kind for kind in needed if kind != "booking"]
+        results = await asyncio.gather(*(run_cpu(upload_artifacts, blobs[kind], kind) for kind in others))
+        artifacts.update(zip(others, results))
 
-    inserted = []
-    skipped = []
-
-    now = datetime.utcnow().isoformat()
-    with engine.begin() as conn:
-        for ym in periods_list:
-            for kind, blob, h in [
-                ("booking", b_booking, h_booking),
-                ("multi",   b_multi,   h_multi),
-                ("transp",  b_transp,  h_transp),
-            ]:
-                exists = conn.execute(
-                    text("SELECT 1 FROM uploads WHERE client=:c AND ym=:y AND kind=:k AND hash=:h LIMIT 1"),
-                    {"c": client, "y": ym, "k": kind, "h": h}
-                ).fetchone()
-                if exists:
-                    skipped.append({"ym": ym, "kind": kind, "reason": "hash_igual"})
-                    continue
-                conn.execute(text("DELETE FROM uploads WHERE client=:c AND ym=:y AND kind=:k"),
-                             {"c": client, "y": ym, "k": kind})
-                conn.execute(text(
-                    "INSERT INTO uploads (client,ym,kind,data,hash,created_at) "
-                    "VALUES (:c,:y,:k,:d,:h,:t)"
-                ), {"c": client, "y": ym, "k": kind, "d": blob, "h": h, "t": now})
-                inserted.append({"ym": ym, "kind": kind})
-                
-                # Limpar cache
-                cache_key = f"{client}_{ym}_{kind}"
-                if cache_key in cache:
-                    del cache[cache_key]
+        inserted, skipped = await run_blocking(store_upload, client, periods_list, blobs, hashes, artifacts, pending)
 
     return JSONResponse({
         "status": "ok",
         "periods": periods_list,
-        "embarcadores": embarcadores_list,
+        "embarcadores": parsed["embarcadores"],
         "inserted": inserted,
         "skipped": skipped
     })
 
 @app.get("/api/summary")
-def api_summary(client: str, ym: str = Query(...), embarcador: str = Query(...)):
+async def api_summary(client: str, ym: str = Query(...), embarcador: str = Query(...)):
     ym_list = [y.strip() for y in ym.split(",") if y.strip()]
     emb_list = [e.strip() for e in embarcador.split(",") if e.strip()]
     if not ym_list:
@@ -1472,29 +3723,19 @@ def api_summary(client: str, ym: str = Query(...), embarcador: str = Query(...))
     if not emb_list:
         raise HTTPException(status_code=400, detail="Nenhum embarcador informado")
 
-    booking_frames, multi_frames, transp_frames = [], [], []
-    for y in ym_list:
-        b_blob = get_latest_blob(client, y, "booking")
-        m_blob = get_latest_blob(client, y, "multi")
-        t_blob = get_latest_blob(client, y, "transp")
-        if not b_blob or not m_blob or not t_blob:
-            raise HTTPException(status_code=400, detail=f"Faltam planilhas p/ {y}.")
-        booking_frames.append(load_booking_df(b_blob, [y], emb_list))
-        multi_frames.append(load_multi_df(m_blob, [y], emb_list))
-        transp_frames.append(load_transp_df(t_blob, [y], emb_list))
-
-    booking_concat = _concat_safely(booking_frames)
-    multi_concat = _concat_safely(multi_frames)
-    transp_concat = _concat_safely(transp_frames)
-
-    kpis = compute_kpis(booking_concat, multi_concat, transp_concat)
-    debug_info = {
-        "booking_len": len(booking_concat),
-        "booking_sum_qtde": int(booking_concat["qtde"].sum()) if len(booking_concat) else 0,
-        "transp_len": len(transp_concat),
-        "multi_len": len(multi_concat),
-    }
-    return JSONResponse({"kpis": kpis, "debug": debug_info})
+    async def compute():
+        async with report_limiter:
+            booking_concat, multi_concat, transp_concat, kpis = await run_blocking(load_period_results, client, ym_list, emb_list)
+        debug_info = {
+            "booking_len": booking_concat.attrs.get("bookings", len(booking_concat)),
+            "booking_sum_qtde": int(booking_concat["qtde"].sum()) if len(booking_concat) else 0,
+            "transp_len": len(transp_concat),
+            "multi_len": len(multi_concat),
+        }
+        return {"kpis": kpis, "debug": debug_info}
+
+    body = await report_flight.run(report_flight_key("summary", client, ym_list, emb_list), compute)
+    return JSONResponse(body)
 
 @app.post("/api/generate-email")
 async def api_generate_email(payload: dict):
@@ -1504,20 +3745,38 @@ async def api_generate_email(payload: dict):
     if not client or not yms or not embarcadores:
         raise HTTPException(status_code=400, detail="Campos obrigatórios ausentes.")
 
-    booking_frames, multi_frames, transp_frames = [], [], []
-    for y in yms:
-        booking_frames.append(load_booking_df(get_latest_blob(client, y, "booking"), [y], embarcadores))
-        multi_frames.append(load_multi_df(get_latest_blob(client, y, "multi"), [y], embarcadores))
-        transp_frames.append(load_transp_df(get_latest_blob(client, y, "transp"), [y], embarcadores))
-
-    booking_concat = _concat_safely(booking_frames)
-    multi_concat = _concat_safely(multi_frames)
-    transp_concat = _concat_safely(transp_frames)
-
-    kpis = compute_kpis(booking_concat, multi_concat, transp_concat)
-    txt, html = build_email_v2(kpis, yms, embarcadores, booking_concat, transp_concat, multi_concat)
-
-    return JSONResponse({"status": "ok", "email": txt, "email_html": html})
+    defer_ai = bool(payload.get("defer_ai"))
+
+    # O texto do e-mail usa a ordem dos filtros como veio: ela também entra na chave
+    async def compute():
+        async with report_limiter:
+            booking_concat, multi_concat, transp_concat, kpis = await run_blocking(load_period_results, client, yms, embarcadores)
+
+            # defer_ai: responde já com o texto padrão; as seções da IA chegam via polling
+            if defer_ai:
+                txt, html, ai_status, ai_job = await run_blocking(
+                    build_email_deferred, kpis, yms, embarcadores, booking_concat, transp_concat, multi_concat)
+                return {"status": "ok", "email": txt, "email_html": html, "ai_status": ai_status, "ai_job": ai_job}
+
+            txt, html = await build_email_async(kpis, yms, embarcadores, booking_concat, transp_concat, multi_concat)
+        return {"status": "ok", "email": txt, "email_html": html}
+
+    body = await report_flight.run(report_flight_key("email", client, yms, embarcadores, defer_ai, tuple(yms), tuple(embarcadores)), compute)
+    return JSONResponse(body)
+
+@app.get("/api/generate-email/ai/{job_id}")
+def api_generate_email_ai(job_id: str):
+    """Estado da IA de um e-mail gerado com defer_ai: pending | done (com o e-mail completo) | fallback"""
+    with _ai_lock:
+        job = ai_jobs.get(job_id)
+        if job is not None and job["status"] == "pending" and datetime.now().timestamp() - job["started"] > AI_JOB_TIMEOUT_S:
+            job = ai_jobs[job_id] = {"status": "fallback"}
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job de IA não encontrado ou expirado.")
+    out = {"status": "ok", "ai_status": job["status"]}
+    if job["status"] == "done":
+        out.update(email=job["email"], email_html=job["email_html"])
+    return JSONResponse(out)
 
 @app.post("/api/generate-eml-by")
 async def api_generate_eml_by(payload: dict):
@@ -1527,90 +3786,104 @@ async def api_generate_eml_by(payload: dict):
     if not client or not yms or not embarcadores:
         raise HTTPException(status_code=400, detail="Campos obrigatórios ausentes.")
 
-    booking_frames, multi_frames, transp_frames = [], [], []
-    for y in yms:
-        booking_frames.append(load_booking_df(get_latest_blob(client, y, "booking"), [y], embarcadores))
-        multi_frames.append(load_multi_df(get_latest_blob(client, y, "multi"), [y], embarcadores))
-        transp_frames.append(load_transp_df(get_latest_blob(client, y, "transp"), [y], embarcadores))
+    async def compute():
+        async with report_limiter:
+            booking_concat, multi_concat, transp_concat, kpis = await run_blocking(load_period_results, client, yms, embarcadores)
+            txt, html = await build_email_async(kpis, yms, embarcadores, booking_concat, transp_concat, multi_concat)
+        return await run_blocking(eml_payload, txt, html, yms, embarcadores)
 
-    booking_concat = _concat_safely(booking_frames)
-    multi_concat = _concat_safely(multi_frames)
-    transp_concat = _concat_safely(transp_frames)
+    payload_eml = await report_flight.run(report_flight_key("eml", client, yms, embarcadores, tuple(yms), tuple(embarcadores)), compute)
+    return JSONResponse({"status": "ok", **payload_eml})
 
-    kpis = compute_kpis(booking_concat, multi_concat, transp_concat)
-    txt, html = build_email_v2(kpis, yms, embarcadores, booking_concat, transp_concat, multi_concat)
+@app.post("/api/report-jobs")
+def api_enqueue_report_job(payload: dict):
+    """Enfileira um e-mail ("type": "email") ou .eml ("type": "eml"); acompanhar em /api/report-jobs/{id}"""
+    job_type = payload.get("type", "email")
+    client = payload.get("client")
+    yms = payload.get("yms", [])
+    embarcadores = payload.get("embarcadores", [])
+    if job_type not in REPORT_JOB_TYPES:
+        raise HTTPException(status_code=400, detail=f"Tipo inválido: {job_type}. Use {', '.join(REPORT_JOB_TYPES)}.")
+    if not client or not yms or not embarcadores:
+        raise HTTPException(status_code=400, detail="Campos obrigatórios ausentes.")
 
-    emb_label = ", ".join(embarcadores)
-    subject = f"Diário Operacional – {format_periodos_label(yms)} – {emb_label}"
-    raw_eml = build_eml(subject, html, txt)
-    b64 = base64.b64encode(raw_eml).decode("ascii")
-    return JSONResponse({"status": "ok", "filename": "diario_operacional.eml", "file_b64": b64})
+    job_id, coalesced = enqueue_report_job(job_type, client, yms, embarcadores)
+    job = get_report_job(job_id)
+    return JSONResponse({"status": "ok", "job_id": job_id, "job_status": job["status"], "coalesced": coalesced},
+                        status_code=202)
+
+@app.get("/api/report-jobs/{job_id}")
+def api_report_job_status(job_id: str):
+    job = get_report_job(job_id)
+    return JSONResponse({"status": "ok", "job_id": job_id, "type": job["job_type"], "job_status": job["status"],
+                         "stage": job["stage"], "progress": job["progress"], "stages": list(REPORT_STAGES),
+                         "error": job["error"], "created_at": job["created_at"], "updated_at": job["updated_at"]})
+
+@app.get("/api/report-jobs/{job_id}/result")
+def api_report_job_result(job_id: str):
+    job = get_report_job(job_id, with_result=True)
+    if job["status"] == "error":
+        raise HTTPException(status_code=409, detail=f"Job falhou: {job['error']}")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job ainda em andamento ({job['stage'] or job['status']}).")
+    return JSONResponse({"status": "ok", **json.loads(job["result"])})
+
+# Disponibilidade do cliente: uma leitura pela PK de upload_periods
+_AVAILABILITY_SQL = text("SELECT ym, kinds, updated_at FROM upload_periods WHERE client=:c ORDER BY ym DESC")
+
+def _availability_etag(client: str, ym: Optional[str], rows) -> str:
+    """ETag da resposta: muda quando algum mês do cliente é gravado/removido (updated_at)"""
+    state = json.dumps([client, ym or "", AGG_VERSION, [list(r) for r in rows]], default=str)
+    return '"' + hashlib.sha1(state.encode("utf-8")).hexdigest()[:20] + '"'
 
 @app.get("/api/available-data")
-def api_available_data(client: str = Query(..., description="Identificador do bucket/cliente")):
+def api_available_data(request: Request,
+                       client: str = Query(..., description="Identificador do bucket/cliente"),
+                       ym: Optional[str] = Query(None, description="Opcional: meses YYYY-MM separados por vírgula p/ listar os embarcadores")):
     """
     Retorna períodos e embarcadores disponíveis no banco para o cliente.
     Útil para auto-carregar dados ao abrir a aplicação sem precisar refazer upload.
+    Períodos = meses com os três tipos de planilha (upload_periods); embarcadores vêm do
+    catálogo gravado no upload: por padrão, os do arquivo de booking do período mais
+    recente; com ?ym=..., os ativos naqueles meses. Responde 304 se o ETag não mudou.
     """
     if not client:
         raise HTTPException(status_code=400, detail="Informe ?client=...")
     
     try:
-        with engine.begin() as conn:
-            # Buscar períodos únicos onde temos dados completos (booking, multi, transp)
-            periods_query = text("""
-                SELECT DISTINCT ym 
-                FROM uploads 
-                WHERE client = :c 
-                  AND ym IN (
-                      SELECT ym FROM uploads WHERE client = :c AND kind = 'booking'
-                      INTERSECT
-                      SELECT ym FROM uploads WHERE client = :c AND kind = 'multi'
-                      INTERSECT
-                      SELECT ym FROM uploads WHERE client = :c AND kind = 'transp'
-                  )
-                ORDER BY ym DESC
-            """)
-            periods_result = conn.execute(periods_query, {"c": client}).fetchall()
-            periods = [row[0] for row in periods_result]
-            
-            # Se não há períodos, retorna vazio
-            if not periods:
-                return JSONResponse({
-                    "status": "ok",
-                    "has_data": False,
-                    "periods": [],
-                    "embarcadores": []
-                })
-            
-            # Carregar embarcadores do período mais recente
-            latest_period = periods[0]
-            booking_blob = get_latest_blob(client, latest_period, "booking")
-            
-            if booking_blob:
-                # Parsear booking para extrair embarcadores
-                booking_sheets = parse_excel_bytes(booking_blob)
-                if booking_sheets:
-                    df_all = pd.concat(booking_sheets.values(), ignore_index=True)
-                    col_emb = ensure_col(df_all, CANDS_BOOKING_EMB)
-                    col_stat = ensure_col(df_all, CANDS_BOOKING_STAT)
-                    
-                    if col_emb:
-                        df_active = df_all[df_all[col_stat].astype(str).str.strip().str.lower() == "ativo"] if col_stat else df_all
-                        embarcadores = sorted(df_active[col_emb].astype(str).str.strip().dropna().unique().tolist())
-                    else:
-                        embarcadores = []
-                else:
-                    embarcadores = []
-            else:
-                embarcadores = []
-            
+        with engine.connect() as conn:
+            rows = conn.execute(_AVAILABILITY_SQL, {"c": client}).fetchall()
+        etag = _availability_etag(client, ym, rows)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag in {t.strip() for t in request.headers.get("if-none-match", "").split(",")}:
+            return Response(status_code=304, headers=headers)
+
+        # Meses com dados completos (booking, multi, transp), do mais recente p/ o mais antigo
+        periods = [r[0] for r in rows if (r[1] & KINDS_COMPLETE) == KINDS_COMPLETE]
+
+        # Se não há períodos, retorna vazio
+        if not periods:
             return JSONResponse({
                 "status": "ok",
-                "has_data": True,
-                "periods": periods,
-                "embarcadores": embarcadores
-            })
+                "has_data": False,
+                "periods": [],
+                "embarcadores": []
+            }, headers=headers)
+
+        if ym:
+            ym_list = [y.strip() for y in ym.split(",") if y.strip()]
+            catalog = embarcador_catalog(client, ym_list)
+        else:
+            catalog = embarcador_catalog(client, [periods[0]], whole_file=True)
+        embarcadores = sorted(catalog)
+
+        return JSONResponse({
+            "status": "ok",
+            "has_data": True,
+            "periods": periods,
+            "embarcadores": embarcadores,
+            "embarcador_roots": {e: catalog[e] for e in embarcadores}
+        }, headers=headers)
             
     except Exception as e:
         print(f"[ERROR] Falha ao buscar dados disponíveis: {str(e)}")
@@ -1630,26 +3903,42 @@ def api_flush(client: str = Query(..., description="Identificador do bucket/clie
 
     with engine.begin() as conn:
         if ym:
+            stale = _legacy_tokens(conn, "client=:c AND ym=:y", {"c": client, "y": ym})
             res = conn.execute(text("DELETE FROM uploads WHERE client=:c AND ym=:y"),
                                {"c": client, "y": ym})
             deleted = res.rowcount or 0
+            conn.execute(text("DELETE FROM upload_periods WHERE client=:c AND ym=:y"), {"c": client, "y": ym})
             detail = {"client": client, "ym": ym}
         else:
+            stale = _legacy_tokens(conn, "client=:c", {"c": client})
             res = conn.execute(text("DELETE FROM uploads WHERE client=:c"), {"c": client})
             deleted = res.rowcount or 0
+            conn.execute(text("DELETE FROM upload_periods WHERE client=:c"), {"c": client})
             detail = {"client": client, "ym": None}
+        stale |= gc_orphan_blobs(conn)
 
-    # Limpar cache
-    cache.clear()
+    # Limpar só o cache derivado dos arquivos removidos
+    invalidate_content(stale)
     
     return JSONResponse({"status": "ok", "deleted": int(deleted), "detail": detail})
 
-@app.get("/api/health")
-def health():
-    return {"ok": True, "cache_size": len(cache)}
-
 @app.get("/api/clear-cache")
 def clear_cache():
     """Endpoint para limpar cache manualmente"""
     cache.clear()
-    return {"status": "ok", "message": "Cache limpo com sucesso"}
\ No newline at end of file
+    result_cache.clear()
+    chart_cache.clear()
+    ai_cache.clear()
+    return {"status": "ok", "message": "Cache limpo com sucesso"}
+# =============================================================================
+# CLI
+# =============================================================================
+if __name__ == "__main__":
+    # python -m backend.app init-db  -> cria/migra o schema fora do processo do servidor
+    import argparse
+    parser = argparse.ArgumentParser(description="Tarefas do backend do Diário Operacional")
+    parser.add_argument("command", choices=["init-db"])
+    args = parser.parse_args()
+    if args.command == "init-db":
+        ensure_schema()
+        print("[DB] Schema pronto")
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks do backend do Diário Operacional
+
+Para rodar (a partir da raiz do repositório):
+  python -m backend.benchmarks booking
+  python -m backend.benchmarks booking --sizes 10000 100000
+  python -m backend.benchmarks import --repeat 5 --budget 3.0
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+os.environ.setdefault("SUPABASE_DB_URL", "sqlite:///./bench.db")
+
+from backend.app import BOOKING_OUT_COLUMNS, filter_booking_norm  # noqa: E402
+
+
+# =============================================================================
+# REFERÊNCIAS (implementações antigas, mantidas p/ comparação)
+# =============================================================================
+
+def legacy_filter_booking_norm(norm: pd.DataFrame,
+                               selected_ym_list: Optional[List[str]] = None,
+                               selected_embarcadores: Optional[List[str]] = None) -> pd.DataFrame:
+    """Agregação por booking com loop groupby + sort_values (versão anterior)."""
+    df_all = norm[norm["ativo"].astype(bool)]
+    if selected_ym_list:
+        df_all = df_all[df_all["__ym"].isin(selected_ym_list)]
+    df_all = df_all[~df_all["__ym"].isna()]
+
+    records = []
+    embarcadores_str = ",".join(selected_embarcadores) if selected_embarcadores else ""
+    for (ym_val, bid), sub in df_all.groupby(["__ym", "booking_id"], dropna=False):
+        total_qtde = sub["qtde"].sum()
+        best_row = sub.sort_values("qtde", ascending=False).iloc[0]
+        records.append({
+            "ym": ym_val,
+            "booking_id": bid,
+            "porto_origem": best_row["porto_origem"],
+            "porto_destino": best_row["porto_destino"],
+            "qtde": int(total_qtde),
+            "embarcador": embarcadores_str
+        })
+    return pd.DataFrame(records, columns=BOOKING_OUT_COLUMNS).reset_index(drop=True)
+
+
+# =============================================================================
+# DADOS SINTÉTICOS
+# =============================================================================
+
+def synthetic_booking_norm(n_rows: int, seed: int = 42) -> pd.DataFrame:
+    """Frame normalizado de booking com ~3 linhas por booking em 6 meses."""
+    rng = np.random.default_rng(seed)
+    n_bookings = max(1, n_rows // 3)
+    portos = np.array(["SANTOS", "PARANAGUA", "ITAJAI", "SUAPE", "MANAUS", "PECEM", "RIO GRANDE"], dtype=object)
+    yms = np.array([f"2024-{m:02d}" for m in range(7, 13)], dtype=object)
+    bid = rng.integers(0, n_bookings, n_rows)
+    return pd.DataFrame({
+        "__ym": yms[bid % len(yms)],
+        "ativo": rng.random(n_rows) > 0.05,
+        "emb": "ACME SA",
+        "booking_id": np.char.add("BK", bid.astype(str)).astype(object),
+        "porto_origem": portos[rng.integers(0, len(portos), n_rows)],
+        "porto_destino": portos[rng.integers(0, len(portos), n_rows)],
+        # qtde distinta por linha: sem empates, a escolha dos portos é única
+        "qtde": rng.permutation(n_rows) + 1,
+    })
+
+
+# =============================================================================
+# BENCHMARKS
+# =============================================================================
+
+def _timed(fn, *args, repeat: int = 1) -> tuple:
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def bench_booking(sizes: List[int], legacy_max_rows: int) -> None:
+    print(f"{'linhas':>10} {'loop (s)':>10} {'vetor (s)':>10} {'ganho':>8}")
+    for n in sizes:
+        norm = synthetic_booking_norm(n)
+        t_new, out_new = _timed(filter_booking_norm, norm, repeat=3)
+        if n <= legacy_max_rows:
+            t_old, out_old = _timed(legacy_filter_booking_norm, norm)
+            key = ["ym", "booking_id"]
+            pd.testing.assert_frame_equal(
+                out_new.sort_values(key).reset_index(drop=True),
+                out_old.sort_values(key).reset_index(drop=True),
+            )
+            print(f"{n:>10} {t_old:>10.3f} {t_new:>10.3f} {t_old / t_new:>7.0f}x")
+        else:
+            print(f"{n:>10} {'-':>10} {t_new:>10.3f} {'-':>8}")
+
+
+# Dependências que o boot não deve carregar (são importadas no primeiro uso)
+LAZY_MODULES = ("matplotlib", "google.generativeai", "openpyxl")
+
+_IMPORT_PROBE = (
+    "import sys, time\n"
+    "t0 = time.perf_counter()\n"
+    "import backend.app\n"
+    "print('@time', time.perf_counter() - t0)\n"
+    "print('@lazy', *(m for m in {mods!r} if m in sys.modules))\n"
+)
+
+
+def import_profile(importtime: bool = False) -> Tuple[float, List[str], str]:
+    """
+    Importa backend.app num processo novo (como no boot do servidor, sem DDL no import).
+    Devolve (segundos, dependências lazy que foram carregadas, saída do -X importtime).
+    """
+    env = dict(os.environ, RUN_DB_INIT_AT_IMPORT="false")
+    env.setdefault("SUPABASE_DB_URL", "sqlite:///./bench.db")
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", _IMPORT_PROBE.format(mods=LAZY_MODULES)]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run(cmd, cwd=root, env=env, capture_output=True, text=True, check=True)
+    probe = {ln.split()[0]: ln.split()[1:] for ln in proc.stdout.splitlines() if ln.startswith("@")}
+    return float(probe["@time"][0]), probe["@lazy"], proc.stderr
+
+
+def _top_imports(importtime_log: str, n: int) -> List[Tuple[int, str]]:
+    """Imports diretos do backend.app com maior tempo acumulado no -X importtime (µs)"""
+    rows = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")[-3:]
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1 and cumulative.strip().isdigit():
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:n]
+
+
+def bench_import(repeat: int, budget: Optional[float], top: int) -> int:
+    times = []
+    loaded: List[str] = []
+    for _ in range(repeat):
+        t, loaded, _ = import_profile()
+        times.append(t)
+    print(f"import backend.app: min {min(times):.3f}s  mediana {statistics.median(times):.3f}s  ({repeat} execuções)")
+    print(f"dependências lazy carregadas no import: {', '.join(loaded) or 'nenhuma'}")
+    if top:
+        _, _, log = import_profile(importtime=True)
+        for us, name in _top_imports(log, top):
+            print(f"{us / 1e6:>10.3f}s  {name}")
+    if loaded or (budget is not None and min(times) > budget):
+        print("REGRESSÃO no tempo de boot")
+        return 1
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks do backend")
+    parser.add_argument("target", choices=["booking", "import"])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--legacy-max-rows", type=int, default=1_000_000,
+                        help="não roda a versão antiga acima deste tamanho")
+    parser.add_argument("--repeat", type=int, default=5, help="import: nº de processos medidos")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="import: falha (exit 1) se o melhor tempo passar deste limite em segundos")
+    parser.add_argument("--top", type=int, default=10, help="import: pacotes mais lentos a listar")
+    args = parser.parse_args()
+
+    if args.target == "booking":
+        bench_booking(args.sizes, args.legacy_max_rows)
+    elif args.target == "import":
+        sys.exit(bench_import(args.repeat, args.budget, args.top))
+
+
+if __name__ == "__main__":
+    main()
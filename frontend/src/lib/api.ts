@@ -169,11 +169,19 @@ export async function generateEmlBy(payload: {
   return res.json();
 }
 
-/** Dados disponíveis (períodos/embarcadores) */
+/** Dados disponíveis (períodos/embarcadores); com yms, lista os embarcadores ativos nesses meses */
 export async function getAvailableData(
-  client: string
-): Promise<{ has_data: boolean; periods: string[]; embarcadores: string[]; error?: string }> {
-  const res = await fetchWithTimeout(buildUrl("/api/available-data", { client }), {}, 60000);
+  client: string,
+  yms?: string[]
+): Promise<{
+  has_data: boolean;
+  periods: string[];
+  embarcadores: string[];
+  embarcador_roots?: Record<string, string | null>;
+  error?: string;
+}> {
+  const params = { client, ...(yms && yms.length ? { ym: yms.join(",") } : {}) };
+  const res = await fetchWithTimeout(buildUrl("/api/available-data", params), {}, 60000);
   await ensureOk(res);
   return res.json();
 }